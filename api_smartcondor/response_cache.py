@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+'''
+LRU cache with time to live for the API responses. Entries can optionally
+be shared with other server processes through a local SQLite file, and the
+whole cache is dropped whenever a newer snapshot is found in the database.
+'''
+from collections import OrderedDict
+from threading import Lock
+from time import time
+import json
+import sqlite3
+
+
+class SQLiteStore(object):
+    '''
+    Local store shared by the processes of the API server
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as con:
+            con.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT '
+                        'PRIMARY KEY, expires REAL, mimetype TEXT, body BLOB)')
+            con.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY '
+                        'KEY, value TEXT)')
+
+    def _connect(self):
+        # A connection per operation, since they cannot be shared by threads
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key):
+        with self._connect() as con:
+            row = con.execute('SELECT expires, mimetype, body FROM responses '
+                              'WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1], bytes(row[2])
+
+    def put(self, key, expires, mimetype, body):
+        with self._connect() as con:
+            con.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)',
+                        (key, expires, mimetype, sqlite3.Binary(body)))
+
+    def clear(self, snapshot):
+        '''
+        Removes every response and records the snapshot they belong to from
+        now on
+        '''
+        with self._connect() as con:
+            con.execute('DELETE FROM responses')
+            con.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        ('snapshot', snapshot))
+
+    def snapshot(self):
+        with self._connect() as con:
+            row = con.execute('SELECT value FROM meta WHERE name = ?',
+                              ('snapshot',)).fetchone()
+        return row[0] if row else None
+
+
+class ResponseCache(object):
+    '''
+    In-process LRU cache of response bodies with time to live
+    '''
+
+    def __init__(self, max_entries=512, ttl=3600, store_path=None,
+                 check_interval=60):
+        '''
+        max_entries -> maximum number of responses kept in memory
+        ttl -> seconds a response is valid for
+        store_path -> [Optional] SQLite file shared with other processes
+        check_interval -> minimum seconds between database snapshot checks
+        '''
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.store = SQLiteStore(store_path) if store_path else None
+        self.entries = OrderedDict()  # key -> (expires, mimetype, body)
+        self.lock = Lock()
+        self.snapshot = None
+        self.last_check = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def make_key(self, endpoint, view_args, query_args):
+        '''
+        Returns the cache key for a request: endpoint plus its URL and query
+        string arguments, sorted so that equivalent requests share a key.
+        The current snapshot is part of the key, so processes which have not
+        noticed a newer snapshot yet do not share their responses with the
+        ones that have
+        '''
+        return json.dumps([self.snapshot, endpoint, sorted(view_args.items()),
+                           sorted(query_args.items())])
+
+    def get(self, key):
+        '''
+        Returns the tuple (mimetype, body) cached for the given key, or None
+        '''
+        now = time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    # Move it to the most recently used end
+                    self.entries[key] = self.entries.pop(key)
+                    self.hits += 1
+                    return entry[1:]
+                del self.entries[key]
+        if self.store:
+            entry = self.store.get(key)
+            if entry is not None and entry[0] > now:
+                self._put_in_memory(key, entry)
+                with self.lock:
+                    self.hits += 1
+                return entry[1:]
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def _put_in_memory(self, key, entry):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = entry
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def put(self, key, mimetype, body):
+        entry = (time() + self.ttl, mimetype, body)
+        self._put_in_memory(key, entry)
+        if self.store:
+            self.store.put(key, *entry)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.invalidations += 1
+
+    def check_snapshot(self, latest_snapshot):
+        '''
+        Drops every cached response if the given snapshot (a callable which
+        returns the newest timestamp stored in the database) is newer than
+        the one the responses belong to. The database is checked at most
+        once every check_interval seconds
+        '''
+        now = time()
+        if self.last_check and now - self.last_check < self.check_interval:
+            return
+        self.last_check = now
+        latest = latest_snapshot()
+        latest = latest.isoformat() if latest else None
+        if latest == self.snapshot:
+            return
+        if self.snapshot is not None or self.entries:
+            self.clear()
+        self.snapshot = latest
+        if self.store and self.store.snapshot() != latest:
+            self.store.clear(latest)
+
+    def stats(self):
+        with self.lock:
+            requests = self.hits + self.misses
+            return {'hits': self.hits, 'misses': self.misses,
+                    'hit_rate': (float(self.hits) / requests
+                                 if requests else 0.),
+                    'entries': len(self.entries),
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'snapshot': self.snapshot,
+                    'shared_store': self.store.path if self.store else None}
@@ -1,112 +1,304 @@
 # -*- coding: utf-8 -*-
 
-from flask import Flask, jsonify
+from flask import Flask, Response, jsonify, request
 from flask_pymongo import PyMongo
 from flask_restful import Api, Resource
-from datetime import datetime
+from pymongo import ASCENDING, DESCENDING
+from datetime import datetime, timedelta
+from functools import wraps
+from response_cache import ResponseCache
+import base64
+import json
 
 app = Flask(__name__)
 app.config['MONGO_DBNAME'] = 'smartcondor'
 mongo = PyMongo(app, config_prefix='MONGO')
 APP_URL = 'http://127.0.0.1:5000'
 
+# Response cache. CACHE_STORE is an optional SQLite file to share cached
+# responses among server processes
+app.config.setdefault('CACHE_MAX_ENTRIES', 512)
+app.config.setdefault('CACHE_TTL', 3600)
+app.config.setdefault('CACHE_STORE', None)
+cache = ResponseCache(max_entries=app.config['CACHE_MAX_ENTRIES'],
+                      ttl=app.config['CACHE_TTL'],
+                      store_path=app.config['CACHE_STORE'])
+
+# Page size limits for every request
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Sort orders matching the indexes created by mongo_loader.py, so that
+# pages are read in index order instead of sorting in memory
+UNDERLYINGS_SORT = [('timestamp', DESCENDING), ('ticker', ASCENDING)]
+OPTIONS_SORT = [('timestamp', DESCENDING), ('ticker', ASCENDING),
+                ('contract_id', ASCENDING)]
+
+# Fields which can be requested through the 'fields' parameter
+UNDERLYINGS_FIELDS = ['ticker', 'last', 'iv', 'timestamp']
+OPTIONS_FIELDS = ['ticker', 'contract_id', 'right', 'strike', 'close',
+                  'bid', 'ask', 'iv', 'expiry', 'multiplier', 'timestamp']
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def encode_token(doc):
+    '''
+    Returns the resume token pointing right after given document: its
+    timestamp (in milliseconds) and, for options, its contract id
+    '''
+    key = [int((doc['timestamp'] - EPOCH).total_seconds() * 1000)]
+    if 'contract_id' in doc:
+        key.append(doc['contract_id'])
+    return base64.urlsafe_b64encode(
+        json.dumps(key).encode('utf-8')).decode('ascii')
+
+
+def decode_token(token):
+    '''
+    Returns the query which resumes a scan sorted as UNDERLYINGS_SORT or
+    OPTIONS_SORT after the document given by the resume token. Raises
+    ValueError if the token is not valid
+    '''
+    try:
+        key = json.loads(base64.urlsafe_b64decode(
+            token.encode('ascii')).decode('utf-8'))
+        timestamp = EPOCH + timedelta(milliseconds=key[0])
+    except (TypeError, ValueError, IndexError, OverflowError):
+        raise ValueError('Wrong resume token')
+    # Timestamps are scanned descending, contract ids ascending
+    if len(key) == 1:
+        return {'timestamp': {'$lt': timestamp}}
+    return {'$or': [{'timestamp': {'$lt': timestamp}},
+                    {'timestamp': timestamp,
+                     'contract_id': {'$gt': key[1]}}]}
+
+
+def parse_page_args(default_limit, allowed_fields, key_fields):
+    '''
+    Reads the pagination arguments of the request query string:
+        limit -> number of documents per page (up to MAX_PAGE_SIZE)
+        after -> resume token returned by the previous page
+        fields -> comma separated list of fields to be returned. Fields used
+            by the resume token are always returned
+        format -> 'json' (default) or 'ndjson'
+    Returns a tuple (limit, resume query, projection, format). Raises
+    ValueError on wrong arguments
+    '''
+    try:
+        limit = int(request.args.get('limit', default_limit))
+    except ValueError:
+        raise ValueError('Wrong limit format: must be an integer')
+    if limit < 1:
+        raise ValueError('Wrong limit format: must be positive')
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    after = request.args.get('after')
+    resume = decode_token(after) if after else None
+
+    fields = request.args.get('fields')
+    fields = fields.split(',') if fields else allowed_fields
+    unknown = [f for f in fields if f not in allowed_fields]
+    if unknown:
+        raise ValueError('Unknown fields: ' + ', '.join(unknown))
+    projection = {f: True for f in set(fields) | set(key_fields)}
+    projection['_id'] = False
+
+    output_format = request.args.get('format', 'json')
+    if output_format not in ['json', 'ndjson']:
+        raise ValueError('Wrong format: use \'json\' or \'ndjson\'')
+    return limit, resume, projection, output_format
+
+
+def _to_json(doc):
+    return json.dumps(doc, default=lambda v: (
+        v.strftime('%Y-%m-%dT%H:%M:%S') if isinstance(v, datetime)
+        else str(v)))
+
+
+def stream_page(collection, query, sort, limit, resume, projection,
+                output_format):
+    '''
+    Streams one page of the query results. A single extra document is read
+    to know whether there is a next page, so memory use does not depend on
+    the page size. The resume token of the next page (or null on the last
+    page) is sent as 'next': in the JSON object for 'json' format, or as the
+    last line for 'ndjson' format
+    '''
+    if resume:
+        query = {'$and': [query, resume]}
+    cursor = collection.find(query, projection).sort(sort).limit(limit + 1)
+
+    def generate():
+        token = None
+        if output_format == 'json':
+            yield '{"status": "ok", "response": ['
+        for n, doc in enumerate(cursor):
+            if n == limit:
+                token = encode_token(last)
+                break
+            if output_format == 'ndjson':
+                yield _to_json(doc) + '\n'
+            else:
+                yield (', ' if n else '') + _to_json(doc)
+            last = doc
+        cursor.close()
+        if output_format == 'ndjson':
+            yield _to_json({'next': token}) + '\n'
+        else:
+            yield '], "next": ' + _to_json(token) + '}'
+
+    return Response(generate(), mimetype=(
+        'application/x-ndjson' if output_format == 'ndjson'
+        else 'application/json'))
+
+
+def error_response(error):
+    return jsonify({'status': 'nok', 'response': error})
+
+
+def latest_snapshot():
+    '''
+    Returns the newest timestamp stored in the database. Both lookups are
+    served by the timestamp indexes
+    '''
+    latest = None
+    for collection in [mongo.db.underlyings, mongo.db.options]:
+        for doc in collection.find({}, {'timestamp': True, '_id': False}).sort(
+                'timestamp', DESCENDING).limit(1):
+            if latest is None or doc['timestamp'] > latest:
+                latest = doc['timestamp']
+    return latest
+
+
+def cached(get):
+    '''
+    Decorator which serves a resource get method from the response cache.
+    Streamed responses are stored once they have been completely sent,
+    error responses are not cached
+    '''
+    @wraps(get)
+    def wrapper(self, *args, **kwargs):
+        cache.check_snapshot(latest_snapshot)
+        key = cache.make_key(request.endpoint, request.view_args,
+                             request.args.to_dict())
+        entry = cache.get(key)
+        if entry is not None:
+            return Response(entry[1], mimetype=entry[0])
+
+        response = get(self, *args, **kwargs)
+        if response.is_streamed:
+            chunks = response.response
+
+            def tee():
+                body = []
+                for chunk in chunks:
+                    body.append(chunk)
+                    yield chunk
+                cache.put(key, response.mimetype,
+                          ''.join(body).encode('utf-8'))
+
+            response.response = tee()
+        return response
+    return wrapper
+
 
 class Underlying(Resource):
+    @cached
     def get(self, ticker=None, startdate=None, enddate=None):
         '''
         Gets a list of underlying close prices and IV for given ticker and
-        dates between requested limits
+        dates between requested limits, newest first. Without dates, the
+        latest day info is returned
         '''
-        data = []
-        error = None
-        if ticker:
-            # Check if date range is given
-            if startdate and enddate:
-                try:
-                    # Check dates format
-                    start_datetime = datetime.strptime(startdate, '%d%m%Y')
-                    end_datetime = datetime.strptime(enddate, '%d%m%Y')
-                    # Query the database
-                    info = mongo.db.underlyings.find({
-                        'ticker': ticker,
-                        'timestamp': {
-                            '$gte': start_datetime,
-                            '$lte': end_datetime
-                        }
-                    })
-                    if info:
-                        data.append(info)
-                except ValueError:
-                    error = 'Wrong date format: use \'ddmmyyyy\''
-            else:
-                # No dates given, return latest day info
-                info = mongo.db.underlyings.find({
-                    'ticker': ticker}).limit(1).sort({'$natural': -1})
-                if info:
-                    data.append(info)
+        query = {'ticker': ticker}
+        default_limit = 1
+        # Check if date range is given
+        if startdate and enddate:
+            try:
+                # Check dates format
+                start_datetime = datetime.strptime(startdate, '%d%m%Y')
+                end_datetime = datetime.strptime(enddate, '%d%m%Y')
+            except ValueError:
+                return error_response('Wrong date format: use \'ddmmyyyy\'')
+            query['timestamp'] = {'$gte': start_datetime,
+                                  '$lte': end_datetime}
+            default_limit = DEFAULT_PAGE_SIZE
 
-        return jsonify({'status': ('nok' if error else 'ok'),
-                        'response': (error if error else data)})
+        try:
+            page_args = parse_page_args(default_limit, UNDERLYINGS_FIELDS,
+                                        ['timestamp'])
+        except ValueError as e:
+            return error_response(str(e))
+        return stream_page(mongo.db.underlyings, query, UNDERLYINGS_SORT,
+                           *page_args)
 
 
 class OptionData(Resource):
+    @cached
     def get(self, ticker=None, right=None, strike=None, expiry=None,
             samples=1):
-        data = []
-        error = None
-        query = {}
-        if ticker:
-            query['ticker'] = ticker
-            # Check if expiry date is given
-            if expiry:
-                try:
-                    # Check date format
-                    query['expiry'] = datetime.strptime(expiry, '%d%m%Y')
-                except ValueError:
-                    error = 'Wrong date format: use \'ddmmyyyy\''
-
-            # Check if right is given
-            if (right.upper() == 'P') or (right.upper() == 'C'):
-                query['right'] = right.upper()
-            else:
-                error = ('Wrong right format: use \'C\' for calls '
-                         'or \'P\' for puts')
-
-            # Check if strike is given and it is a positive number
-            if strike:
-                try:
-                    value = float(strike)
-                    if value < 0:
-                        error = 'Wrong strike format: must be positive'
-                    else:
-                        query['strike'] = strike
-                except ValueError:
-                    error = 'Wrong strike format: must be a number'
-
-        # Query the database
-        info = mongo.db.options.find(query).limit(samples).sort(
-            {'$natural': -1})
-        if info:
-            data.append(info)
-
-        return jsonify({'status': ('nok' if error else 'ok'),
-                        'response': (error if error else data)})
+        '''
+        Gets the stored snapshots of the options of given ticker, right,
+        strike and expiry, newest first. samples is the default page size
+        '''
+        query = {'ticker': ticker}
+        # Check if expiry date is given
+        if expiry:
+            try:
+                # Check date format
+                query['expiry'] = datetime.strptime(expiry, '%d%m%Y')
+            except ValueError:
+                return error_response('Wrong date format: use \'ddmmyyyy\'')
+
+        # Check if right is given
+        if right and right.upper() in ['P', 'C']:
+            query['right'] = right.upper()
+        else:
+            return error_response('Wrong right format: use \'C\' for calls '
+                                  'or \'P\' for puts')
+
+        # Check if strike is given and it is a positive number
+        if strike:
+            try:
+                value = float(strike)
+            except ValueError:
+                return error_response('Wrong strike format: must be a number')
+            if value < 0:
+                return error_response('Wrong strike format: must be positive')
+            query['strike'] = value
+
+        try:
+            page_args = parse_page_args(samples, OPTIONS_FIELDS,
+                                        ['timestamp', 'contract_id'])
+        except ValueError as e:
+            return error_response(str(e))
+        return stream_page(mongo.db.options, query, OPTIONS_SORT, *page_args)
+
+
+class CacheStats(Resource):
+    def get(self):
+        '''
+        Gets the response cache hit/miss counters
+        '''
+        return jsonify({'status': 'ok', 'response': cache.stats()})
 
 
 api = Api(app)
-api.add_resource(Underlying, '/underlying/<string:ticker>/')
-api.add_resource(Underlying, '/underlying/<string:ticker>/'
-                             '<string:startdate>/'
-                             '<string:enddate>')
-api.add_resource(OptionData, '/optiondata/<string:ticker>/'
-                             '<string:right>/'
-                             '<string:strike>/'
-                             '<string:expiry>')
+api.add_resource(Underlying, '/underlying/<string:ticker>/',
+                 '/underlying/<string:ticker>/'
+                 '<string:startdate>/'
+                 '<string:enddate>')
 api.add_resource(OptionData, '/optiondata/<string:ticker>/'
                              '<string:right>/'
                              '<string:strike>/'
-                             '<string:expiry>/'
-                             '<int:samples>')
+                             '<string:expiry>',
+                 '/optiondata/<string:ticker>/'
+                 '<string:right>/'
+                 '<string:strike>/'
+                 '<string:expiry>/'
+                 '<int:samples>')
+api.add_resource(CacheStats, '/cache/stats')
 
 if __name__ == '__main__':
     app.run(debug=True)
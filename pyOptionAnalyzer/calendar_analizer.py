@@ -1,4 +1,3 @@
-# from itertools import combinations
 from argparse import ArgumentParser
 import logging
 import pandas as pd
@@ -6,9 +5,11 @@ import numpy as np
 from scipy import interpolate
 from scipy.stats import lognorm
 import sys
-from option import Option
+from chain_index import ChainIndex
 from make_selection import SelectionList
+from chain_store import open_chain_source
 from calendar_spread import CalendarSpread
+from debit_matrix import DebitMatrix
 import matplotlib.pyplot as plt
 import seaborn as sns
 sns.set(style='darkgrid')
@@ -21,37 +22,31 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s')
 
 
-def plot_calendars(df, near_term_exp, next_term_exp, current_price):
+def plot_calendars(df, near_term_exp, next_term_exp, current_price,
+                   debit_matrix=None):
+    '''
+    Plots the debit per strike of the calendar spreads between two expiries
+    df -> option chain of a single right
+    debit_matrix -> [Optional] DebitMatrix of midprices already computed for
+        the option chain, to be reused instead of building it again
+    '''
     ticker = str(df['m_symbol'].head(1)).split()[0]
-    # Filter to keep only the expirations under analysis
-    df = df[(df['m_expiry'] == near_term_exp) |
-            (df['m_expiry'] == next_term_exp)]
-    # Replace -1.0 values in bid/ask for 0
-    df.loc[df.bid < 0, 'bid'] = 0
-    df.loc[df.ask < 0, 'ask'] = 0
-    # Replace NaN values by 0
-    df = df.fillna(0)
-    # Calculate midprice and remove rows whose midprice is zero
-    df['midprice'] = (df['bid'] + df['ask']) / 2
-    df = df[df.midprice != 0]
-    # Group by expiry & strike: each group will have 2 entries: diff their
-    # midprice
-    groups = df.groupby('m_expiry')
-    near_term_group = groups.get_group(near_term_exp)
-    next_term_group = groups.get_group(next_term_exp)
-    # Drop strikes which are not available in both expiries
-    strikes = pd.merge(near_term_group[['m_strike']],
-                       next_term_group[['m_strike']],
-                       how='inner', on=['m_strike'])
-    # print len(near_term_group), len(next_term_group)
-    prices = []
-    for strike in strikes['m_strike']:
-        a = near_term_group.loc[near_term_group['m_strike'] == strike,
-                                'midprice'].values[0]
-        b = next_term_group.loc[next_term_group['m_strike'] == strike,
-                                'midprice'].values[0]
-        price = b - a
-        prices.append(price)
+    if debit_matrix is None:
+        # Replace -1.0 values in bid/ask for 0
+        df = df.copy()
+        df.loc[df.bid < 0, 'bid'] = 0
+        df.loc[df.ask < 0, 'ask'] = 0
+        # Replace NaN values by 0
+        df = df.fillna(0)
+        # Calculate midprice and remove rows whose midprice is zero
+        df['midprice'] = (df['bid'] + df['ask']) / 2
+        df = df[df.midprice != 0]
+        # Align the midprices of every strike and expiry at once
+        debit_matrix = DebitMatrix.from_chain(df, 'midprice', 'midprice')
+    # Strikes not available in both expiries are dropped
+    curve = debit_matrix.curve(near_term_exp, next_term_exp)
+    strikes = pd.DataFrame({'m_strike': curve.index.values})
+    prices = curve.values
 
     # Create plot
     fig, ax1 = plt.subplots()
@@ -81,7 +76,8 @@ if __name__ == "__main__":
     # Configure the command line options
     parser = ArgumentParser()
     parser.add_argument('-i', '--input', type=str,
-                        help='Uses an excel file as input')
+                        help=('Uses an excel file (.xlsx) or a chain store '
+                              'directory as input'))
     parser.add_argument('-x', '--expiry', type=str, help=('Determines option '
                         'expiry date. Use format YYYYMM'))
     parser.add_argument('-s', '--strike', type=float,
@@ -95,17 +91,17 @@ if __name__ == "__main__":
     args = parser.parse_args()
     df_option_chain = None
     if not args.input:
-        print('ERROR: requires an excel input')
+        print('ERROR: requires an excel or chain store input')
     if not args.right:
         print('ERROR: must select call or put calendar spreads with -r')
     if args.right.upper() not in ['C', 'P']:
         print('ERROR: -r argument must be either \'C\' or \'P\'')
     else:
-        # Load the option chain from excel
-        logging.info('Loading option chain from Excel file ' + args.input)
-        excel_file = pd.ExcelFile(args.input)
-        # Get sheets names
-        tickers = excel_file.sheet_names
+        # Load the option chain from excel or from the chain store
+        logging.info('Loading option chain from ' + args.input)
+        chain_source = open_chain_source(args.input)
+        # Get available tickers
+        tickers = chain_source.tickers()
         # Let the user decide which ticker to analyze
         selectionList = SelectionList(tickers)
         selectionList.mainloop()
@@ -116,7 +112,7 @@ if __name__ == "__main__":
         else:
             logging.info('User quitted')
             sys.exit()
-        df = excel_file.parse(selected_ticker)
+        df = chain_source.load(selected_ticker)
 
         # Keep only calls or puts depending on the selection made
         df = df[df.m_right == args.right.upper()]
@@ -168,12 +164,9 @@ if __name__ == "__main__":
             logging.info('User quitted')
             sys.exit()
 
-        near_term_opt = Option.from_pandas(
-            df[(df['m_expiry'] == near_term) &
-               (df['m_strike'] == strike)], amount=-1)
-        next_term_opt = Option.from_pandas(
-            df[(df['m_expiry'] == next_term) &
-               (df['m_strike'] == strike)], amount=1)
+        near_term_opt, next_term_opt = ChainIndex(df).options(
+            [(near_term, strike, args.right), (next_term, strike, args.right)],
+            [-1, 1])
 
         calendar = CalendarSpread(near_term_opt, next_term_opt)
         logging.info('Plotting ' + str(near_term) + '/' + str(next_term) +
@@ -216,17 +209,4 @@ if __name__ == "__main__":
 
         calls = df[df['m_right'] == 'C']
         plot_calendars(calls, near_term, next_term, current_price)
-        sys.exit()  # TODO remove to go on
-
-        '''
-        # Do all the possible combinations of expiries for calendar spreads
-        expiry_combinations = list(combinations(expiries, r=2))
-
-        # Iterate calls
-        for (near_term, next_term) in expiry_combinations:
-            if near_term > next_term:
-                continue
-            today = datetime.today()  # TODO Avoid past options for now
-            if today > datetime.strptime(str(near_term), '%Y%m%d'):
-                continue
-        '''
+        sys.exit()
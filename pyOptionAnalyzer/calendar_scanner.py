@@ -0,0 +1,306 @@
+'''
+Headless calendar spread scanner. It builds every long calendar spread
+candidate of an option chain (all the expiry pairs, strikes and rights),
+values all of them at the near-term expiration at once and returns them
+ranked in a DataFrame, so no expiry or strike has to be picked by hand.
+
+Every candidate is evaluated on its own grid of underlying prices, evenly
+spaced in standard deviations of the lognormal distribution at the near-term
+expiration, and its probability of profit and expected value are integrated
+by pop_engine for all the candidates at once.
+'''
+from argparse import ArgumentParser
+from datetime import datetime
+from multiprocessing import Pool
+import logging
+import numpy as np
+import pandas as pd
+import bs_engine
+import iv_solver
+import pop_engine
+from chain_buffer import IB_UNSET_INTEGER
+from chain_store import open_chain_source
+from debit_matrix import DebitMatrix
+
+# Grid of underlying prices, in standard deviations around the forward price
+GRID_STDDEVS = 5.
+GRID_POINTS = 201
+# Candidates valued at the same time (bounds the memory used by the grids)
+CHUNK_SIZE = 2000
+# Underlying prices further than this factor from the median strike are
+# taken as unset values
+MAX_PRICE_TO_STRIKE = 10.
+
+# Columns of the DataFrame returned by the scanner
+SCAN_COLUMNS = ['ticker', 'right', 'strike', 'near_expiry', 'next_expiry',
+                'debit', 'mid_debit', 'delta', 'gamma', 'theta', 'vega',
+                'be_low', 'be_high', 'n_breakevens', 'pop', 'expected_value',
+                'max_profit', 'max_loss', 'return_on_risk']
+
+
+def underlying_price(df):
+    '''
+    Returns the underlying price quoted by IB along with the option chain
+    (median of the bid_undPrice and ask_undPrice columns). IB unset values,
+    and prices implausible for the strikes of the chain, are discarded
+    '''
+    columns = [c for c in ['bid_undPrice', 'ask_undPrice'] if c in df]
+    prices = pd.to_numeric(df[columns].stack(), errors='coerce') \
+        if columns else pd.Series([])
+    prices = prices[(prices > 0) & (prices < IB_UNSET_INTEGER)]
+    if 'm_strike' in df and len(prices):
+        strike = pd.to_numeric(df['m_strike'], errors='coerce').median()
+        if strike > 0:
+            prices = prices[(prices < strike * MAX_PRICE_TO_STRIKE) &
+                            (prices > strike / MAX_PRICE_TO_STRIKE)]
+    if not len(prices):
+        raise ValueError('The option chain has no underlying price, it must '
+                         'be given')
+    return float(prices.median())
+
+
+def prepare_chain(df, s, r, date):
+    '''
+    Returns the quoted contracts of an option chain (both bid and ask above
+    zero) with their midprice, time to expiration (t), implied volatility
+    (sigma, solving the missing ones) and Black-Scholes greeks
+    '''
+    df = df.copy()
+    for column in ['bid', 'ask', 'm_strike']:
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+    df = df[(df['bid'] > 0) & (df['ask'] > 0)]
+    df = iv_solver.fill_missing_iv(df, s, r, date)
+    df['mid'] = (df['bid'] + df['ask']) / 2.
+    df['sigma'] = df[['bid_impliedVolatility', 'ask_impliedVolatility']].mean(
+        axis=1).fillna(df['mid_iv'])
+    expiries = pd.to_datetime(df['m_expiry'].astype(str), format='%Y%m%d')
+    df['t'] = (expiries - date).dt.days.values / 365.
+    df = df[(df['t'] > 0) & (df['sigma'] > 0)]
+    res = bs_engine.greeks(np.asarray(df['m_right'], dtype=str), s,
+                           df['m_strike'].values, df['t'].values, r,
+                           df['sigma'].values)
+    for greek in ['delta', 'gamma', 'theta', 'vega']:
+        df[greek] = res[greek]
+    return df
+
+
+def calendar_candidates(df):
+    '''
+    Returns a DataFrame with a row per calendar spread candidate: every pair
+    of expiries with a contract of the same right and strike. It holds the
+    natural debit (buying the next-term option at the ask and selling the
+    near-term one at the bid), the mid debit and the leg columns suffixed
+    with _near and _next
+    '''
+    legs = df.set_index(['m_right', 'm_strike', 'm_expiry'])[
+        ['bid', 'ask', 'mid', 'sigma', 't', 'delta', 'gamma', 'theta',
+         'vega']]
+    legs = legs[~legs.index.duplicated()]
+    candidates = []
+    for right, group in df.groupby('m_right'):
+        natural = DebitMatrix.from_chain(group, 'bid', 'ask')
+        pairs = natural.to_frame()
+        pairs['mid_debit'] = DebitMatrix.from_chain(group).at(
+            pairs['strike'].values, pairs['near_expiry'].values,
+            pairs['next_expiry'].values)
+        pairs.insert(0, 'right', right)
+        candidates.append(pairs)
+    if not candidates:
+        return pd.DataFrame(columns=['right', 'strike', 'near_expiry',
+                                     'next_expiry', 'debit', 'mid_debit'])
+    pairs = pd.concat(candidates, ignore_index=True)
+    # Attach the data of both legs with indexed lookups
+    for leg in ['near', 'next']:
+        values = legs.reindex(pd.MultiIndex.from_arrays(
+            [pairs['right'], pairs['strike'], pairs[leg + '_expiry']]))
+        for column in values.columns:
+            pairs[column + '_' + leg] = values[column].values
+    return pairs
+
+
+def _evaluate(flag, k, t_near, t_next, sigma_next, debit, s, r, sigma):
+    '''
+    Values a chunk of calendars at the near-term expiration and returns a
+    dict of arrays with their breakevens, probability of profit, expected
+    value and max profit/loss. Inputs are arrays with a value per calendar
+    '''
+    z = np.linspace(-GRID_STDDEVS, GRID_STDDEVS, GRID_POINTS)
+    mu, sd = pop_engine.lognormal_params(s, r, sigma, t_near)
+    x = np.exp(mu[:, np.newaxis] + sd[:, np.newaxis] * z)  # candidates x grid
+
+    # Next-term option value minus the near-term intrinsic value
+    col = np.newaxis
+    call = bs_engine.is_call(flag)[:, col]
+    intrinsic = np.where(call, np.maximum(x - k[:, col], 0.),
+                         np.maximum(k[:, col] - x, 0.))
+    y = (bs_engine.black_scholes(flag[:, col], x, k[:, col],
+                                 (t_next - t_near)[:, col], r,
+                                 sigma_next[:, col]) -
+         intrinsic - debit[:, col])
+
+    # Breakevens, interpolating the P/L linearly between grid points
+    y0, y1 = y[:, :-1], y[:, 1:]
+    crossing = np.sign(y0) != np.sign(y1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = np.where(crossing, x[:, :-1] + y0 / (y0 - y1) *
+                           (x[:, 1:] - x[:, :-1]), np.nan)
+    statistics = pop_engine.expiry_statistics(x, y, s, r, sigma, t_near)
+    n_breakevens = crossing.sum(axis=1)
+    has_be = n_breakevens > 0
+    be_low = np.where(has_be, np.where(crossing, x_cross, np.inf).min(axis=1),
+                      np.nan)
+    be_high = np.where(has_be,
+                       np.where(crossing, x_cross, -np.inf).max(axis=1),
+                       np.nan)
+    return {'be_low': be_low, 'be_high': be_high,
+            'n_breakevens': n_breakevens, 'pop': statistics['pop'],
+            'expected_value': statistics['expected_value'],
+            'max_profit': y.max(axis=1),
+            'max_loss': y.min(axis=1)}
+
+
+def scan_calendars(df, s, r, date=None, rights=('C', 'P'), iv=None,
+                   rank_by='expected_value', ticker=None):
+    '''
+    Returns a DataFrame with every long calendar spread of the given option
+    chain (one short near-term option and one long next-term option of the
+    same strike and right), ranked by the given column. Prices, breakevens
+    and P/L figures are per share (multiply by the contract multiplier to get
+    the value per spread); greeks are the net greeks of the spread
+    inputs:
+        df -> option chain DataFrame, as loaded from the chain store
+        s -> underlying price
+        r -> interest rate on a 3-month U.S. Treasury bill or similar
+        date -> [Optional] date of the chain snapshot (default today)
+        rights -> rights to be scanned
+        iv -> [Optional] underlying implied volatility used for the price
+            distribution. By default, the IV of each near-term option is used
+        rank_by -> column the candidates are sorted by (descending)
+        ticker -> [Optional] ticker of the chain (default the m_symbol
+            column, which chains stored by sheet may lack)
+    '''
+    if ticker is None and 'm_symbol' in df and len(df):
+        ticker = df['m_symbol'].iloc[0]
+    date = date if date else datetime.today()
+    date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    df = df[df['m_right'].isin([right.upper() for right in rights])]
+    pairs = calendar_candidates(prepare_chain(df, s, r, date))
+    pairs = pairs[pairs['debit'] > 0].reset_index(drop=True)
+
+    results = {}
+    for start in range(0, len(pairs), CHUNK_SIZE):
+        chunk = pairs.iloc[start:start + CHUNK_SIZE]
+        sigma = (np.full(len(chunk), float(iv)) if iv else
+                 chunk['sigma_near'].values)
+        values = _evaluate(
+            np.asarray(chunk['right'], dtype=str), chunk['strike'].values,
+            chunk['t_near'].values, chunk['t_next'].values,
+            chunk['sigma_next'].values, chunk['debit'].values, s, r, sigma)
+        for name, value in values.items():
+            results.setdefault(name, []).append(value)
+
+    scan = pd.DataFrame({
+        'ticker': ticker,
+        'right': pairs['right'], 'strike': pairs['strike'],
+        'near_expiry': pairs['near_expiry'],
+        'next_expiry': pairs['next_expiry'],
+        'debit': pairs['debit'], 'mid_debit': pairs['mid_debit']})
+    for greek in ['delta', 'gamma', 'theta', 'vega']:
+        scan[greek] = pairs[greek + '_next'] - pairs[greek + '_near']
+    for name in ['be_low', 'be_high', 'n_breakevens', 'pop',
+                 'expected_value', 'max_profit', 'max_loss']:
+        scan[name] = (np.concatenate(results[name]) if name in results
+                      else np.array([]))
+    scan['return_on_risk'] = scan['max_profit'] / scan['debit']
+    return scan[SCAN_COLUMNS].sort_values(
+        rank_by, ascending=False).reset_index(drop=True)
+
+
+def _scan_ticker(job):
+    '''
+    Loads the chain of a ticker and scans it (process pool worker)
+    '''
+    source, ticker, s, r, date, rights, iv, rank_by = job
+    chain_source = open_chain_source(source)
+    if date is None:
+        # Time to expiration must be counted from the snapshot date
+        snapshot = chain_source.snapshots(ticker)[-1]
+        df = chain_source.load(ticker, snapshot)
+        date = datetime.strptime(snapshot, '%Y%m%d')
+    else:
+        df = chain_source.load(
+            ticker, date.strftime('%Y%m%d') if date else None)
+    s = s if s else underlying_price(df)
+    logging.info('Scanning ' + ticker + ' calendars (' + str(len(df)) +
+                 ' contracts, underlying at ' + str(s) + ')')
+    return scan_calendars(df, s, r, date, rights, iv, rank_by, ticker)
+
+
+def scan_tickers(source, tickers, r, date=None, rights=('C', 'P'),
+                 underlying_prices=None, iv=None, rank_by='expected_value',
+                 processes=None):
+    '''
+    Scans the calendars of several tickers, one ticker per process when
+    processes > 1, and returns them ranked in a single DataFrame
+    inputs:
+        source -> excel file or chain store directory
+        tickers -> list of tickers to be scanned
+        underlying_prices -> [Optional] dict of {ticker: underlying price}.
+            By default, the price quoted along with the chain is used
+        processes -> [Optional] number of worker processes
+        Other inputs as in scan_calendars
+    '''
+    underlying_prices = underlying_prices if underlying_prices else {}
+    jobs = [(source, t, underlying_prices.get(t), r, date, rights, iv,
+             rank_by) for t in tickers]
+    if processes and processes > 1:
+        pool = Pool(processes)
+        scans = pool.map(_scan_ticker, jobs)
+        pool.close()
+        pool.join()
+    else:
+        scans = [_scan_ticker(job) for job in jobs]
+    return pd.concat(scans, ignore_index=True).sort_values(
+        rank_by, ascending=False).reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    # Configure the command line options
+    parser = ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, required=True,
+                        help=('[Required] Uses an excel file (.xlsx) or a '
+                              'chain store directory as input'))
+    parser.add_argument('-t', '--tickers', nargs='+',
+                        help='Tickers to be scanned (default all)')
+    parser.add_argument('-r', '--rights', nargs='+', default=['C', 'P'],
+                        help='\'C\' for calls, \'P\' for puts (default both)')
+    parser.add_argument('-c', '--current_price', type=float,
+                        help='Current underlying price (single ticker)')
+    parser.add_argument('-v', '--iv', type=float,
+                        help='Current underlying IV, as a decimal')
+    parser.add_argument('-d', '--date', type=str, help=('Snapshot date. Use '
+                        'format YYYYMMDD (default latest)'))
+    parser.add_argument('-k', '--rank_by', type=str,
+                        default='expected_value',
+                        help='Column used to rank the calendars')
+    parser.add_argument('-n', '--top', type=int, default=20,
+                        help='Number of calendars to be shown')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='Number of worker processes')
+    parser.add_argument('-o', '--output', type=str,
+                        help='Stores the ranked calendars in a CSV file')
+    parser.add_argument('--risk_free_rate', type=float, default=0.01,
+                        help='Risk free interest rate (default 0.01)')
+    args = parser.parse_args()
+
+    tickers = (args.tickers if args.tickers
+               else open_chain_source(args.input).tickers())
+    prices = ({tickers[0]: args.current_price}
+              if args.current_price and len(tickers) == 1 else None)
+    date = datetime.strptime(args.date, '%Y%m%d') if args.date else None
+    scan = scan_tickers(args.input, tickers, args.risk_free_rate, date,
+                        args.rights, prices, args.iv, args.rank_by,
+                        args.processes)
+    if args.output:
+        scan.to_csv(args.output, index=False)
+    print(scan.head(args.top).to_string())
@@ -1,7 +1,5 @@
-import vollib.black_scholes as bs
+import bs_engine
 from strategy import Strategy
-import numpy as np
-from scipy.stats import lognorm
 
 
 class CalendarSpread(Strategy):
@@ -71,40 +69,6 @@ class CalendarSpread(Strategy):
     def __len__(self):
         return self.amount
 
-    def get_profit_probability(self, x_vector, y_vector, iv, s, r, t):
-        '''
-        Returns the probability of obtaining a profit with the strategy with
-        in current scenario under study
-        inputs:
-            x_vector -> vector of underlying prices
-            y_vector -> vector with Black-Scholes results
-            iv -> underlying implied volatility
-            s -> current underlying price
-        '''
-        p_profit = 0
-        # Calculate break-even points
-        zero_crossings = np.where(np.diff(np.sign(y_vector)))[0]
-        breakevens = [x_vector[i] for i in zero_crossings]
-        if len(breakevens) > 2:
-            print 'ERROR: more than 2 zeroes detected'
-        elif len(breakevens) == 0:
-            p_profit = (0.9999 if y_vector[(len(y_vector)/2)] > 0 else 0.0001)
-        else:
-            # Get probability of being below the min breakeven at expiration
-            # REVIEW CDF can't return zero!
-            scale = s * np.exp(r * t)
-            p_below = lognorm.cdf(breakevens[0], iv, scale=scale)
-            # Get probability of being above the max breakeven at expiration
-            p_above = lognorm.sf(breakevens[1], iv, scale=scale)
-            # Get the probability of profit for the calendar
-            p_profit = 1 - p_above - p_below
-            print('Profit prob. with s=' + str(s) + ', iv=' + str(iv) +
-                  ', b/e=' + str(breakevens))
-            print('1 - ' + str(p_below) + ' - ' + str(p_above) + ' = ' +
-                  str(p_profit))  # TODO debugging purposes
-
-        return p_profit
-
     def plot(self, x_vector, date, r, iv):
         '''
         Creates a risk graph for the calendar spread
@@ -113,15 +77,10 @@ class CalendarSpread(Strategy):
                 be calculated
             date -> date to be plotted
             r -> interest rate on a 3-month U.S. Treasury bill or similar
-            iv -> implied volatility of the underlying
+            iv -> implied volatility of the underlying, or a VolSurface to
+                price each leg with its own IV
         returns:
             y -> Black-Scholes solution to given x_vector and parameters
         '''
-        y = np.zeros(len(x_vector))
-        # Create the discrete values of P/L to plot against xrange
-        for opt in self.options_list:
-            t = (opt.expiration - date).days / 365.
-            y += np.array([opt.multiplier * opt.amount * (bs.black_scholes(
-                opt.right, x, opt.strike, t, r, iv) -
-                opt.get_debit()) for x in x_vector])
-        return y
+        return bs_engine.risk_graph(
+            self.options_list, x_vector, [date], r, iv)[0]
@@ -0,0 +1,147 @@
+'''
+Typed columnar buffers where IB_API stores the option chains as ticks
+arrive. Every field is a preallocated NumPy column and every contract owns a
+row, so ticks are written as float64 values in place and the chain is
+exported as a DataFrame without converting strings.
+'''
+import numpy as np
+import pandas as pd
+
+# IB sends Double.MAX_VALUE for values it could not compute
+IB_UNSET_DOUBLE = 1.7976931348623157e308
+# and Integer.MAX_VALUE in older files (e.g. unset underlying prices)
+IB_UNSET_INTEGER = 2 ** 31 - 1
+
+# Contract details columns and their types
+CONTRACT_COLUMNS = [
+    ('m_conId', np.int64), ('m_symbol', object), ('m_expiry', np.int64),
+    ('m_strike', np.float64), ('m_right', object),
+    ('m_multiplier', np.float64), ('m_currency', object),
+    ('m_localSymbol', object)]
+
+# Market data columns, filled from tickPrice and tickOptionComputation
+_COMPUTATION_FIELDS = ['delta', 'impliedVolatility', 'optPrice',
+                       'pvDividend', 'gamma', 'vega', 'theta', 'undPrice']
+MARKET_DATA_COLUMNS = (['bid', 'ask', 'close'] +
+                       ['bid_' + f for f in _COMPUTATION_FIELDS] +
+                       ['ask_' + f for f in _COMPUTATION_FIELDS] + ['iv'])
+
+
+class ChainBuffer(object):
+    '''
+    Preallocated columnar buffer holding the option chain of one underlying
+    '''
+
+    def __init__(self, ticker, capacity=256):
+        self.ticker = ticker
+        self.size = 0
+        self.rows = {}  # contract id (local symbol) -> row
+        self.columns = {}
+        for name, dtype in CONTRACT_COLUMNS:
+            self.columns[name] = np.zeros(capacity, dtype=dtype)
+        for name in MARKET_DATA_COLUMNS:
+            self.columns[name] = np.full(capacity, np.nan)
+
+    @classmethod
+    def from_dataframe(cls, ticker, df):
+        '''
+        Constructor from an option chain DataFrame exported by to_dataframe
+        '''
+        buf = cls(ticker, capacity=max(len(df), 1))
+        for contract_id in df.index:
+            buf.row(contract_id)
+        for name, column in buf.columns.items():
+            if name in df.columns and name != 'm_localSymbol':
+                column[:len(df)] = df[name].values
+        return buf
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, contract_id):
+        return contract_id in self.rows
+
+    def keys(self):
+        return self.rows.keys()
+
+    def _grow(self):
+        '''
+        Doubles the capacity of every column
+        '''
+        for name, column in self.columns.items():
+            extra = (np.full(len(column), np.nan)
+                     if name in MARKET_DATA_COLUMNS else
+                     np.zeros(len(column), dtype=column.dtype))
+            self.columns[name] = np.concatenate([column, extra])
+
+    def row(self, contract_id):
+        '''
+        Returns the row of the given contract, allocating it if needed
+        '''
+        row = self.rows.get(contract_id)
+        if row is None:
+            if self.size == len(self.columns['m_conId']):
+                self._grow()
+            row = self.rows[contract_id] = self.size
+            self.columns['m_localSymbol'][row] = contract_id
+            self.size += 1
+        return row
+
+    def add_contract(self, contract):
+        '''
+        Stores the contract details of an option
+        contract -> IB Contract object
+        '''
+        row = self.row(contract.m_localSymbol)
+        self.columns['m_conId'][row] = contract.m_conId
+        self.columns['m_symbol'][row] = contract.m_symbol
+        self.columns['m_expiry'][row] = int(contract.m_expiry)
+        self.columns['m_strike'][row] = contract.m_strike
+        self.columns['m_right'][row] = contract.m_right
+        self.columns['m_multiplier'][row] = float(contract.m_multiplier)
+        self.columns['m_currency'][row] = contract.m_currency
+        return row
+
+    def set(self, contract_id, field, value):
+        '''
+        Writes a market data value for the given contract
+        '''
+        value = float(value)
+        self.columns[field][self.row(contract_id)] = (
+            np.nan if value == IB_UNSET_DOUBLE else value)
+
+    def get(self, contract_id, field):
+        '''
+        Returns a stored value of the given contract
+        '''
+        return self.columns[field][self.rows[contract_id]]
+
+    def quote(self, contract_id):
+        '''
+        Returns a dict with the market data of the given contract
+        '''
+        row = self.row(contract_id)
+        return dict((name, float(self.columns[name][row]))
+                    for name in MARKET_DATA_COLUMNS)
+
+    def to_dataframe(self):
+        '''
+        Returns the option chain as a DataFrame indexed by contract id. The
+        DataFrame is built with copy=False, so pandas versions which do not
+        consolidate blocks keep its columns as views on the buffer
+        '''
+        names = [c[0] for c in CONTRACT_COLUMNS] + MARKET_DATA_COLUMNS
+        return pd.DataFrame(
+            {name: self.columns[name][:self.size] for name in names},
+            index=pd.Index(self.columns['m_localSymbol'][:self.size]),
+            columns=names, copy=False)
+
+
+class ChainBufferDict(dict):
+    '''
+    Dictionary of {ticker: ChainBuffer} which creates buffers on demand
+    '''
+
+    def __missing__(self, key):
+        value = self[key] = ChainBuffer(key)
+        return value
@@ -0,0 +1,117 @@
+'''
+Selection of the option contracts worth downloading. A ChainFilter keeps the
+contracts within a moneyness band and/or an absolute delta band around the
+underlying price, up to a maximum number of days to expiration and of the
+given rights, so that market data lines and download time only go to
+contracts the strategies can use. It is applied by IB_API to the contract
+details before their market data is requested; the deltas are estimated with
+Black-Scholes at the implied volatility of the underlying, since no option
+has been quoted yet.
+'''
+from datetime import datetime
+import numpy as np
+import bs_engine
+from option import parse_expirations
+
+
+class ChainFilter(object):
+    '''
+    Filter of option contracts by moneyness, delta, expiry and right
+    '''
+
+    def __init__(self, moneyness=None, delta=None, max_dte=None, rights=None,
+                 r=0.01):
+        '''
+        moneyness -> [Optional] (low, high) bounds of strike / underlying
+            price, e.g. (0.8, 1.2)
+        delta -> [Optional] (low, high) bounds of the absolute delta, e.g.
+            (0.05, 0.95)
+        max_dte -> [Optional] maximum days to expiration
+        rights -> [Optional] rights to be kept, e.g. ['C'] (default both)
+        r -> interest rate used to estimate the deltas
+        '''
+        self.moneyness = moneyness
+        self.delta = delta
+        self.max_dte = max_dte
+        self.rights = (set(right.upper() for right in rights) if rights
+                       else None)
+        self.r = r
+
+    @classmethod
+    def parse(cls, spec, r=0.01):
+        '''
+        Constructor from a command line spec: comma separated key=value
+        items, with bands given as low:high. E.g.
+        'moneyness=0.8:1.2,delta=0.05:0.95,dte=60,rights=CP'
+        '''
+        kwargs = {}
+        for item in spec.split(','):
+            key, _, value = item.partition('=')
+            key = key.strip().lower()
+            if key in ('moneyness', 'delta'):
+                low, _, high = value.partition(':')
+                kwargs[key] = (float(low), float(high))
+            elif key == 'dte':
+                kwargs['max_dte'] = int(value)
+            elif key == 'rights':
+                kwargs['rights'] = list(value.strip())
+            else:
+                raise ValueError('Unknown chain filter key: ' + str(key))
+        return cls(r=r, **kwargs)
+
+    def needs_price(self):
+        '''
+        Returns True if the underlying price is needed to apply the filter
+        '''
+        return self.moneyness is not None or self.delta is not None
+
+    def needs_iv(self):
+        '''
+        Returns True if the underlying IV is needed to apply the filter
+        '''
+        return self.delta is not None
+
+    def mask(self, strikes, expirations, rights, s=None, iv=None,
+             date=None):
+        '''
+        Returns a boolean array which is True for the contracts to be kept.
+        The moneyness and delta bands are skipped when the underlying price
+        (or IV) is not given
+        inputs:
+            strikes -> array of strike prices
+            expirations -> list of expiration datetimes
+            rights -> array of 'C'/'P' rights
+            s -> [Optional] underlying price
+            iv -> [Optional] implied volatility of the underlying
+            date -> [Optional] date of the download (default today)
+        '''
+        date = date if date else datetime.today()
+        date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+        strikes = np.asarray(strikes, dtype=float)
+        rights = np.char.upper(np.asarray(rights, dtype=str))
+        keep = np.ones(len(strikes), dtype=bool)
+        days = np.array([(e - date).days for e in expirations], dtype=int)
+        if self.max_dte is not None:
+            keep &= days <= self.max_dte
+        if self.rights is not None:
+            keep &= np.in1d(rights, list(self.rights))
+        if self.moneyness is not None and s:
+            keep &= ((strikes >= self.moneyness[0] * s) &
+                     (strikes <= self.moneyness[1] * s))
+        if self.delta is not None and s and iv:
+            delta = np.abs(bs_engine.greeks(
+                rights, s, strikes, np.maximum(days, 0) / 365., self.r,
+                iv)['delta'])
+            keep &= (delta >= self.delta[0]) & (delta <= self.delta[1])
+        return keep
+
+    def apply(self, contracts, s=None, iv=None, date=None):
+        '''
+        Returns the IB option Contracts to be kept. Other inputs as in mask
+        '''
+        if not contracts:
+            return []
+        keep = self.mask([c.m_strike for c in contracts],
+                         parse_expirations([c.m_expiry for c in contracts]),
+                         [c.m_right for c in contracts], s, iv, date)
+        return [c for c, k in zip(contracts, keep) if k]
@@ -0,0 +1,79 @@
+'''
+Index of an option chain by (expiry, strike, right). It is built once per
+chain, so strategy builders get the contracts they need with dictionary
+lookups instead of masking the whole DataFrame for every option, and build
+the options (or legs) of a strategy in bulk.
+'''
+from leg_array import LegArray
+from option import Option
+
+
+class ChainIndex(object):
+    '''
+    Maps the (expiry, strike, right) of every contract of an option chain to
+    its row
+    '''
+
+    def __init__(self, df):
+        '''
+        df -> option chain DataFrame (m_expiry, m_strike and m_right columns)
+        '''
+        self.df = df
+        self.rows = {}
+        keys = zip(df['m_expiry'].tolist(), df['m_strike'].tolist(),
+                   df['m_right'].tolist())
+        for row, key in enumerate(keys):
+            # The first quote of a duplicated contract is kept
+            self.rows.setdefault(self._key(*key), row)
+        self._legs = None
+
+    @staticmethod
+    def _key(expiry, strike, right):
+        return int(expiry), float(strike), right.upper()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, key):
+        return self._key(*key) in self.rows
+
+    def row(self, expiry, strike, right):
+        '''
+        Returns the position in the chain of the given contract
+        inputs:
+            expiry -> expiry as YYYYMMDD (integer or string)
+            strike -> strike price
+            right -> 'C' for calls, 'P' for puts (any case)
+        '''
+        key = self._key(expiry, strike, right)
+        if key not in self.rows:
+            raise KeyError('Contract not available in the option chain: ' +
+                           str(key))
+        return self.rows[key]
+
+    def option(self, expiry, strike, right, amount=1):
+        '''
+        Returns an Option of the given contract. Inputs as in row
+        '''
+        return Option.from_chain(
+            self.df.iloc[[self.row(expiry, strike, right)]], amount)[0]
+
+    def options(self, contracts, amounts=1):
+        '''
+        Returns a list of Options, built in bulk
+        inputs:
+            contracts -> list of (expiry, strike, right) tuples
+            amounts -> amount of every option (scalar or a sequence)
+        '''
+        return Option.from_chain(
+            self.df.iloc[[self.row(*c) for c in contracts]], amounts)
+
+    def legs(self, contracts, amounts=1):
+        '''
+        Returns a LegArray with the given contracts. Inputs as in options.
+        The legs of the whole chain are converted once, on the first call
+        '''
+        if self._legs is None:
+            self._legs = LegArray.from_chain(self.df)
+        return self._legs[[self.row(*c) for c in contracts]].with_amounts(
+            amounts)
@@ -0,0 +1,206 @@
+'''
+Columnar on-disk storage for option chains. Chains are stored as Parquet
+files partitioned by ticker and snapshot date:
+
+    <root>/<TICKER>/<YYYYMMDD>.parquet
+
+Each file holds one row group per expiry, so loaders can read only the
+columns and the expiries they ask for instead of parsing a whole Excel
+workbook. Run this module as a script to convert existing Excel files.
+'''
+from argparse import ArgumentParser
+from datetime import datetime
+import logging
+import os
+import pandas as pd
+
+# Columns which are kept as text; everything else is stored as numbers
+TEXT_COLUMNS = ['m_symbol', 'm_right', 'm_currency', 'm_localSymbol']
+
+
+def is_excel(path):
+    '''
+    Returns True if given path refers to an Excel file rather than to a
+    chain store directory
+    '''
+    return os.path.splitext(path)[1].lower() in ['.xls', '.xlsx']
+
+
+def excel_snapshot(path):
+    '''
+    Returns the snapshot date (YYYYMMDD) of an Excel option chain file, taken
+    from its file name prefix (ddmmyy_*.xlsx) or from its modification time
+    '''
+    try:
+        date = datetime.strptime(os.path.basename(path).split('_')[0],
+                                 '%d%m%y')
+    except ValueError:
+        date = datetime.fromtimestamp(os.path.getmtime(path))
+    return date.strftime('%Y%m%d')
+
+
+def _normalize(df):
+    '''
+    Returns a copy of the option chain ready to be stored: text columns as
+    strings, any other column as numbers and rows sorted by expiry and strike
+    '''
+    df = df.drop([c for c in df.columns if str(c).startswith('Unnamed')],
+                 axis=1)
+    for column in df.columns:
+        if column in TEXT_COLUMNS:
+            df[column] = df[column].astype(str)
+        elif df[column].dtype == object:
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+    return df.sort_values(['m_expiry', 'm_strike']).reset_index(drop=True)
+
+
+class ChainStore(object):
+    '''
+    Option chains store partitioned by ticker and snapshot date
+    '''
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, ticker, date):
+        return os.path.join(self.root, ticker, date + '.parquet')
+
+    def tickers(self):
+        '''
+        Returns the list of tickers available at the store
+        '''
+        if not os.path.isdir(self.root):
+            return []
+        return sorted(t for t in os.listdir(self.root)
+                      if os.path.isdir(os.path.join(self.root, t)))
+
+    def snapshots(self, ticker):
+        '''
+        Returns the sorted list of snapshot dates (YYYYMMDD) stored for the
+        given ticker
+        '''
+        folder = os.path.join(self.root, ticker)
+        if not os.path.isdir(folder):
+            return []
+        return sorted(os.path.splitext(f)[0] for f in os.listdir(folder)
+                      if f.endswith('.parquet'))
+
+    def save(self, opt_chains, date=None):
+        '''
+        Stores the given option chains as a new snapshot
+        opt_chains -> dictionary of {ticker: dataframe}
+        date -> [Optional] snapshot date as YYYYMMDD (default today)
+        '''
+        # pyarrow is only needed by the store, not to read Excel files
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        date = date if date else datetime.today().strftime('%Y%m%d')
+        for ticker in opt_chains.keys():
+            df = _normalize(opt_chains[ticker])
+            path = self._path(ticker, date)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            # Write one row group per expiry so that readers can skip them
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            writer = pq.ParquetWriter(path, table.schema)
+            for _, group in df.groupby('m_expiry', sort=True):
+                writer.write_table(pa.Table.from_pandas(
+                    group, schema=table.schema, preserve_index=False))
+            writer.close()
+            logging.info('Stored ' + str(len(df)) + ' ' + ticker +
+                         ' contracts at ' + path)
+
+    def load(self, ticker, date=None, columns=None, expiries=None):
+        '''
+        Loads an option chain snapshot from the store
+        ticker -> ticker whose option chain is requested
+        date -> [Optional] snapshot date as YYYYMMDD (default latest one)
+        columns -> [Optional] list of columns to be read (default all)
+        expiries -> [Optional] list of expiries (as YYYYMMDD) to be read
+            (default all)
+        '''
+        import pyarrow.parquet as pq
+        if not date:
+            snapshots = self.snapshots(ticker)
+            if not snapshots:
+                raise ValueError('No snapshots stored for ' + str(ticker))
+            date = snapshots[-1]
+        filters = None
+        if expiries is not None:
+            filters = [('m_expiry', 'in', [int(e) for e in expiries])]
+        return pq.read_table(self._path(ticker, date), columns=columns,
+                             filters=filters).to_pandas()
+
+    def expiries(self, ticker, date=None):
+        '''
+        Returns the sorted list of expiries of a stored option chain
+        '''
+        df = self.load(ticker, date, columns=['m_expiry'])
+        return sorted(df['m_expiry'].unique())
+
+
+class ExcelChainSource(object):
+    '''
+    Read-only access to an Excel file with an option chain per sheet, with
+    the same interface as ChainStore
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.excel_file = pd.ExcelFile(path)
+
+    def tickers(self):
+        return self.excel_file.sheet_names
+
+    def snapshots(self, ticker):
+        '''
+        Returns the only snapshot date (YYYYMMDD) of the file, see
+        excel_snapshot
+        '''
+        return [excel_snapshot(self.path)]
+
+    def load(self, ticker, date=None, columns=None, expiries=None):
+        df = self.excel_file.parse(ticker)
+        if expiries is not None:
+            df = df[df['m_expiry'].isin([int(e) for e in expiries])]
+        return df[columns] if columns else df
+
+
+def open_chain_source(path):
+    '''
+    Returns a ChainStore or an ExcelChainSource depending on the given path
+    '''
+    return ExcelChainSource(path) if is_excel(path) else ChainStore(path)
+
+
+def convert_excel(input_file, store, date=None):
+    '''
+    Copies every sheet (ticker) of an Excel option chain file into the store
+    input_file -> Excel file as written by main.py
+    store -> destination ChainStore
+    date -> [Optional] snapshot date as YYYYMMDD. If not given, it is taken
+        from the file name prefix (ddmmyy_*.xlsx) or from its modification
+        time
+    '''
+    date = date if date else excel_snapshot(input_file)
+    excel_file = pd.ExcelFile(input_file)
+    store.save({t: excel_file.parse(t) for t in excel_file.sheet_names},
+               date)
+    return date
+
+
+if __name__ == '__main__':
+    # Configure the command line options
+    parser = ArgumentParser()
+    parser.add_argument('-i', '--input', nargs='+', required=True,
+                        help='[Required] Excel files to be converted')
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='[Required] Chain store directory')
+    parser.add_argument('-d', '--date', type=str, help=('Snapshot date. Use '
+                        'format YYYYMMDD'))
+    args = parser.parse_args()
+
+    chain_store = ChainStore(args.output)
+    for excel in args.input:
+        snapshot = convert_excel(excel, chain_store, args.date)
+        print('Converted ' + excel + ' (' + snapshot + ')')
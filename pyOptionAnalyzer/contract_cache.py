@@ -0,0 +1,132 @@
+'''
+Persistent cache of the option contracts of every ticker, as received from
+IB contract details. Listed expiries and strikes barely change from one day
+to the next, so IB_API requests the market data of the cached contracts
+right away instead of waiting for the contract details round trip. Cached
+tickers older than the TTL are refreshed in the background: their contract
+details are requested too, and only the contracts which were not cached get
+their market data requested (delta refresh). Contracts are stored per
+ticker and expiry, and expired ones are dropped.
+'''
+from datetime import datetime
+from time import time
+import json
+import logging
+import os
+from ib.ext.Contract import Contract
+
+# Default seconds a ticker is served from the cache without refreshing it
+DEFAULT_TTL = 3 * 24 * 3600
+# Contract fields stored, enough to request market data
+CONTRACT_FIELDS = ('m_conId', 'm_symbol', 'm_secType', 'm_expiry',
+                   'm_strike', 'm_right', 'm_multiplier', 'm_exchange',
+                   'm_currency', 'm_localSymbol', 'm_tradingClass')
+
+
+class ContractCache(object):
+    '''
+    Option contracts of several tickers, stored as a JSON file per ticker
+    '''
+
+    def __init__(self, directory, ttl=DEFAULT_TTL):
+        '''
+        directory -> directory where the cache files are stored
+        ttl -> seconds after which the contracts of a ticker are refreshed
+        '''
+        self.directory = directory
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _file(self, ticker):
+        return os.path.join(self.directory, ticker + '.json')
+
+    def _read(self, ticker):
+        '''
+        Returns the stored dict of a ticker, with the time it was updated
+        and its contracts by expiry, or None if it is not cached
+        '''
+        path = self._file(ticker)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except Exception, e:
+            logging.error('Could not read ' + ticker + ' cached contracts: ' +
+                          str(e))
+            return None
+
+    def get(self, ticker, expiry=None):
+        '''
+        Returns a tuple (contracts, fresh) with the list of cached IB
+        Contracts of a ticker which have not expired, and whether they were
+        updated within the TTL. A ticker without live contracts is a miss
+        inputs:
+            ticker -> underlying ticker
+            expiry -> [Optional] only the contracts of this expiry (YYYYMMDD)
+        '''
+        stored = self._read(ticker)
+        if stored is None:
+            self.misses += 1
+            return [], False
+        today = datetime.today().strftime('%Y%m%d')
+        contracts = []
+        for exp, fields_list in sorted(stored['expiries'].items()):
+            if exp < today or (expiry and exp != str(expiry)):
+                continue
+            for fields in fields_list:
+                contract = Contract()
+                for name, value in fields.items():
+                    # JSON strings are read as unicode
+                    if isinstance(value, basestring):
+                        value = str(value)
+                    setattr(contract, str(name), value)
+                contracts.append(contract)
+        if not contracts:
+            self.misses += 1
+            return [], False
+        self.hits += 1
+        return contracts, time() - stored['updated'] < self.ttl
+
+    def update(self, ticker, contracts):
+        '''
+        Replaces the cached contracts of a ticker with the ones received from
+        the contract details. Returns a tuple with the number of contracts
+        added and removed
+        '''
+        stored = self._read(ticker)
+        old = set()
+        if stored is not None:
+            old = set(fields['m_conId'] for fields_list in
+                      stored['expiries'].values() for fields in fields_list)
+        expiries = {}
+        for contract in contracts:
+            expiries.setdefault(str(contract.m_expiry), []).append(
+                dict((name, getattr(contract, name))
+                     for name in CONTRACT_FIELDS))
+        new = set(contract.m_conId for contract in contracts)
+        # Write and rename, so a crash never leaves a truncated file
+        path = self._file(ticker)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'ticker': ticker, 'updated': time(),
+                       'expiries': expiries}, f)
+        os.rename(path + '.tmp', path)
+        added, removed = len(new - old), len(old - new)
+        logging.info('Cached ' + str(len(new)) + ' ' + ticker +
+                     ' contracts (' + str(added) + ' added, ' +
+                     str(removed) + ' removed)')
+        return added, removed
+
+    def clear(self, ticker=None):
+        '''
+        Removes the cached contracts of a ticker (default all)
+        '''
+        tickers = ([ticker] if ticker else
+                   [f[:-5] for f in os.listdir(self.directory)
+                    if f.endswith('.json')])
+        for t in tickers:
+            if os.path.isfile(self._file(t)):
+                os.remove(self._file(t))
@@ -0,0 +1,97 @@
+'''
+Term-structure debit matrix of calendar spreads. The option prices of a
+chain are aligned once in a (strike x expiry) table, and the debit of every
+calendar spread follows from broadcasting it as a (strike x near x next)
+array, instead of looking up both legs of each strike separately.
+'''
+import numpy as np
+import pandas as pd
+
+
+class DebitMatrix(object):
+    '''
+    Debits of the calendar spreads of an option chain of a single right:
+    values[k, i, j] is the debit of buying the option of strike strikes[k]
+    and expiry expiries[j] while selling the one of expiry expiries[i]. It
+    is NaN where any leg is missing and where expiries[j] <= expiries[i]
+    '''
+
+    def __init__(self, strikes, expiries, near_prices, next_prices):
+        '''
+        strikes -> sorted array of strikes
+        expiries -> sorted array of expiries (as YYYYMMDD integers)
+        near_prices -> (strike x expiry) prices of the sold options
+        next_prices -> (strike x expiry) prices of the bought options
+        '''
+        self.strikes = np.asarray(strikes, dtype=float)
+        self.expiries = np.asarray(expiries)
+        near_prices = np.asarray(near_prices, dtype=float)
+        next_prices = np.asarray(next_prices, dtype=float)
+        self.values = (next_prices[:, np.newaxis, :] -
+                       near_prices[:, :, np.newaxis])
+        later = np.triu(np.ones((len(expiries), len(expiries)), dtype=bool),
+                        k=1)
+        self.values[:, ~later] = np.nan
+
+    @classmethod
+    def from_chain(cls, df, near_price='mid', next_price='mid'):
+        '''
+        Constructor from an option chain DataFrame with a single right
+        near_price -> column with the price of the sold options (e.g. 'bid')
+        next_price -> column with the price of the bought options (e.g.
+            'ask')
+        '''
+        if df['m_right'].nunique() > 1:
+            raise ValueError('The option chain must contain a single right')
+        near = df.pivot_table(index='m_strike', columns='m_expiry',
+                              values=near_price, aggfunc='first')
+        next_ = df.pivot_table(index='m_strike', columns='m_expiry',
+                               values=next_price, aggfunc='first')
+        next_ = next_.reindex(index=near.index, columns=near.columns)
+        return cls(near.index.values, near.columns.values, near.values,
+                   next_.values)
+
+    def __len__(self):
+        return int(np.count_nonzero(~np.isnan(self.values)))
+
+    def _positions(self, strikes, near_expiries, next_expiries):
+        '''
+        Returns the array indices of the given labels
+        '''
+        return (np.searchsorted(self.strikes, strikes),
+                np.searchsorted(self.expiries, near_expiries),
+                np.searchsorted(self.expiries, next_expiries))
+
+    def at(self, strikes, near_expiries, next_expiries):
+        '''
+        Returns the debits of the given calendars (arrays of labels which
+        must be present in the matrix)
+        '''
+        return self.values[self._positions(strikes, near_expiries,
+                                           next_expiries)]
+
+    def curve(self, near_expiry, next_expiry):
+        '''
+        Returns a Series with the debit per strike of the calendars between
+        two given expiries, dropping strikes missing in any of them
+        '''
+        i, j = np.searchsorted(self.expiries, [near_expiry, next_expiry])
+        if (j >= len(self.expiries) or self.expiries[i] != near_expiry or
+                self.expiries[j] != next_expiry):
+            raise ValueError('Expiries not available in the option chain')
+        return pd.Series(self.values[:, i, j],
+                         index=pd.Index(self.strikes, name='m_strike'),
+                         name='debit').dropna()
+
+    def to_frame(self):
+        '''
+        Returns a DataFrame with a row per available calendar: strike,
+        near_expiry, next_expiry and debit
+        '''
+        k, i, j = np.nonzero(~np.isnan(self.values))
+        return pd.DataFrame({'strike': self.strikes[k],
+                             'near_expiry': self.expiries[i],
+                             'next_expiry': self.expiries[j],
+                             'debit': self.values[k, i, j]},
+                            columns=['strike', 'near_expiry', 'next_expiry',
+                                     'debit'])
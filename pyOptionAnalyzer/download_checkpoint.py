@@ -0,0 +1,143 @@
+'''
+Checkpoints of a chain download, so that a run which dies halfway (IB
+disconnection, error storms) can be resumed. IB_API saves the state of every
+ticker to local disk as its download goes on: the option contracts received,
+the contracts whose snapshot has arrived or was rejected and the chain and
+underlying data. On restart the completed tickers are loaded instead of
+downloaded, and only the contracts with missing or rejected snapshots are
+requested again.
+'''
+from datetime import datetime
+from time import time
+import cPickle as pickle
+import logging
+import os
+import shutil
+from ib.ext.Contract import Contract
+
+# Default seconds between checkpoints of a running ticker
+DEFAULT_INTERVAL = 30.
+
+
+def contract_to_dict(contract):
+    '''
+    Returns the fields of an IB Contract as a dict
+    '''
+    return dict(contract.__dict__)
+
+
+def contract_from_dict(fields):
+    '''
+    Returns an IB Contract with the given fields
+    '''
+    contract = Contract()
+    contract.__dict__.update(fields)
+    return contract
+
+
+class DownloadCheckpoint(object):
+    '''
+    State of the tickers of a download run, stored in a directory per run
+    '''
+
+    def __init__(self, directory, run=None, interval=DEFAULT_INTERVAL):
+        '''
+        directory -> directory where the checkpoints are stored
+        run -> [Optional] name of the run (default today as YYYYMMDD, so a
+            nightly download resumes the checkpoints of the same night only)
+        interval -> minimum seconds between checkpoints of a running ticker
+        '''
+        run = run if run else datetime.today().strftime('%Y%m%d')
+        self.path = os.path.join(directory, run)
+        self.interval = interval
+        self.last_saved = {}  # ticker -> time of its last checkpoint
+        self.resumed = {}  # ticker -> description of what was resumed
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+
+    def _file(self, ticker):
+        return os.path.join(self.path, ticker + '.pkl')
+
+    def due(self, ticker):
+        '''
+        Returns True if the interval since the last checkpoint of a ticker
+        has elapsed
+        '''
+        return time() - self.last_saved.get(ticker, 0) >= self.interval
+
+    def save(self, ticker, contracts, received, chain, underlying,
+             complete=False, failed=()):
+        '''
+        Stores the state of a ticker, replacing its previous checkpoint
+        inputs:
+            ticker -> underlying ticker
+            contracts -> list of the option contracts received (None while
+                the contract details have not arrived)
+            received -> set of contract ids whose snapshot has arrived
+            chain -> option chain DataFrame (ChainBuffer.to_dataframe)
+            underlying -> dict with the underlying data (close, iv...)
+            complete -> True once all the data of the ticker has arrived
+            failed -> contract ids whose snapshot request was rejected
+        '''
+        state = {'ticker': ticker, 'complete': complete,
+                 'contracts': (None if contracts is None else
+                               [contract_to_dict(c) for c in contracts]),
+                 'received': set(received), 'failed': set(failed),
+                 'chain': chain, 'underlying': dict(underlying)}
+        # Write and rename, so a crash never leaves a truncated checkpoint
+        path = self._file(ticker)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+        self.last_saved[ticker] = time()
+
+    def load(self, ticker):
+        '''
+        Returns the stored state of a ticker as a dict (see save, contracts
+        as IB Contract objects), or None if there is no usable checkpoint
+        '''
+        path = self._file(ticker)
+        if not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                state = pickle.load(f)
+        except Exception, e:
+            logging.error('Could not read ' + ticker + ' checkpoint: ' +
+                          str(e))
+            return None
+        state.setdefault('failed', set())
+        if state['contracts'] is not None:
+            state['contracts'] = [contract_from_dict(c)
+                                  for c in state['contracts']]
+        return state
+
+    def record_resume(self, ticker, state, n_missing=None):
+        '''
+        Logs and records what was resumed for a ticker
+        '''
+        if state['complete'] and not state['failed']:
+            msg = 'complete, loaded from checkpoint'
+        else:
+            msg = (str(len(state['received'])) + ' snapshots loaded, ' +
+                   str(n_missing) + ' requested again')
+            if state['failed']:
+                msg += ' (' + str(len(state['failed'])) + ' rejected)'
+        self.resumed[ticker] = msg
+        logging.info('Resuming ' + ticker + ': ' + msg)
+
+    def summary(self):
+        '''
+        Returns a text with what was resumed for every ticker
+        '''
+        if not self.resumed:
+            return 'Nothing resumed from ' + self.path
+        return '\n'.join(['Resumed from ' + self.path + ':'] +
+                         ['  ' + t + ': ' + self.resumed[t]
+                          for t in sorted(self.resumed)])
+
+    def clear(self):
+        '''
+        Removes the checkpoints of the run (once it has been exported)
+        '''
+        shutil.rmtree(self.path, ignore_errors=True)
@@ -2,15 +2,28 @@
 This script will access the IB API and download the option chain for given
 securities
 '''
-from threading import Thread
-from Queue import Queue
+from threading import Event, Lock, RLock, Semaphore, Thread
+from Queue import Empty, Queue
+from collections import deque
 from ib.opt import ibConnection
 from ib.ext.Contract import Contract
-from time import sleep
+from time import time
+from chain_buffer import ChainBuffer, ChainBufferDict
+from ib_scheduler import (IB_MAX_MARKET_DATA_LINES, IB_MAX_MSGS_PER_SEC,
+                          IB_WARNING_CODES, MarketDataLines, RequestError,
+                          RequestFuture, RequestPacer, RequestTimeout,
+                          TickerJob)
+from market_stream import DEFAULT_WINDOW, StreamPublisher
 import pandas as pd
 import logging
 import traceback  # TODO debugging purposes only
 
+# Market data lines never taken by streaming subscriptions, so that snapshot
+# requests still go on while streaming
+SNAPSHOT_LINES = 1
+# Messages which take a market data line
+MARKET_DATA_MSGS = ('reqMktData', 'reqStkHistoricalVol', 'reqStkImpliedVol')
+
 
 class IB_API(Thread):
     '''
@@ -18,9 +31,17 @@ class IB_API(Thread):
     operations
     '''
 
-    def __init__(self, event, port=4001, client_id=0):
+    def __init__(self, event, port=4001, client_id=0,
+                 max_msgs_per_sec=IB_MAX_MSGS_PER_SEC,
+                 max_lines=IB_MAX_MARKET_DATA_LINES, max_tickers=5):
         '''
         Connection to the IB API
+        event -> threading.Event set when all the requested data has arrived
+        port -> TWS/Gateway port
+        client_id -> IB API client id
+        max_msgs_per_sec -> maximum number of messages sent per second
+        max_lines -> maximum number of simultaneous market data requests
+        max_tickers -> maximum number of tickers downloaded concurrently
         '''
         super(IB_API, self).__init__()
         self.event = event
@@ -32,23 +53,57 @@ class IB_API(Thread):
         # Create message queues
         self.input_queue = Queue()
         self.output_queue = Queue()
+        # Cancel messages are sent ahead of the output queue, since they
+        # free the lines its market data requests may be waiting for
+        self.cancel_queue = Queue()
 
         # Connection variables
         self.connection = None
         self.port = port
         self.client_id = client_id
         self.reqId = 1
+        self.reqId_lock = Lock()
         self.status = 'DISCONNECTED'
         self.keep_alive = True
+        # Set once the server accepts or rejects the client id
+        self.connected = Event()
 
         # Dict which relates contract ids with the req id used for retrieval
         self.reqId_ticker = {}
-        self.opt_chain = MultiDict()
+        self.opt_chain = ChainBufferDict()
         self.stk_data = MultiDict()
         self.contracts = []
         self.portfolio_positions = MultiDict()
         self.subscriptions = []
 
+        # Request scheduling: pacing, market data lines and ticker jobs
+        self.pacer = RequestPacer(max_msgs_per_sec)
+        self.lines = MarketDataLines(max_lines)
+        self.max_tickers = max_tickers
+        self.jobs_lock = RLock()
+        self.jobs = {}  # ticker -> running TickerJob
+        self.pending_tickers = deque()
+        self.reqId_job = {}  # market data req id -> TickerJob
+        self.cancel_lock = Lock()
+        self.sent = set()  # market data req ids sent to the server
+        self.cancelled = set()  # req ids cancelled before being sent
+        self.details_reqId = {}  # contract details req id -> contracts
+        self.completed = Queue()  # (ticker, latency) of finished tickers
+        self.latencies = {}
+        self.checkpoint = None  # DownloadCheckpoint of the running download
+        self.contract_cache = None  # ContractCache of the option contracts
+        self.chain_filter = None  # ChainFilter of the contracts downloaded
+        # Futures of single requests by req id. The pending market data
+        # futures are bounded, so callers wait instead of flooding the queue
+        self.futures = {}
+        self.pending_requests = Semaphore(max_lines)
+
+        # Streaming mode: tickers whose subscriptions are kept open and the
+        # publisher of their changes
+        self.stream = None
+        self.streaming = set()
+        self.stream_filter = None
+
         self.thread_exception_msg = None
 
     def run(self):
@@ -71,19 +126,27 @@ class IB_API(Thread):
             self.status = 'CONNECTED'
             # Check input messages
             while(self.keep_alive):
-                while not self.input_queue.empty():
-                    # Extract message from queue and process it
-                    self._process_message(self.input_queue.get())
+                # Extract message from queue and process it, waking up
+                # now and then to check the errors of the other threads
+                try:
+                    self._process_message(self.input_queue.get(timeout=0.5))
+                except Empty:
+                    pass
                 if self.thread_exception_msg:
                     logging.error(self.thread_exception_msg)
                     self.close()
         except Exception, e:
             traceback.print_exc()
             logging.error(str(e))
+            # Wake up the threads waiting for the connection
+            self.keep_alive = False
+            self.connected.set()
             self.stop()
 
     def stop(self):
         self.keep_alive = False
+        if self.stream:
+            self.stream.stop()
         self.disconnect()
         self.sender_thread.__stop = True
         self.__stop = True
@@ -128,13 +191,15 @@ class IB_API(Thread):
             # self._get_account_summary(msg.accountsList, True)
         elif msg.typeName == 'nextValidId':
             logging.info('Next valid order id: ' + str(msg.orderId))
-            self.reqId = msg.orderId
+            with self.reqId_lock:
+                self.reqId = max(self.reqId, msg.orderId)
             if msg.orderId == 1:
                 # Clear contract dicts
                 self.reqId_ticker = {}
-                self.opt_chain = MultiDict()
+                self.opt_chain = ChainBufferDict()
                 self.stk_data = MultiDict()
                 self.contracts = []
+            self.connected.set()
         elif msg.typeName == 'updateAccountTime':
             pass  # TODO UNIMPLEMENTED
         elif msg.typeName == 'updateAccountValue':
@@ -144,6 +209,8 @@ class IB_API(Thread):
         elif msg.typeName == 'contractDetails':
             contract = msg.contractDetails.m_summary
             self.contracts.append(contract)
+            if msg_reqId in self.details_reqId:
+                self.details_reqId[msg_reqId].append(contract)
             # Check security type at received contractDetails message
             if contract.m_secType == 'OPT':
                 # Store list of available options into dict
@@ -155,8 +222,7 @@ class IB_API(Thread):
         elif msg.typeName == 'contractDetailsEnd':
             logging.info('Received contractDetailsEnd for reqId ' +
                          str(msg_reqId))
-            # Request market data snapshots to the server
-            self._get_market_data(snapshot=True)
+            self._contract_details_done(msg_reqId)
         elif msg.typeName == 'tickPrice':
             self._parse_tickPrice(msg)
         elif msg.typeName == 'tickOptionComputation':
@@ -167,7 +233,13 @@ class IB_API(Thread):
             # Remove the req id from the list of requested ids, to be able to
             # determine when all the data has arrived
             if msg_reqId in self.reqId_ticker.keys():
-                del self.reqId_ticker[msg_reqId]
+                contract = self.reqId_ticker.pop(msg_reqId)
+                self._resolve(msg_reqId, self.opt_chain[
+                    contract.m_symbol].quote(contract.m_localSymbol))
+                job = self.reqId_job.get(msg_reqId)
+                if job is not None:
+                    job.received.add(contract.m_localSymbol)
+            self._request_done(msg_reqId)
             # Print info
             logging.info('Received tickSnapshotEnd for reqId ' +
                          str(msg_reqId) + '. Still pending ' +
@@ -180,18 +252,48 @@ class IB_API(Thread):
             logging.info('Received execDetails for reqId ' + str(msg_reqId))
         elif msg.typeName == 'error':
             logging.error(str(msg.errorCode) + ' - ' + str(msg.errorMsg))
-            if msg.errorCode == 200:
-                # Requested contract is ambiguous, remove from req_Id List
-                if msg_reqId in self.reqId_ticker.keys():
-                    del self.reqId_ticker[msg_reqId]
-                # Check if all the expected data has arrived
-                self.check_if_all_data_arrived()
-            elif msg.errorCode == 326:
+            if msg.errorCode == 326:
                 # ClientId in use, raise exception and reconnect with different
                 # id
                 self.thread_exception_msg = msg.errorMsg
+                self.connected.set()
+            elif msg.errorCode in IB_WARNING_CODES:
+                pass
+            elif (msg_reqId in self.reqId_ticker or
+                  msg_reqId in self.details_reqId or
+                  msg_reqId in self.futures):
+                # Any other error ends the request: ambiguous contract (200),
+                # duplicated or rejected request (322), no market data
+                # subscription (354, 10168)...
+                self._request_failed(msg_reqId, RequestError(msg.errorCode,
+                                                             msg.errorMsg))
         elif msg.typeName == 'connectionClosed':
             logging.info('Connection has been closed')
+            for req_id in list(self.futures):
+                self._fail(req_id, RequestError(None, 'Connection closed'))
+
+    def _request_failed(self, req_id, error):
+        '''
+        Ends a request rejected by the server: its future fails, its market
+        data line is freed and its ticker job goes on without it
+        '''
+        self._fail(req_id, error)
+        contract = self.reqId_ticker.pop(req_id, None)
+        job = self.reqId_job.get(req_id)
+        if (job is not None and contract is not None and
+                contract.m_secType == 'OPT'):
+            job.failed.add(contract.m_localSymbol)
+        if req_id in self.subscriptions:
+            self.subscriptions.remove(req_id)
+        if contract is not None and contract.m_secType == 'STK':
+            # No underlying data to filter the deferred contracts
+            self._release_deferred(contract.m_symbol, force=True)
+        if req_id in self.details_reqId:
+            # No contract details found for the requested ticker
+            self._contract_details_done(req_id, complete=False)
+        self._request_done(req_id)
+        # Check if all the expected data has arrived
+        self.check_if_all_data_arrived()
 
     def check_if_all_data_arrived(self):
         '''
@@ -199,7 +301,8 @@ class IB_API(Thread):
         '''
         if not self.reqId_ticker:
             logging.info('All requested market data has arrived')
-            if not self.subscriptions:
+            if (not self.subscriptions and not self.jobs and
+                    not self.pending_tickers):
                 self.status = 'IDLE'
                 logging.info('IB connection status set to IDLE')
                 self.event.set()
@@ -216,25 +319,22 @@ class IB_API(Thread):
         contract = self.reqId_ticker[msg.tickerId]
         underlying = contract.m_symbol
         contract_id = contract.m_localSymbol
+        field = {1: 'bid', 2: 'ask', 9: 'close'}.get(msg.field)
+        if field is None:
+            return
 
         # Parse message
-        if msg.field == 1:
-            if contract.m_secType == 'OPT':
-                self.opt_chain[underlying][contract_id]['bid'] = str(price)
-            elif contract.m_secType == 'STK':
-                self.stk_data[underlying]['bid'] = str(price)
-        elif msg.field == 2:
-            if contract.m_secType == 'OPT':
-                self.opt_chain[underlying][contract_id]['ask'] = str(price)
-            elif contract.m_secType == 'STK':
-                self.stk_data[underlying]['ask'] = str(price)
-        elif msg.field == 9:
-            if contract.m_secType == 'OPT':
-                self.opt_chain[underlying][contract_id]['close'] = str(price)
-            elif contract.m_secType == 'STK':
-                self.stk_data[underlying]['close'] = str(price)
-                if self._check_underlying_data(underlying):
-                    self.cancel_subscription(msg.tickerId)
+        if contract.m_secType == 'OPT':
+            self.opt_chain[underlying].set(contract_id, field, price)
+            self._publish(underlying, contract_id, field)
+        elif contract.m_secType == 'STK':
+            self.stk_data[underlying][field] = float(price)
+            self._publish(underlying, None, field)
+            self._release_deferred(underlying)
+            if (field == 'close' and underlying not in self.streaming and
+                    self._check_underlying_data(underlying)):
+                self._resolve(msg.tickerId, dict(self.stk_data[underlying]))
+                self.cancel_subscription(msg.tickerId)
 
     def _parse_tickOptionComputation(self, msg):
         '''
@@ -246,45 +346,24 @@ class IB_API(Thread):
 
         underlying = self.reqId_ticker[msg.tickerId].m_symbol
         contract_id = self.reqId_ticker[msg.tickerId].m_localSymbol
-        field = msg.field
-        price = msg.values()[2]
-        delta = msg.delta
-        impliedVolatility = msg.impliedVol
-        optPrice = msg.optPrice
-        pvDividend = msg.pvDividend
-        gamma = msg.gamma
-        vega = msg.vega
-        theta = msg.theta
-        undPrice = msg.undPrice
+        chain = self.opt_chain[underlying]
         # Parse message
-        if field == 10:
-            self.opt_chain[underlying][contract_id]['bid_delta'] = str(delta)
-            self.opt_chain[underlying][contract_id][
-                'bid_impliedVolatility'] = (str(impliedVolatility))
-            self.opt_chain[underlying][contract_id]['bid_optPrice'] = (
-                str(optPrice))
-            self.opt_chain[underlying][contract_id]['bid_pvDividend'] = (
-                str(pvDividend))
-            self.opt_chain[underlying][contract_id]['bid_gamma'] = str(gamma)
-            self.opt_chain[underlying][contract_id]['bid_vega'] = str(vega)
-            self.opt_chain[underlying][contract_id]['bid_theta'] = str(theta)
-            self.opt_chain[underlying][contract_id]['bid_undPrice'] = (
-                str(undPrice))
-        elif field == 11:
-            self.opt_chain[underlying][contract_id]['ask_delta'] = str(delta)
-            self.opt_chain[underlying][contract_id][
-                'ask_impliedVolatility'] = (str(impliedVolatility))
-            self.opt_chain[underlying][contract_id]['ask_optPrice'] = (
-                str(optPrice))
-            self.opt_chain[underlying][contract_id]['ask_pvDividend'] = (
-                str(pvDividend))
-            self.opt_chain[underlying][contract_id]['ask_gamma'] = str(gamma)
-            self.opt_chain[underlying][contract_id]['ask_vega'] = str(vega)
-            self.opt_chain[underlying][contract_id]['ask_theta'] = str(theta)
-            self.opt_chain[underlying][contract_id]['ask_undPrice'] = (
-                str(undPrice))
-        elif field == 24:
-            self.opt_chain[underlying][contract_id]['iv'] = str(price)
+        if msg.field in (10, 11):
+            prefix = 'bid_' if msg.field == 10 else 'ask_'
+            chain.set(contract_id, prefix + 'delta', msg.delta)
+            chain.set(contract_id, prefix + 'impliedVolatility',
+                      msg.impliedVol)
+            chain.set(contract_id, prefix + 'optPrice', msg.optPrice)
+            chain.set(contract_id, prefix + 'pvDividend', msg.pvDividend)
+            chain.set(contract_id, prefix + 'gamma', msg.gamma)
+            chain.set(contract_id, prefix + 'vega', msg.vega)
+            chain.set(contract_id, prefix + 'theta', msg.theta)
+            chain.set(contract_id, prefix + 'undPrice', msg.undPrice)
+            # A single change for the whole computation
+            self._publish(underlying, contract_id, prefix + 'greeks')
+        elif msg.field == 24:
+            chain.set(contract_id, 'iv', msg.values()[2])
+            self._publish(underlying, contract_id, 'iv')
 
     def _parse_tickGeneric(self, msg):
         '''
@@ -298,14 +377,26 @@ class IB_API(Thread):
 
         underlying = self.reqId_ticker[msg.tickerId].m_symbol
         if msg.tickType == 23:
-            self.stk_data[underlying]['hv'] = str(msg.value)
+            self.stk_data[underlying]['hv'] = float(msg.value)
             logging.info('[HV] ' + underlying + ': ' + str(msg.value))
+            self._publish(underlying, None, 'hv')
         elif msg.tickType == 24:
-            self.stk_data[underlying]['iv'] = str(msg.value)
+            self.stk_data[underlying]['iv'] = float(msg.value)
             logging.info('[IV] ' + underlying + ': ' + str(msg.value))
-            if self._check_underlying_data(underlying):
+            self._publish(underlying, None, 'iv')
+            self._release_deferred(underlying)
+            if (underlying not in self.streaming and
+                    self._check_underlying_data(underlying)):
+                self._resolve(msg.tickerId, dict(self.stk_data[underlying]))
                 self.cancel_subscription(msg.tickerId)
 
+    def _publish(self, ticker, contract_id, field):
+        '''
+        Publishes a tick of a streamed ticker to the stream consumers
+        '''
+        if self.stream is not None and ticker in self.streaming:
+            self.stream.publish(ticker, contract_id, field)
+
     def get_option_contracts(self, tickers, expiry=None, strike=None):
         '''
         Call for all the options contract for the underlying
@@ -323,45 +414,383 @@ class IB_API(Thread):
                 'Getting ' + str(ticker) + ' option contracts' +
                 (' expiring on ' + str(expiry)) if expiry else '' +
                 (' with strike ' + str(strike)) if strike else '')
-            # Contract creation
-            contract = Contract()
-            contract.m_symbol = ticker
-            contract.m_exchange = 'SMART'
-            contract.m_secType = 'OPT'
-            if expiry:
-                contract.m_expiry = expiry
-            if strike:
-                contract.m_strike = strike
-            self.connection.reqContractDetails(self.reqId, contract)
-            logging.info('Requested contract details for ' + ticker + ' (' +
-                         str(self.reqId) + ')')
-            self.reqId += 1
+            self._request_contract_details(self._next_req_id(), ticker,
+                                           expiry, strike)
+
+    def _request_contract_details(self, req_id, ticker, expiry, strike):
+        '''
+        Queues a contract details request of the options of a ticker
+        '''
+        # Contract creation
+        contract = Contract()
+        contract.m_symbol = ticker
+        contract.m_exchange = 'SMART'
+        contract.m_secType = 'OPT'
+        if expiry:
+            contract.m_expiry = expiry
+        if strike:
+            contract.m_strike = strike
+        self.details_reqId[req_id] = []
+        with self.jobs_lock:
+            if contract.m_symbol in self.jobs:
+                self.jobs[contract.m_symbol].details_pending.add(req_id)
+        self.output_queue.put((req_id, 'reqContractDetails', contract, False))
+
+    def download_chains(self, tickers, checkpoint=None,
+                        contract_cache=None, chain_filter=None):
+        '''
+        Downloads the option chains and the underlying close price and IV of
+        given tickers, running up to max_tickers of them concurrently. As
+        soon as all the data of a ticker has arrived, a tuple (ticker,
+        latency in seconds) is put in the completed queue
+        tickers -> List of tickers to be downloaded
+        checkpoint -> [Optional] DownloadCheckpoint where the progress of
+            every ticker is saved, and from which a previous run is resumed
+        contract_cache -> [Optional] ContractCache whose contracts get their
+            market data requested without waiting for the contract details
+        chain_filter -> [Optional] ChainFilter selecting the contracts whose
+            market data is requested
+        '''
+        self.status = 'WORKING'
+        if checkpoint is not None:
+            self.checkpoint = checkpoint
+        if contract_cache is not None:
+            self.contract_cache = contract_cache
+        if chain_filter is not None:
+            self.chain_filter = chain_filter
+        with self.jobs_lock:
+            self.pending_tickers.extend(tickers)
+            self._start_pending_jobs()
+
+    def start_streaming(self, tickers, window=DEFAULT_WINDOW,
+                        contract_filter=None):
+        '''
+        Starts streaming the option chains and the underlying data of given
+        tickers: their market data subscriptions are kept open, every tick
+        updates the chain buffers in place and the changes are published,
+        coalesced per contract within the window. Returns the
+        StreamPublisher, where the consumers are registered
+        inputs:
+            tickers -> list of tickers to be streamed
+            window -> seconds during which the ticks of a contract are
+                coalesced (only used when the stream is created)
+            contract_filter -> [Optional] callable which receives every
+                option contract and returns True if it has to be streamed.
+                Every subscription takes a market data line until it is
+                cancelled, so whole chains rarely fit: contracts beyond the
+                free lines are not streamed
+        '''
+        if self.stream is None:
+            self.stream = StreamPublisher(window)
+            self.stream.start()
+        self.stream_filter = contract_filter
+        self.streaming.update(tickers)
+        logging.info('Starting streaming of ' + ', '.join(tickers))
+        self.get_option_contracts(tickers)
+        for ticker in tickers:
+            self.get_stock_implied_volatility(ticker, False)
+        return self.stream
+
+    def stop_streaming(self, tickers=None):
+        '''
+        Cancels the subscriptions of given streamed tickers (default all).
+        The stream is stopped when no ticker is left
+        '''
+        tickers = set(tickers) if tickers else set(self.streaming)
+        for req_id in list(self.subscriptions):
+            contract = self.reqId_ticker.get(req_id)
+            if contract is not None and contract.m_symbol in tickers:
+                self.cancel_subscription(req_id)
+        self.streaming.difference_update(tickers)
+        logging.info('Stopped streaming of ' + ', '.join(tickers))
+        if not self.streaming and self.stream is not None:
+            self.stream.stop()
+            self.stream = None
+
+    def _start_pending_jobs(self):
+        '''
+        Starts queued ticker jobs while there are free job slots
+        '''
+        with self.jobs_lock:
+            while (self.pending_tickers and
+                   len(self.jobs) < self.max_tickers):
+                ticker = self.pending_tickers.popleft()
+                state = (self.checkpoint.load(ticker) if self.checkpoint
+                         else None)
+                # Rejected snapshots are requested again, so a ticker which
+                # completed with them is resumed as an unfinished one
+                if (state is not None and state['complete'] and
+                        not state['failed']):
+                    self._restore_checkpoint(state)
+                    self.completed.put((ticker, 0.))
+                    continue
+                logging.info('Starting download of ' + ticker + ' data')
+                job = self.jobs[ticker] = TickerJob(ticker)
+                if state is None or state['contracts'] is None:
+                    self._start_job(job)
+                    continue
+                # Only request the snapshots which had not arrived
+                self._restore_checkpoint(state)
+                job.contracts = state['contracts']
+                job.received = state['received']
+                missing = [c for c in job.contracts
+                           if c.m_localSymbol not in job.received]
+                self.checkpoint.record_resume(ticker, state, len(missing))
+                self._request_snapshots(job, missing)
+                if not self._check_underlying_data(ticker):
+                    self.get_stock_implied_volatility(ticker, True)
+                self._check_job(job)
+
+    def _start_job(self, job):
+        '''
+        Requests the option contracts and the underlying data of a new
+        ticker job. Cached contracts get their market data requested right
+        away, and the contract details are only requested when the cache is
+        missing or stale
+        '''
+        cached, fresh = (self.contract_cache.get(job.ticker)
+                         if self.contract_cache else ([], False))
+        if cached:
+            logging.info('Requesting ' + str(len(cached)) + ' cached ' +
+                         job.ticker + ' contracts' +
+                         ('' if fresh else ', refreshing them'))
+            for contract in cached:
+                self.contracts.append(contract)
+                self._save_option_contracts_to_dict(contract)
+            job.contracts = cached
+            self._request_snapshots(job, cached)
+        if not fresh:
+            self.get_option_contracts([job.ticker])
+        self.get_stock_implied_volatility(job.ticker, True)
+
+    def _request_snapshots(self, job, contracts, force=False):
+        '''
+        Requests the market data snapshots of the contracts of a ticker job
+        which pass the chain filter. The contracts are deferred while the
+        underlying data the filter needs has not arrived, unless force is
+        True (the bands which need it are then skipped)
+        '''
+        if self.chain_filter is not None:
+            s = self._underlying_price(job.ticker)
+            iv = self.stk_data[job.ticker].get('iv')
+            if not force and ((self.chain_filter.needs_price() and not s) or
+                              (self.chain_filter.needs_iv() and not iv)):
+                job.deferred.extend(contracts)
+                return
+            n_contracts = len(contracts)
+            contracts = self.chain_filter.apply(contracts, s, iv)
+            logging.info('Chain filter kept ' + str(len(contracts)) +
+                         ' of ' + str(n_contracts) + ' ' + job.ticker +
+                         ' contracts')
+        self._get_market_data(snapshot=True, contracts=contracts)
+
+    def _release_deferred(self, ticker, force=False):
+        '''
+        Requests the deferred contracts of a ticker job once the underlying
+        data has arrived (or its request failed, when force is True)
+        '''
+        with self.jobs_lock:
+            job = self.jobs.get(ticker)
+            if job is None or not job.deferred:
+                return
+            contracts, job.deferred = job.deferred, []
+            self._request_snapshots(job, contracts, force)
+            self._check_job(job)
+
+    def _underlying_price(self, ticker):
+        '''
+        Returns the bid-ask midpoint of an underlying (the close price if
+        there is no quote), or None if no price has arrived
+        '''
+        data = self.stk_data[ticker]
+        if data.get('bid') > 0 and data.get('ask') > 0:
+            return (data['bid'] + data['ask']) / 2.
+        return data.get('close')
+
+    def _restore_checkpoint(self, state):
+        '''
+        Loads the chain and underlying data stored in a checkpoint
+        '''
+        ticker = state['ticker']
+        self.opt_chain[ticker] = ChainBuffer.from_dataframe(ticker,
+                                                            state['chain'])
+        self.stk_data[ticker].update(state['underlying'])
+        if state['complete'] and not state['failed']:
+            self.checkpoint.record_resume(ticker, state)
+
+    def _save_checkpoint(self, job, complete=False):
+        '''
+        Saves the progress of a ticker job, if checkpoints are enabled
+        '''
+        if self.checkpoint is None:
+            return
+        try:
+            # The received ids go first, so they never include a snapshot
+            # missing in the chain. Rejected ones are kept apart, so that a
+            # resumed run requests them again
+            received = set(job.received)
+            self.checkpoint.save(
+                job.ticker, job.contracts, received,
+                self.opt_chain[job.ticker].to_dataframe(),
+                self.stk_data[job.ticker], complete,
+                job.failed - received)
+        except Exception, e:
+            logging.error('Could not save ' + job.ticker + ' checkpoint: ' +
+                          str(e))
+
+    def _contract_details_done(self, req_id, complete=True):
+        '''
+        Requests the market data snapshots of the contracts received for the
+        given contract details request (subscriptions for streamed tickers).
+        complete is False when the request failed, so the contracts received
+        (if any) are partial and are not cached
+        '''
+        contracts = self.details_reqId.pop(req_id, None)
+        if contracts is None:
+            return
+        if req_id in self.futures:
+            self._resolve(req_id, contracts)
+            return
+        with self.jobs_lock:
+            jobs = [job for job in self.jobs.values()
+                    if req_id in job.details_pending]
+        for job in jobs:
+            if self.contract_cache is not None and complete and contracts:
+                self.contract_cache.update(job.ticker, contracts)
+            if job.contracts:
+                # Delta refresh: the cached contracts were already requested
+                requested = set(c.m_conId for c in job.contracts)
+                contracts = [c for c in contracts
+                             if c.m_conId not in requested]
+        streamed = [c for c in contracts if c.m_symbol in self.streaming]
+        if streamed:
+            # Subscribe to the streamed contracts
+            if self.stream_filter:
+                streamed = [c for c in streamed if self.stream_filter(c)]
+            # Subscriptions hold their lines until they are cancelled, so
+            # only the free ones can be taken
+            free = max(self.lines.max_lines - SNAPSHOT_LINES -
+                       len(self.subscriptions), 0)
+            if len(streamed) > free:
+                logging.warning(
+                    'Only ' + str(free) + ' of ' + str(len(streamed)) + ' ' +
+                    streamed[0].m_symbol + ' contracts can be streamed, '
+                    'there are no more market data lines')
+                streamed = streamed[:free]
+            self._get_market_data(snapshot=False, contracts=streamed)
+            contracts = [c for c in contracts
+                         if c.m_symbol not in self.streaming]
+        # Request market data snapshots to the server
+        if jobs:
+            for job in jobs:
+                self._request_snapshots(job, contracts)
+        else:
+            self._get_market_data(snapshot=True, contracts=contracts)
+        with self.jobs_lock:
+            for job in jobs:
+                job.details_pending.discard(req_id)
+                job.contracts = (job.contracts or []) + contracts
+                self._save_checkpoint(job)
+                self._check_job(job)
+
+    def _request_done(self, req_id):
+        '''
+        Frees the market data line of the given request and updates the
+        ticker job it belongs to
+        '''
+        self.lines.release(req_id)
+        self.sent.discard(req_id)
+        with self.jobs_lock:
+            job = self.reqId_job.pop(req_id, None)
+            if job is not None:
+                job.pending.discard(req_id)
+                if self.checkpoint and self.checkpoint.due(job.ticker):
+                    self._save_checkpoint(job)
+                self._check_job(job)
 
-    def _get_market_data(self, snapshot):
+    def _check_job(self, job):
+        '''
+        Checks if all the data of given ticker job has arrived, and if so
+        reports it and starts the next queued ticker
+        '''
+        with self.jobs_lock:
+            if not job.is_done() or job.ticker not in self.jobs:
+                return
+            job.end_time = time()
+            del self.jobs[job.ticker]
+            self._save_checkpoint(job, complete=True)
+            self.latencies[job.ticker] = job.latency()
+            logging.info('Downloaded ' + job.ticker + ' data in ' +
+                         '{0:.2f}'.format(job.latency()) + ' s')
+            self.completed.put((job.ticker, job.latency()))
+            self._start_pending_jobs()
+        self.check_if_all_data_arrived()
+
+    def _get_market_data(self, snapshot, contracts=None):
         '''
         Requests all the options prices and greeks
         snapshot -> True if only a snapshot of market data is desired; False if
             a subscription is desired
+        contracts -> [Optional] list of contracts to be requested (default
+            all the received option contracts)
         '''
         self.status = 'WORKING'
         # Loop through all options contracts
-        for contract in self.contracts:
-            # Store the relationship between reqId and contract object
-            self.reqId_ticker[self.reqId] = contract
-            self.output_queue.put(
-                (self.reqId, 'reqMktData', contract, snapshot))
-            # If it is a subscription, add reqId to the subscription list
-            if not snapshot:
-                self.subscriptions.append(self.reqId)
-            self.reqId += 1
+        for contract in (self.contracts if contracts is None else contracts):
+            self._request_market_data(self._next_req_id(), contract, snapshot)
+
+    def _request_market_data(self, req_id, contract, snapshot):
+        '''
+        Queues a market data request of an option contract
+        '''
+        # Store the relationship between reqId and contract object
+        self.reqId_ticker[req_id] = contract
+        self._add_to_job(req_id, contract.m_symbol)
+        self.output_queue.put((req_id, 'reqMktData', contract, snapshot))
+        # If it is a subscription, add reqId to the subscription list
+        if not snapshot:
+            self.subscriptions.append(req_id)
+
+    def _add_to_job(self, req_id, ticker):
+        '''
+        Adds a market data request to the job of given ticker, if any
+        '''
+        with self.jobs_lock:
+            job = self.jobs.get(ticker)
+            if job is not None:
+                job.pending.add(req_id)
+                self.reqId_job[req_id] = job
 
     def cancel_subscription(self, req_id):
         '''
-        Cancels the data subscription associated to given req_id
+        Cancels the data subscription associated to given req_id. A request
+        which has not been sent yet is dropped by the sender instead
+        '''
+        contract = self.reqId_ticker.get(req_id)
+        if contract is None:
+            return
+        with self.cancel_lock:
+            if req_id not in self.sent:
+                self.cancelled.add(req_id)
+                return
+        self.cancel_queue.put((req_id, contract))
+        # Wake up the sender if it is idle
+        self.output_queue.put((req_id, 'cancelMktData', contract, False))
+
+    def _cancel_done(self, req_id):
+        '''
+        Forgets a cancelled request and frees its market data line
         '''
+        # Remove reqId from subscription list
+        if req_id in self.subscriptions:
+            self.subscriptions.remove(req_id)
+        # If it does not belong to a subscription, remove the reqId from the
+        # list of requested ids
         if req_id in self.reqId_ticker.keys():
-            contract = self.reqId_ticker[req_id]
-            self.output_queue.put((req_id, 'cancelMktData', contract, False))
+            del self.reqId_ticker[req_id]
+        self._request_done(req_id)
+        # Check if there is any pending job
+        self.check_if_all_data_arrived()
 
     def get_stock_historical_volatility(self, ticker):
         '''
@@ -376,10 +805,10 @@ class IB_API(Thread):
         stock_contract.m_currency = 'USD'
 
         # Insert request to output queue
-        self.reqId_ticker[self.reqId] = stock_contract
+        req_id = self._next_req_id()
+        self.reqId_ticker[req_id] = stock_contract
         self.output_queue.put(
-            (self.reqId, 'reqStkHistoricalVol', stock_contract, False))
-        self.reqId += 1
+            (req_id, 'reqStkHistoricalVol', stock_contract, False))
 
     def get_stock_implied_volatility(self, ticker, snapshot):
         '''
@@ -388,6 +817,13 @@ class IB_API(Thread):
             a subscription is desired
         '''
         self.status = 'WORKING'
+        self._request_stock_data(self._next_req_id(), ticker, snapshot)
+
+    def _request_stock_data(self, req_id, ticker, snapshot):
+        '''
+        Queues a market data request (prices and implied volatility) of a
+        stock
+        '''
         # Create stock's contract
         stock_contract = Contract()
         stock_contract.m_symbol = ticker
@@ -396,80 +832,191 @@ class IB_API(Thread):
         stock_contract.m_currency = 'USD'
 
         # Insert request to output queue
-        self.reqId_ticker[self.reqId] = stock_contract
+        self.reqId_ticker[req_id] = stock_contract
+        self._add_to_job(req_id, ticker)
         self.output_queue.put(
-            (self.reqId, 'reqStkImpliedVol', stock_contract, snapshot))
+            (req_id, 'reqStkImpliedVol', stock_contract, snapshot))
         # If it is a subscription, add reqId to the subscription list
         if not snapshot:
-            self.subscriptions.append(self.reqId)
-        self.reqId += 1
+            self.subscriptions.append(req_id)
+
+    def _next_req_id(self):
+        '''
+        Returns a new request id. Requests are issued from several threads
+        '''
+        with self.reqId_lock:
+            req_id = self.reqId
+            self.reqId += 1
+        return req_id
+
+    def wait_connected(self, timeout=10.):
+        '''
+        Waits until the server accepts or rejects the client id. Returns True
+        if the connection is ready and False if the client id is in use.
+        Raises RequestTimeout if the server does not answer within timeout
+        seconds, and RequestError if the connection failed
+        '''
+        if not self.connected.wait(timeout):
+            raise RequestTimeout('No answer from IB server at port ' +
+                                 str(self.port))
+        if self.thread_exception_msg:
+            return False
+        if not self.keep_alive:
+            raise RequestError(None, 'Could not connect to IB server')
+        return True
+
+    def _new_future(self, req_id, on_cancel=None):
+        '''
+        Registers the future of a request, dropped once it is finished
+        '''
+        self.status = 'WORKING'
+        future = self.futures[req_id] = RequestFuture(req_id, on_cancel)
+        future.add_done_callback(lambda f: self.futures.pop(f.req_id, None))
+        return future
+
+    def _resolve(self, req_id, result):
+        future = self.futures.get(req_id)
+        if future is not None:
+            future.set_result(result)
+
+    def _fail(self, req_id, error):
+        future = self.futures.get(req_id)
+        if future is not None:
+            future.set_error(error)
+
+    def request_contract_details(self, ticker, expiry=None, strike=None):
+        '''
+        Requests the option contracts of a ticker (inputs as in
+        get_option_contracts). Returns a RequestFuture resolved with the list
+        of contracts when contractDetailsEnd arrives. No market data is
+        requested for them
+        '''
+        req_id = self._next_req_id()
+        future = self._new_future(req_id)
+        self._request_contract_details(req_id, ticker, expiry, strike)
+        return future
+
+    def request_market_data(self, contract):
+        '''
+        Requests a market data snapshot of an option contract. Returns a
+        RequestFuture resolved with a dict of its market data fields when
+        tickSnapshotEnd arrives; cancelling the future cancels the request.
+        It blocks while max_lines market data futures are pending, so it
+        must not be called from a future callback
+        '''
+        self.pending_requests.acquire()
+        req_id = self._next_req_id()
+        future = self._new_future(req_id, self.cancel_subscription)
+        future.add_done_callback(lambda f: self.pending_requests.release())
+        self._request_market_data(req_id, contract, True)
+        return future
+
+    def request_stock_data(self, ticker):
+        '''
+        Requests the prices and implied volatility of a stock. Returns a
+        RequestFuture resolved with a dict of them once both the close price
+        and the IV have arrived
+        '''
+        req_id = self._next_req_id()
+        future = self._new_future(req_id, self.cancel_subscription)
+        self._request_stock_data(req_id, ticker, True)
+        return future
 
     def _send_messages(self):
         '''
-        Method to send pending messages at output queue to the IB server
+        Method to send pending messages at output queue to the IB server,
+        pacing them and waiting for a free line before every market data
+        request. Queued cancels are sent first, also while waiting for a line
+        '''
+        while self.keep_alive:
+            self._send_cancels()
+            try:
+                req_id, msgType, contract, snapshot = self.output_queue.get(
+                    timeout=0.5)
+            except Empty:
+                continue
+            if msgType == 'cancelMktData':
+                # Only wakes the sender up, cancels go by the cancel queue
+                continue
+            if msgType in MARKET_DATA_MSGS:
+                if self._drop_cancelled(req_id):
+                    continue
+                while not self.lines.acquire(req_id, timeout=0.1):
+                    # Cancels do not wait for a line, they free them
+                    self._send_cancels()
+                    if not self.keep_alive:
+                        return
+                if self._drop_cancelled(req_id, claim=True):
+                    continue
+            # Sleep between messages to avoid collapsing IB server
+            self.pacer.wait()
+            if msgType == 'reqContractDetails':
+                self.connection.reqContractDetails(req_id, contract)
+                logging.info('Requested contract details for ' +
+                             str(contract.m_symbol) + ' (' + str(req_id) +
+                             ')')
+            elif msgType == 'reqMktData':
+                self.connection.reqMktData(
+                    req_id, contract, None, snapshot=snapshot)
+                logging.info('Requested market data ' +
+                             ('snapshot' if snapshot else 'subscription') +
+                             ' for ' + str(contract.m_localSymbol) + ' (' +
+                             str(req_id) + ')')
+            elif msgType == 'reqStkHistoricalVol':  # TODO Under test
+                self.connection.reqMktData(
+                    req_id, contract, '104', snapshot=False)
+                logging.info('Requested historical volatility for ' +
+                             str(contract.m_symbol) + ' (' +
+                             str(req_id) + ')')
+            elif msgType == 'reqStkImpliedVol':
+                self.connection.reqMktData(
+                    req_id, contract, '106', snapshot=False)
+                logging.info('Requested implied volatility for ' +
+                             str(contract.m_symbol) + ' (' +
+                             str(req_id) + ')')
+            elif msgType == 'reqAccountUpdates':  # TODO Under test
+                # Contract variable here refers to the account number
+                self.connection.reqAccountUpdates(True, contract)
+
+    def _send_cancels(self):
+        '''
+        Sends the queued cancel messages (sender thread)
         '''
         while True:
-            while not self.output_queue.empty():
-                req_id, msgType, contract, snapshot = self.output_queue.get()
-                if msgType == 'reqMktData':
-                    self.connection.reqMktData(
-                        req_id, contract, None, snapshot=snapshot)
-                    logging.info('Requested market data snapshot for ' +
-                                 str(contract.m_localSymbol) + ' (' +
-                                 str(req_id) + ')')
-                elif msgType == 'cancelMktData':
-                    self.connection.cancelMktData(req_id)
-                    logging.info('Cancelled market data subscription for ' +
-                                 str(contract.m_localSymbol) + ' (' +
-                                 str(req_id) + ')')
-                    # Remove reqId from subscription list
-                    if req_id in self.subscriptions:
-                        self.subscriptions.remove(req_id)
-                    # If it does not belong to a subscription, remove the reqId
-                    # from the list of requested ids
-                    if req_id in self.reqId_ticker.keys():
-                        del self.reqId_ticker[req_id]
-                    # Check if there is any pending job
-                    if not self.subscriptions and not self.reqId_ticker:
-                        self.status = 'IDLE'
-                        logging.info('IB connection status set to IDLE')
-                        self.event.set()
-                elif msgType == 'reqStkHistoricalVol':  # TODO Under test
-                    self.connection.reqMktData(
-                        req_id, contract, '104', snapshot=False)
-                    logging.info('Requested historical volatility for ' +
-                                 str(contract.m_symbol) + ' (' +
-                                 str(req_id) + ')')
-                elif msgType == 'reqStkImpliedVol':
-                    self.connection.reqMktData(
-                        req_id, contract, '106', snapshot=False)
-                    logging.info('Requested implied volatility for ' +
-                                 str(contract.m_symbol) + ' (' +
-                                 str(req_id) + ')')
-                elif msgType == 'reqAccountUpdates':  # TODO Under test
-                    # Contract variable here refers to the account number
-                    self.connection.reqAccountUpdates(True, contract)
-
-                # Sleep between messages to avoid collapsing IB server
-                sleep(0.1)
+            try:
+                req_id, contract = self.cancel_queue.get_nowait()
+            except Empty:
+                return
+            self.pacer.wait()
+            self.connection.cancelMktData(req_id)
+            logging.info('Cancelled market data subscription for ' +
+                         str(contract.m_localSymbol) + ' (' + str(req_id) +
+                         ')')
+            self._cancel_done(req_id)
+
+    def _drop_cancelled(self, req_id, claim=False):
+        '''
+        Returns True if the given market data request was cancelled before
+        being sent, and forgets it (sender thread). Otherwise, if claim is
+        True, the request is recorded as sent, so that it gets a cancel
+        message from then on
+        '''
+        with self.cancel_lock:
+            if req_id not in self.cancelled:
+                if claim:
+                    self.sent.add(req_id)
+                return False
+            self.cancelled.remove(req_id)
+        logging.info('Dropped cancelled request ' + str(req_id))
+        self._cancel_done(req_id)
+        return True
 
     def _save_option_contracts_to_dict(self, opt_con):
         '''
-        It saves the options market data into the both the contracts dictionary
-        and the option chain dictionary
+        It saves the option contract details into its option chain buffer
             opt_con -> Contract details on an option
         '''
-        underlying = opt_con.m_symbol
-        c_id = opt_con.m_localSymbol  # contract id
-
-        # Store data in the option chain dictionary
-        self.opt_chain[underlying][c_id]['m_conId'] = opt_con.m_conId
-        self.opt_chain[underlying][c_id]['m_expiry'] = opt_con.m_expiry
-        self.opt_chain[underlying][c_id]['m_strike'] = opt_con.m_strike
-        self.opt_chain[underlying][c_id]['m_right'] = opt_con.m_right
-        self.opt_chain[underlying][c_id]['m_multiplier'] = opt_con.m_multiplier
-        self.opt_chain[underlying][c_id]['m_currency'] = opt_con.m_currency
-        self.opt_chain[underlying][c_id]['m_localSymbol'] = c_id
+        self.opt_chain[opt_con.m_symbol].add_contract(opt_con)
 
     def _check_underlying_data(self, underlying):
         '''
@@ -485,8 +1032,8 @@ class IB_API(Thread):
 
     def _get_account_summary(self, accounts_list, snapshot):  # TODO under test
         self.output_queue.put(
-            (self.reqId, 'reqAccountUpdates', accounts_list, snapshot))
-        self.reqId += 1
+            (self._next_req_id(), 'reqAccountUpdates', accounts_list,
+             snapshot))
 
     def _parsePortfolioData(self, msg):  # TODO Under test
         '''
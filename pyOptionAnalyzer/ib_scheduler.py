@@ -0,0 +1,228 @@
+'''
+Request scheduling helpers for IB_API: message pacing, market data lines
+accounting, per-ticker download jobs and the futures of single requests
+'''
+from threading import Condition, Event, Lock
+from time import sleep, time
+
+# IB limits: messages per second sent to TWS/Gateway and simultaneous market
+# data lines (default account allowance)
+IB_MAX_MSGS_PER_SEC = 50
+IB_MAX_MARKET_DATA_LINES = 100
+# IB error codes which are only warnings, the request goes on: data farm
+# connection status (2100-2199), partial market data permissions (10090) and
+# delayed market data being displayed (10167)
+IB_WARNING_CODES = frozenset(range(2100, 2200) + [10090, 10167])
+
+
+class RequestPacer(object):
+    '''
+    Spaces the messages sent to the IB server so that no more than max_rate
+    messages per second are sent
+    '''
+
+    def __init__(self, max_rate=IB_MAX_MSGS_PER_SEC):
+        self.interval = 1. / max_rate
+        self.next_time = time()
+        self.lock = Lock()
+
+    def wait(self):
+        '''
+        Blocks until next message can be sent
+        '''
+        with self.lock:
+            now = time()
+            if self.next_time > now:
+                sleep(self.next_time - now)
+                now = self.next_time
+            self.next_time = now + self.interval
+
+
+class MarketDataLines(object):
+    '''
+    Keeps track of the market data lines in use, so that no more than
+    max_lines requests are active at the same time
+    '''
+
+    def __init__(self, max_lines=IB_MAX_MARKET_DATA_LINES):
+        self.max_lines = max_lines
+        self.active = set()
+        self.condition = Condition()
+
+    def __len__(self):
+        return len(self.active)
+
+    def acquire(self, req_id, timeout=None):
+        '''
+        Takes a line for given request id, waiting until one is free. Returns
+        False if no line got free within the given timeout (in seconds)
+        '''
+        with self.condition:
+            deadline = None if timeout is None else time() + timeout
+            while len(self.active) >= self.max_lines:
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            self.active.add(req_id)
+            return True
+
+    def release(self, req_id):
+        '''
+        Frees the line used by the given request id, if any
+        '''
+        with self.condition:
+            if req_id in self.active:
+                self.active.remove(req_id)
+                self.condition.notify()
+
+
+class TickerJob(object):
+    '''
+    Tracks the requests issued to download the data of a single ticker
+    '''
+
+    def __init__(self, ticker):
+        self.ticker = ticker
+        self.start_time = time()
+        self.end_time = None
+        self.details_pending = set()  # contract details req ids
+        self.pending = set()  # market data req ids
+        self.contracts = None  # option contracts received
+        self.received = set()  # contract ids whose snapshot has arrived
+        self.failed = set()  # contract ids whose request was rejected
+        self.deferred = []  # contracts waiting for the underlying data
+
+    def is_done(self):
+        return (not self.details_pending and not self.pending and
+                not self.deferred)
+
+    def latency(self):
+        '''
+        Returns the seconds elapsed since the job started until it finished
+        (or until now, if it is still running)
+        '''
+        return (self.end_time if self.end_time else time()) - self.start_time
+
+
+class RequestError(Exception):
+    '''
+    Error answered by the IB server to a request
+    '''
+
+    def __init__(self, code, msg):
+        super(RequestError, self).__init__(str(code) + ' - ' + str(msg))
+        self.code = code
+
+
+class RequestTimeout(Exception):
+    pass
+
+
+class RequestCancelled(Exception):
+    pass
+
+
+class RequestFuture(object):
+    '''
+    Result of a single request, resolved by IB_API when the answer with its
+    req id arrives (or failed with a RequestError)
+    '''
+
+    def __init__(self, req_id, on_cancel=None):
+        '''
+        req_id -> id of the request
+        on_cancel -> [Optional] called with the req id when the future is
+            cancelled before being resolved
+        '''
+        self.req_id = req_id
+        self.on_cancel = on_cancel
+        self._done = Event()
+        self._lock = Lock()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def cancelled(self):
+        return isinstance(self._error, RequestCancelled)
+
+    def _finish(self, result, error):
+        '''
+        Stores the outcome and runs the callbacks. Returns False if the
+        future was already finished
+        '''
+        with self._lock:
+            if self._done.is_set():
+                return False
+            self._result = result
+            self._error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+        return True
+
+    def set_result(self, result):
+        return self._finish(result, None)
+
+    def set_error(self, error):
+        return self._finish(None, error)
+
+    def add_done_callback(self, callback):
+        '''
+        Calls callback(future) once the future is finished (right away if it
+        already is). Callbacks usually run on the IB_API thread, so they must
+        not block
+        '''
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def cancel(self):
+        '''
+        Cancels the request if it is still pending. Returns True if it was
+        cancelled
+        '''
+        cancelled = self._finish(None, RequestCancelled(
+            'Request ' + str(self.req_id) + ' cancelled'))
+        if cancelled and self.on_cancel:
+            self.on_cancel(self.req_id)
+        return cancelled
+
+    def result(self, timeout=None):
+        '''
+        Waits for the request and returns its result, raising its error
+        instead if it failed. A RequestTimeout is raised if it is not
+        finished within timeout seconds (the request keeps running)
+        '''
+        if not self._done.wait(timeout):
+            raise RequestTimeout('Request ' + str(self.req_id) +
+                                 ' timed out')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+def wait_all(futures, timeout=None):
+    '''
+    Waits for several requests and returns a list with the result of every
+    future, or its exception if it failed. The futures still pending when
+    the timeout expires are cancelled
+    '''
+    deadline = None if timeout is None else time() + timeout
+    results = []
+    for future in futures:
+        remaining = None if deadline is None else max(deadline - time(), 0)
+        try:
+            results.append(future.result(remaining))
+        except RequestTimeout, e:
+            future.cancel()
+            results.append(e)
+        except Exception, e:
+            results.append(e)
+    return results
@@ -0,0 +1,446 @@
+'''
+Local stand-in for TWS/IB Gateway, speaking enough of the IB socket protocol
+to serve IB_API: contract details, market data snapshots and subscriptions
+(tickPrice, tickOptionComputation, tickGeneric, tickSnapshotEnd) and the
+error codes 200 and 326. Option chains are synthetic, priced with
+Black-Scholes, and their size and response latency are configurable.
+
+Run as a script to benchmark how many contracts per second go through
+IB_API.
+'''
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from threading import Condition, Event, Lock, Thread
+from time import sleep, time
+import SocketServer
+import heapq
+import logging
+import random
+import socket
+import numpy as np
+import bs_engine
+
+# Server version announced on connection. It determines the fields that the
+# IbPy client sends on every request
+SERVER_VERSION = 69
+
+# Incoming message ids
+REQ_MKT_DATA = 1
+CANCEL_MKT_DATA = 2
+REQ_ACCOUNT_DATA = 6
+REQ_IDS = 8
+REQ_CONTRACT_DATA = 9
+REQ_CURRENT_TIME = 49
+
+# Outgoing message ids
+TICK_PRICE = 1
+ERR_MSG = 4
+NEXT_VALID_ID = 9
+CONTRACT_DATA = 10
+MANAGED_ACCTS = 15
+TICK_OPTION_COMPUTATION = 21
+TICK_GENERIC = 45
+CURRENT_TIME = 49
+CONTRACT_DATA_END = 52
+TICK_SNAPSHOT_END = 57
+
+
+class SyntheticChain(object):
+    '''
+    Synthetic option chain of a single underlying
+    '''
+
+    def __init__(self, ticker, price, iv, n_expiries, n_strikes, today,
+                 first_con_id):
+        self.ticker = ticker
+        self.price = price
+        self.iv = iv
+        self.contracts = []
+        step = max(round(price * 0.01), 0.5)
+        strikes = price + step * (np.arange(n_strikes) - n_strikes // 2)
+        for i in range(n_expiries):
+            # Weekly expiries, on fridays
+            expiry = today + timedelta(days=(4 - today.weekday()) % 7 + 7 * i)
+            for strike in strikes:
+                for right in ['C', 'P']:
+                    self.contracts.append({
+                        'conId': first_con_id + len(self.contracts),
+                        'symbol': ticker, 'expiry': expiry.strftime('%Y%m%d'),
+                        'strike': float(strike), 'right': right,
+                        'localSymbol': '{0:<6}{1}{2}{3:08d}'.format(
+                            ticker, expiry.strftime('%y%m%d'), right,
+                            int(strike * 1000)),
+                        't': max((expiry - today).days, 1) / 365.})
+        self.by_local_symbol = {c['localSymbol']: c
+                                for c in self.contracts}
+
+    def quote(self, contract, jitter=0.):
+        '''
+        Returns a dict with bid, ask, close and the model greeks of an option
+        '''
+        s = self.price * (1. + jitter)
+        # Simple volatility smile around the money
+        iv = self.iv * (1. + 0.5 * np.log(contract['strike'] / s) ** 2 * 100)
+        res = bs_engine.greeks(contract['right'], s, contract['strike'],
+                               contract['t'], 0.01, iv)
+        price = float(res['price'])
+        spread = max(0.01, round(price * 0.02, 2))
+        return {'bid': round(max(price - spread / 2., 0.), 2),
+                'ask': round(price + spread / 2., 2),
+                'close': round(price, 2), 'iv': iv, 's': s,
+                'delta': float(res['delta']), 'gamma': float(res['gamma']),
+                'vega': float(res['vega']), 'theta': float(res['theta']),
+                'price': price}
+
+
+class _SimulatorHandler(SocketServer.BaseRequestHandler):
+    '''
+    Serves a single client connection
+    '''
+
+    def setup(self):
+        self.buffer = b''
+        self.send_lock = Lock()
+        self.schedule = []  # heap of (due time, sequence, fields)
+        self.schedule_cv = Condition()
+        self.sequence = 0
+        self.subscriptions = set()
+        self.alive = True
+        self.client_id = None
+
+    def _read_field(self):
+        while b'\0' not in self.buffer:
+            data = self.request.recv(65536)
+            if not data:
+                raise EOFError
+            self.buffer += data
+        field, self.buffer = self.buffer.split(b'\0', 1)
+        return field.decode('ascii')
+
+    def _read_fields(self, n):
+        return [self._read_field() for _ in range(n)]
+
+    def _send(self, fields):
+        data = b''.join(str(f).encode('ascii') + b'\0' for f in fields)
+        with self.send_lock:
+            self.request.sendall(data)
+
+    def _send_later(self, fields, delay):
+        '''
+        Schedules a message to be sent after the given delay (in seconds)
+        '''
+        with self.schedule_cv:
+            self.sequence += 1
+            heapq.heappush(self.schedule,
+                           (time() + delay, self.sequence, fields))
+            self.schedule_cv.notify()
+
+    def _writer(self):
+        '''
+        Sends the scheduled messages when they are due
+        '''
+        while self.alive:
+            with self.schedule_cv:
+                while self.alive and (not self.schedule or
+                                      self.schedule[0][0] > time()):
+                    self.schedule_cv.wait(
+                        self.schedule[0][0] - time() if self.schedule
+                        else 0.5)
+                if not self.alive:
+                    return
+                _, _, fields = heapq.heappop(self.schedule)
+            try:
+                self._send(fields)
+            except socket.error:
+                return
+
+    def _error(self, req_id, code, msg):
+        self._send_later([ERR_MSG, 2, req_id, code, msg], 0.)
+
+    def handle(self):
+        sim = self.server.simulator
+        try:
+            # Handshake: client version, server version and time, client id
+            self._read_field()
+            self._send([SERVER_VERSION,
+                        datetime.now().strftime('%Y%m%d %H:%M:%S') + ' EST'])
+            self.client_id = int(self._read_field())
+            if not sim.register_client(self.client_id):
+                self._send([ERR_MSG, 2, -1, 326, 'Unable to connect as the '
+                            'client id is already in use. Retry with a '
+                            'unique client id.'])
+                return
+            writer = Thread(target=self._writer)
+            writer.daemon = True
+            writer.start()
+            self._send_later([NEXT_VALID_ID, 1, 1], 0.)
+            self._send_later([MANAGED_ACCTS, 1, 'DU000000'], 0.)
+            while True:
+                msg_id = int(self._read_field())
+                if msg_id == REQ_MKT_DATA:
+                    self._req_mkt_data(sim)
+                elif msg_id == CANCEL_MKT_DATA:
+                    _, req_id = self._read_fields(2)
+                    self.subscriptions.discard(int(req_id))
+                elif msg_id == REQ_CONTRACT_DATA:
+                    self._req_contract_data(sim)
+                elif msg_id == REQ_ACCOUNT_DATA:
+                    self._read_fields(3)
+                elif msg_id == REQ_IDS:
+                    self._read_fields(2)
+                    self._send_later([NEXT_VALID_ID, 1, 1], 0.)
+                elif msg_id == REQ_CURRENT_TIME:
+                    self._read_fields(1)
+                    self._send_later([CURRENT_TIME, 1, int(time())], 0.)
+                else:
+                    logging.error('Simulator: unsupported message ' +
+                                  str(msg_id))
+                    return
+        except (EOFError, socket.error):
+            pass
+        finally:
+            self.alive = False
+            with self.schedule_cv:
+                self.schedule_cv.notify()
+            sim.unregister_client(self.client_id)
+
+    def _req_contract_data(self, sim):
+        (_, req_id, _, symbol, sec_type, expiry, strike, right, _, _, _, _,
+         _, _, _, _) = self._read_fields(16)
+        req_id = int(req_id)
+        chain = sim.chains.get(symbol)
+        if chain is None or sec_type != 'OPT':
+            self._error(req_id, 200, 'No security definition has been found '
+                        'for the request')
+            return
+        delay = sim.next_latency()
+        sent = 0
+        for c in chain.contracts:
+            if ((expiry and not c['expiry'].startswith(expiry)) or
+                    (strike and float(strike) and
+                     float(strike) != c['strike']) or
+                    (right and right != c['right'])):
+                continue
+            self._send_later(
+                [CONTRACT_DATA, 8, req_id, c['symbol'], 'OPT', c['expiry'],
+                 c['strike'], c['right'], 'SMART', 'USD', c['localSymbol'],
+                 c['symbol'], c['symbol'], c['conId'], 0.01, 100, '',
+                 'SMART', 1, 0, '', '', '', '', '', '', '', '', '', '', 0.,
+                 0], delay)
+            sent += 1
+        self._send_later([CONTRACT_DATA_END, 1, req_id], delay)
+        sim.count('contract_details', sent)
+
+    def _req_mkt_data(self, sim):
+        (_, req_id, _, symbol, sec_type, _, _, _, _, _, _, _,
+         local_symbol, _) = self._read_fields(14)
+        if self._read_field() not in ('', '0', 'False'):
+            self._read_fields(3)  # delta neutral contract
+        generic_ticks, snapshot = self._read_fields(2)
+        req_id = int(req_id)
+        snapshot = snapshot in ('1', 'True')
+        chain = sim.chains.get(symbol)
+        contract = (chain.by_local_symbol.get(local_symbol)
+                    if chain and sec_type == 'OPT' else None)
+        if chain is None or (sec_type == 'OPT' and contract is None):
+            self._error(req_id, 200, 'No security definition has been found '
+                        'for the request')
+            return
+        if sec_type == 'OPT' and random.random() < sim.ambiguous_rate:
+            self._error(req_id, 200, 'The contract description specified '
+                        'is ambiguous')
+            return
+        delay = sim.next_latency()
+        self._send_ticks(sim, req_id, chain, contract, generic_ticks, delay,
+                         0.)
+        if snapshot:
+            self._send_later([TICK_SNAPSHOT_END, 1, req_id], delay)
+        else:
+            self.subscriptions.add(req_id)
+            Thread(target=self._stream, args=(sim, req_id, chain, contract,
+                                              generic_ticks)).start()
+        sim.count('market_data', 1)
+
+    def _send_ticks(self, sim, req_id, chain, contract, generic_ticks, delay,
+                    jitter):
+        if contract is None:
+            # Stock: prices plus requested generic ticks
+            s = chain.price * (1. + jitter)
+            for field, value in [(1, s - 0.01), (2, s + 0.01), (9, s)]:
+                self._send_later([TICK_PRICE, 3, req_id, field,
+                                  round(value, 2), 100, 0], delay)
+            if generic_ticks and '106' in generic_ticks:
+                self._send_later([TICK_GENERIC, 1, req_id, 24, chain.iv],
+                                 delay)
+            if generic_ticks and '104' in generic_ticks:
+                self._send_later([TICK_GENERIC, 1, req_id, 23,
+                                  chain.iv * 0.9], delay)
+            return
+        q = chain.quote(contract, jitter)
+        for field in [1, 2, 9]:
+            self._send_later([TICK_PRICE, 3, req_id, field,
+                              q[{1: 'bid', 2: 'ask', 9: 'close'}[field]],
+                              1, 0], delay)
+        for field in [10, 11, 13]:
+            self._send_later([TICK_OPTION_COMPUTATION, 6, req_id, field,
+                              q['iv'], q['delta'], q['price'], 0.,
+                              min(q['gamma'], 1.), min(q['vega'], 1.),
+                              max(q['theta'], -1.), q['s']], delay)
+
+    def _stream(self, sim, req_id, chain, contract, generic_ticks):
+        '''
+        Keeps sending random walk updates for a subscription until it is
+        cancelled
+        '''
+        jitter = 0.
+        while self.alive and req_id in self.subscriptions:
+            sleep(sim.stream_interval)
+            jitter += random.gauss(0., 0.001)
+            self._send_ticks(sim, req_id, chain, contract, generic_ticks, 0.,
+                             jitter)
+
+
+class IBSimulator(object):
+    '''
+    Local IB server with synthetic option chains
+    inputs:
+        tickers -> list of tickers to be served
+        port -> listening port (0 picks a free one)
+        n_expiries -> number of (weekly) expiries per ticker
+        n_strikes -> number of strikes per expiry
+        latency -> mean response latency in seconds
+        ambiguous_rate -> fraction of option market data requests answered
+            with error 200
+        stream_interval -> seconds between ticks of market data subscriptions
+    '''
+
+    def __init__(self, tickers, port=0, n_expiries=8, n_strikes=40,
+                 latency=0.05, ambiguous_rate=0., stream_interval=1.):
+        self.latency = latency
+        self.ambiguous_rate = ambiguous_rate
+        self.stream_interval = stream_interval
+        today = datetime.today().replace(hour=0, minute=0, second=0,
+                                         microsecond=0)
+        self.chains = {}
+        for i, ticker in enumerate(tickers):
+            rnd = random.Random(ticker)
+            self.chains[ticker] = SyntheticChain(
+                ticker, round(rnd.uniform(20, 300)), rnd.uniform(0.1, 0.4),
+                n_expiries, n_strikes, today, 100000000 * (i + 1))
+        self.clients = set()
+        self.counters = {'contract_details': 0, 'market_data': 0}
+        self.lock = Lock()
+        SocketServer.ThreadingTCPServer.allow_reuse_address = True
+        self.server = SocketServer.ThreadingTCPServer(
+            ('localhost', port), _SimulatorHandler)
+        self.server.daemon_threads = True
+        self.server.simulator = self
+        self.port = self.server.server_address[1]
+        self.thread = None
+
+    def start(self):
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        logging.info('IB simulator listening on port ' + str(self.port))
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def next_latency(self):
+        '''
+        Returns a random response latency around the configured mean
+        '''
+        return random.expovariate(1. / self.latency) if self.latency else 0.
+
+    def register_client(self, client_id):
+        with self.lock:
+            if client_id in self.clients:
+                return False
+            self.clients.add(client_id)
+            return True
+
+    def unregister_client(self, client_id):
+        with self.lock:
+            self.clients.discard(client_id)
+
+    def count(self, counter, n):
+        with self.lock:
+            self.counters[counter] += n
+
+    def n_contracts(self):
+        return sum(len(c.contracts) for c in self.chains.values())
+
+
+def run_benchmark(tickers, n_expiries, n_strikes, latency, max_msgs_per_sec,
+                  max_lines, max_tickers):
+    '''
+    Downloads the synthetic chains of given tickers through IB_API and
+    returns a dict with the results of the benchmark
+    '''
+    from ib_api import IB_API
+    simulator = IBSimulator(tickers, n_expiries=n_expiries,
+                            n_strikes=n_strikes, latency=latency)
+    simulator.start()
+    event = Event()
+    ib = IB_API(event, port=simulator.port, client_id=0,
+                max_msgs_per_sec=max_msgs_per_sec, max_lines=max_lines,
+                max_tickers=max_tickers)
+    ib.start()
+    if not ib.wait_connected():
+        raise RuntimeError('Client id 0 is already in use')
+    start = time()
+    ib.download_chains(tickers)
+    latencies = {}
+    for _ in tickers:
+        ticker, ticker_latency = ib.completed.get()
+        latencies[ticker] = ticker_latency
+    elapsed = time() - start
+    contracts = sum(len(ib.opt_chain[t]) for t in tickers)
+    ib.stop()
+    simulator.stop()
+    return {'contracts': contracts, 'seconds': elapsed,
+            'contracts_per_sec': contracts / elapsed,
+            'latencies': latencies}
+
+
+if __name__ == '__main__':
+    # Configure the command line options
+    parser = ArgumentParser()
+    parser.add_argument('-t', '--tickers', nargs='+',
+                        default=['SPY', 'QQQ', 'IWM', 'DIA'],
+                        help='Tickers to be simulated')
+    parser.add_argument('-x', '--expiries', type=int, default=4,
+                        help='Number of expiries per ticker')
+    parser.add_argument('-s', '--strikes', type=int, default=20,
+                        help='Number of strikes per expiry')
+    parser.add_argument('-l', '--latency', type=float, default=0.05,
+                        help='Mean server response latency in seconds')
+    parser.add_argument('-r', '--rate', type=float, default=50,
+                        help='Maximum messages per second sent by IB_API')
+    parser.add_argument('-m', '--max_lines', type=int, default=100,
+                        help='Maximum simultaneous market data requests')
+    parser.add_argument('-n', '--max_tickers', type=int, default=5,
+                        help='Maximum tickers downloaded concurrently')
+    parser.add_argument('-p', '--port', type=int,
+                        help='Only run the simulator on given port')
+    args = parser.parse_args()
+
+    if args.port:
+        sim = IBSimulator(args.tickers, port=args.port,
+                          n_expiries=args.expiries, n_strikes=args.strikes,
+                          latency=args.latency)
+        print('Serving ' + str(sim.n_contracts()) + ' contracts on port ' +
+              str(sim.port))
+        sim.server.serve_forever()
+    else:
+        results = run_benchmark(args.tickers, args.expiries, args.strikes,
+                                args.latency, args.rate, args.max_lines,
+                                args.max_tickers)
+        print(str(results['contracts']) + ' contracts in ' +
+              '{0:.2f}'.format(results['seconds']) + ' s: ' +
+              '{0:.1f}'.format(results['contracts_per_sec']) +
+              ' contracts/s')
+        for ticker, latency in sorted(results['latencies'].items()):
+            print('  ' + ticker + ': ' + '{0:.2f}'.format(latency) + ' s')
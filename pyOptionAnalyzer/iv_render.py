@@ -0,0 +1,219 @@
+'''
+Headless batch rendering of IV surfaces. Figures are drawn straight on Agg
+canvases (no pyplot, so no display is needed), every worker process reuses
+its figures across tickers, and the tickers of a watchlist are rendered in
+parallel. The files written are listed in a JSON manifest at the output
+directory.
+'''
+from argparse import ArgumentParser
+from datetime import datetime
+from multiprocessing import Pool
+import json
+import logging
+import os
+import numpy as np
+import pandas as pd
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from mpl_toolkits.mplot3d import Axes3D  # noqa: registers the 3d projection
+import iv_solver
+import vol_surface
+from chain_store import open_chain_source
+
+# Kinds of plots that can be rendered
+KINDS = ('contour', 'surface')
+DEFAULT_DPI = 150
+MANIFEST_FILE = 'manifest.json'
+# Points per axis of the fitted surface grid
+SURFACE_POINTS = 50
+
+# Renderer of the current process, reused across tickers
+_renderer = None
+
+
+def days_to_expiration(dataframe, date=None):
+    '''
+    Returns an array with the days to expiration of every contract of an
+    option chain, parsing each distinct expiry once
+    date -> [Optional] date when the quotes were taken (default today)
+    '''
+    date = date if date else datetime.today()
+    date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    expiries = pd.to_datetime(dataframe['m_expiry'].astype(str),
+                              format='%Y%m%d')
+    return (expiries - date).dt.days.values
+
+
+def contour_data(dataframe, date=None):
+    '''
+    Returns the (days to expiration, strike, IV) arrays of the contracts of
+    an option chain with a valid IV (mean of the bid and ask IVs)
+    '''
+    iv = dataframe[['bid_impliedVolatility', 'ask_impliedVolatility']].apply(
+        pd.to_numeric, errors='coerce').mean(axis=1).values
+    days = days_to_expiration(dataframe, date)
+    strikes = pd.to_numeric(dataframe['m_strike'], errors='coerce').values
+    valid = ((iv > 0) & (iv < iv_solver.MAX_IV) & (days > 0) &
+             np.isfinite(strikes))
+    return days[valid], strikes[valid], iv[valid]
+
+
+class SurfaceRenderer(object):
+    '''
+    Renders IV plots to PNG files, keeping a figure per kind of plot which
+    is cleared and reused for every ticker
+    '''
+
+    def __init__(self, dpi=DEFAULT_DPI):
+        self.dpi = dpi
+        self.figures = {}
+
+    def _figure(self, kind):
+        '''
+        Returns the cleared figure of the given kind
+        '''
+        if kind not in self.figures:
+            figure = Figure()
+            FigureCanvasAgg(figure)
+            self.figures[kind] = figure
+        self.figures[kind].clf()
+        return self.figures[kind]
+
+    def contour(self, ticker, dataframe, path, date=None):
+        '''
+        Renders the contour of the quoted IVs (days to expiration x strike)
+        '''
+        days, strikes, iv = contour_data(dataframe, date)
+        figure = self._figure('contour')
+        ax = figure.add_subplot(111)
+        contour = ax.tricontourf(days, strikes, iv, 50, cmap='OrRd')
+        figure.colorbar(contour, ax=ax)
+        ax.set_xlabel('Days to expiration')
+        ax.set_ylabel('Strike price')
+        ax.set_title(ticker + ' IV surface')
+        figure.savefig(path, dpi=self.dpi)
+
+    def surface(self, ticker, surface, path):
+        '''
+        Renders a fitted VolSurface in 3D
+        '''
+        days = np.linspace(surface.t[0], surface.t[-1], SURFACE_POINTS) * 365
+        strikes = np.linspace(0.7 * surface.s, 1.3 * surface.s,
+                              SURFACE_POINTS)
+        x, y = np.meshgrid(days, strikes)
+        figure = self._figure('surface')
+        ax = figure.add_subplot(111, projection='3d')
+        ax.plot_surface(x, y, surface(y, x / 365.), linewidth=0,
+                        cmap='winter', shade=True)
+        ax.set_xlabel('Days to expiration')
+        ax.set_ylabel('Strike price')
+        ax.set_zlabel('IV')
+        ax.set_title(ticker + ' IV surface')
+        figure.savefig(path, dpi=self.dpi)
+
+
+def _render_ticker(job):
+    '''
+    Renders the plots of a ticker (process pool worker) and returns the list
+    of manifest entries
+    '''
+    global _renderer
+    source, ticker, snapshot, kinds, out_dir, dpi, r = job
+    if _renderer is None or _renderer.dpi != dpi:
+        _renderer = SurfaceRenderer(dpi)
+    chain_source = open_chain_source(source)
+    if snapshot is None:
+        # Time to expiration must be counted from the snapshot date
+        snapshot = chain_source.snapshots(ticker)[-1]
+    date = datetime.strptime(snapshot, '%Y%m%d')
+
+    entries = []
+    for kind in kinds:
+        path = os.path.join(out_dir, ticker + '_' + snapshot + '_' + kind +
+                            '.png')
+        entry = {'ticker': ticker, 'snapshot': snapshot, 'kind': kind}
+        try:
+            if kind == 'contour':
+                _renderer.contour(ticker, chain_source.load(ticker, snapshot),
+                                  path, date)
+            else:
+                _renderer.surface(ticker, vol_surface.get_surface(
+                    source, ticker, snapshot, r=r), path)
+            entry['file'] = os.path.basename(path)
+        except Exception, e:
+            logging.error('Could not render ' + ticker + ' ' + kind + ': ' +
+                          str(e))
+            entry['error'] = str(e)
+        entries.append(entry)
+    return entries
+
+
+def render_tickers(source, tickers, out_dir, kinds=KINDS, snapshot=None,
+                   dpi=DEFAULT_DPI, r=0.01, processes=None):
+    '''
+    Renders the IV plots of several tickers, one ticker per process when
+    processes > 1, and writes the manifest. Returns the manifest entries
+    inputs:
+        source -> excel file or chain store directory
+        tickers -> list of tickers to be rendered
+        out_dir -> directory where the PNG files and the manifest are written
+        kinds -> kinds of plots to be rendered ('contour', 'surface')
+        snapshot -> [Optional] snapshot date as YYYYMMDD (default latest)
+        dpi -> resolution of the PNG files
+        r -> interest rate on a 3-month U.S. Treasury bill or similar
+        processes -> [Optional] number of worker processes
+    '''
+    for kind in kinds:
+        if kind not in KINDS:
+            raise ValueError('Unknown kind of plot: ' + str(kind))
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    jobs = [(source, t, snapshot, kinds, out_dir, dpi, r) for t in tickers]
+    if processes and processes > 1:
+        pool = Pool(processes)
+        results = pool.map(_render_ticker, jobs)
+        pool.close()
+        pool.join()
+    else:
+        results = [_render_ticker(job) for job in jobs]
+
+    entries = [entry for result in results for entry in result]
+    manifest = {'created': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'source': source, 'dpi': dpi, 'files': entries}
+    with open(os.path.join(out_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return entries
+
+
+if __name__ == '__main__':
+    # Configure the command line options
+    parser = ArgumentParser()
+    parser.add_argument('-i', '--input', type=str, required=True,
+                        help=('[Required] Uses an excel file (.xlsx) or a '
+                              'chain store directory as input'))
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help='[Required] Directory where plots are written')
+    parser.add_argument('-t', '--tickers', nargs='+',
+                        help='Tickers to be rendered (default all)')
+    parser.add_argument('-k', '--kinds', nargs='+', default=list(KINDS),
+                        help='Plots to be rendered (contour and/or surface)')
+    parser.add_argument('-d', '--date', type=str, help=('Snapshot date. Use '
+                        'format YYYYMMDD (default latest)'))
+    parser.add_argument('--dpi', type=int, default=DEFAULT_DPI,
+                        help='Resolution of the PNG files')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='Number of worker processes')
+    parser.add_argument('--risk_free_rate', type=float, default=0.01,
+                        help='Risk free interest rate (default 0.01)')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, filename='iv_render.log',
+        format='%(asctime)s - %(levelname)s - %(message)s')
+    tickers = (args.tickers if args.tickers
+               else open_chain_source(args.input).tickers())
+    entries = render_tickers(args.input, tickers, args.output, args.kinds,
+                             args.date, args.dpi, args.risk_free_rate,
+                             args.processes)
+    print(str(len([e for e in entries if 'file' in e])) + ' files written, ' +
+          str(len([e for e in entries if 'error' in e])) + ' errors')
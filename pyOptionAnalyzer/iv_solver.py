@@ -0,0 +1,142 @@
+'''
+Vectorized implied volatility solver. It inverts the Black-Scholes formula of
+bs_engine for whole option chains at once, using Newton-Raphson steps
+safeguarded by bisection, so every contract converges (or is flagged) within
+a bounded number of iterations.
+'''
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import bs_engine
+
+# Implied volatility search bounds (as sigma)
+MIN_IV = 1e-4
+MAX_IV = 5.
+
+
+def implied_volatility(price, flag, s, k, t, r, tol=1e-8, max_iter=100):
+    '''
+    Returns a tuple (iv, converged) of arrays with the implied volatility for
+    each given option price, and whether the solver converged for it. Prices
+    which are missing, non-positive or out of the no-arbitrage bounds are not
+    solved: their IV is NaN and they are flagged as not converged
+    inputs:
+        price -> option prices
+        flag -> 'c' for calls, 'p' for puts (or an array of them)
+        s -> underlying price
+        k -> strike price
+        t -> time to expiration in years
+        r -> risk free interest rate
+        tol -> absolute tolerance on the option price
+        max_iter -> maximum number of iterations
+    '''
+    price, s, k, t, r = np.broadcast_arrays(
+        np.asarray(price, dtype=float), np.asarray(s, dtype=float),
+        np.asarray(k, dtype=float), np.asarray(t, dtype=float),
+        np.asarray(r, dtype=float))
+    flag = np.broadcast_to(bs_engine.is_call(flag), price.shape)
+    flag = np.where(flag, 'c', 'p')
+
+    # Prices must lie between the lowest and the highest BS values
+    lower = bs_engine.black_scholes(flag, s, k, t, r, MIN_IV)
+    upper = bs_engine.black_scholes(flag, s, k, t, r, MAX_IV)
+    with np.errstate(invalid='ignore'):
+        solvable = ((price > 0) & (t > 0) & (price >= lower) &
+                    (price <= upper))
+
+    iv = np.full(price.size, np.nan)
+    converged = np.zeros(price.size, dtype=bool)
+    shape = price.shape
+    # Work on flat copies of the solvable entries only
+    idx = np.flatnonzero(solvable)
+    price, flag, s, k, t, r = [a.ravel()[idx]
+                               for a in (price, flag, s, k, t, r)]
+    lo = np.full(idx.shape, MIN_IV)
+    hi = np.full(idx.shape, MAX_IV)
+    # Brenner-Subrahmanyam approximation as starting point
+    sigma = np.clip(np.sqrt(2. * np.pi / t) * price / s, MIN_IV, MAX_IV)
+    active = np.arange(idx.size)
+
+    for _ in range(max_iter):
+        if not active.size:
+            break
+        res = bs_engine.greeks(flag[active], s[active], k[active], t[active],
+                               r[active], sigma[active])
+        diff = res['price'] - price[active]
+        done = np.abs(diff) < tol
+        # Shrink the bracket around the root
+        lo[active] = np.where(diff < 0, sigma[active], lo[active])
+        hi[active] = np.where(diff > 0, sigma[active], hi[active])
+        # Newton step (vega is given per 1% of volatility), falling back to
+        # bisection whenever the step leaves the bracket
+        vega = res['vega'] * 100.
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            newton = sigma[active] - diff / vega
+        inside = (newton > lo[active]) & (newton < hi[active])
+        sigma[active] = np.where(done, sigma[active], np.where(
+            inside, newton, 0.5 * (lo[active] + hi[active])))
+        converged_now = active[done]
+        iv[idx[converged_now]] = sigma[converged_now]
+        converged[idx[converged_now]] = True
+        active = active[~done]
+
+    return iv.reshape(shape), converged.reshape(shape)
+
+
+def solve_chain(df, underlying_price, r, date=None, tol=1e-8, max_iter=100):
+    '''
+    Returns a copy of the given option chain with the bid, ask and midprice
+    implied volatilities solved for every contract (columns bid_iv, ask_iv
+    and mid_iv), plus a boolean column per quote flagging whether the solver
+    converged (bid_iv_converged, ask_iv_converged and mid_iv_converged)
+    inputs:
+        df -> option chain DataFrame (bid, ask, m_strike, m_expiry and
+            m_right columns are required)
+        underlying_price -> underlying price, either a number or the name of
+            a column of df with the underlying price of each row
+        r -> interest rate on a 3-month U.S. Treasury bill or similar
+        date -> [Optional] date when the quotes were taken (default today)
+        tol -> absolute tolerance on the option price
+        max_iter -> maximum number of solver iterations
+    '''
+    df = df.copy()
+    date = date if date else datetime.today()
+    date = date.replace(hour=0, minute=0, second=0, microsecond=0)
+    s = (pd.to_numeric(df[underlying_price], errors='coerce').values
+         if isinstance(underlying_price, basestring) else underlying_price)
+    k = pd.to_numeric(df['m_strike'], errors='coerce').values
+    expiries = pd.to_datetime(df['m_expiry'].astype(str), format='%Y%m%d')
+    t = (expiries - date).dt.days.values / 365.
+    flag = df['m_right'].astype(str).str.lower().values
+    bid = pd.to_numeric(df['bid'], errors='coerce').values
+    ask = pd.to_numeric(df['ask'], errors='coerce').values
+    # IB quotes -1 when there is no bid/ask, so midprice needs both sides
+    with np.errstate(invalid='ignore'):
+        mid = np.where((bid > 0) & (ask > 0), (bid + ask) / 2., np.nan)
+
+    # Solve the three quotes of every contract in a single call
+    iv, converged = implied_volatility(
+        np.vstack([bid, ask, mid]), flag, s, k, t, r, tol=tol,
+        max_iter=max_iter)
+    for i, quote in enumerate(['bid', 'ask', 'mid']):
+        df[quote + '_iv'] = iv[i]
+        df[quote + '_iv_converged'] = converged[i]
+    return df
+
+
+def fill_missing_iv(df, underlying_price, r, date=None):
+    '''
+    Returns a copy of the given option chain where the IB implied volatility
+    columns (bid_impliedVolatility and ask_impliedVolatility) missing in the
+    snapshot are filled with the solved ones. Inputs as in solve_chain
+    '''
+    solved = solve_chain(df, underlying_price, r, date)
+    for quote in ['bid', 'ask']:
+        column = quote + '_impliedVolatility'
+        if column not in solved:
+            solved[column] = np.nan
+        solved[column] = pd.to_numeric(solved[column], errors='coerce')
+        # IB also uses values out of range to flag missing computations
+        missing = solved[column].isnull() | (solved[column] <= 0)
+        solved.loc[missing, column] = solved.loc[missing, quote + '_iv']
+    return solved
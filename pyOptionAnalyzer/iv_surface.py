@@ -1,12 +1,14 @@
 import pandas as pd
 import numpy as np
-from datetime import datetime
 from mpl_toolkits.mplot3d import Axes3D
 import matplotlib.pyplot as plt
 import matplotlib.tri as mtri
 import matplotlib.mlab as mlab
 from matplotlib import cm
 import seaborn as sns
+from calendar_scanner import underlying_price
+from iv_render import days_to_expiration
+from vol_surface import VolSurface
 sns.set(style='darkgrid')
 sns.set(color_codes=True)
 
@@ -16,7 +18,8 @@ def plot_iv_surface(dataframe):
     This function plots the implied volatility surface and returns it as PNG
     '''
     dataframe = dataframe[dataframe['m_expiry'] < 20170000]
-    dataframe['iv'] = dataframe['bid_impliedVolatility'] + dataframe['ask_impliedVolatility']
+    dataframe['iv'] = (dataframe['bid_impliedVolatility'] +
+                       dataframe['ask_impliedVolatility']) / 2.
     dataframe = dataframe.dropna()
     dataframe = dataframe[dataframe['iv'] < 1]
 
@@ -46,42 +49,50 @@ def plot_iv_surface(dataframe):
     return png_file
     
     
-def plot_iv_surface2(dataframe):
+def plot_iv_surface2(dataframe, date, r=0.01, method='svi'):
     '''
-    This function plots the implied volatility surface and returns it as PNG. 
-    Least squares fit of Chebyshev will be applied.
+    This function plots the fitted implied volatility surface (see
+    vol_surface) and returns it as PNG
+    inputs:
+        dataframe -> option chain of a single ticker
+        date -> datetime when the chain was downloaded (see
+            chain_store.excel_snapshot for excel files)
+        r -> interest rate on a 3-month U.S. Treasury bill or similar
+        method -> smile fitting method, 'svi' or 'spline'
     '''
-    dataframe = dataframe[dataframe['m_expiry'] < 20170000]
-    dataframe['iv'] = dataframe['bid_impliedVolatility'] + dataframe['ask_impliedVolatility']
-    dataframe = dataframe.dropna()
-    dataframe = dataframe[dataframe['iv'] < 1]
-    #TODO Filter by open interest. How to get that data?
+    s = underlying_price(dataframe)
+    surface = VolSurface.fit(dataframe, s, r, date, method)
+
+    days = np.linspace(surface.t[0], surface.t[-1], 50) * 365
+    strike = np.linspace(0.7 * s, 1.3 * s, 50)
+    X, Y = np.meshgrid(days, strike)
+    Z = surface(Y, X / 365.)
 
-    t = dataframe['m_expiry']
-    #t = pd.to_datetime(dataframe['m_expiry'], format='%Y%m%d')
-    strike = dataframe['m_strike']
-    iv = dataframe['iv']
-    
-    X,Y = np.meshgrid(t, strike)
-    XX = X.flatten()
-    YY = Y.flatten()
-    
     fig = plt.figure()
     ax = fig.gca(projection='3d')
-    
-    
-def iv_contour(dataframe):
+    ax.plot_surface(X, Y, Z, linewidth=0, cmap=cm.winter, shade=True)
+    ax.set_xlabel('Days to expiration')
+    ax.set_ylabel('Strike price')
+    ax.set_zlabel('IV')
+
+    ticker = str(dataframe['m_symbol'].iloc[0])
+    plt.title(ticker + ' IV surface')
+    png_file = ticker + '_ivsurf.png'
+    plt.show()
+    return png_file
+
+
+def iv_contour(dataframe, dpi=1200):
     # Filtering
     dataframe = dataframe.dropna()
     dataframe = dataframe[dataframe['m_expiry'] < 20170000]
-    dataframe['iv'] = dataframe['bid_impliedVolatility'] + dataframe['ask_impliedVolatility']
+    dataframe['iv'] = (dataframe['bid_impliedVolatility'] +
+                       dataframe['ask_impliedVolatility']) / 2.
     dataframe = dataframe[dataframe['iv'] < 200]
     #TODO Need to filter out those with no open interest
     
     # Getting data
-    dataframe['days_to_exp'] = dataframe.apply(lambda row: (datetime.strptime(str(row['m_expiry']), '%Y%m%d') -
-        datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
-        ).days, axis=1)
+    dataframe['days_to_exp'] = days_to_expiration(dataframe)
     x = dataframe['days_to_exp']
     y = dataframe['m_strike']
     z = dataframe['iv']
@@ -97,7 +108,7 @@ def iv_contour(dataframe):
     plt.title(ticker + ' IV surface')
     #plt.show()
     png_file = ticker + '_ivsurf.png'
-    plt.savefig(png_file, dpi=1200)
+    plt.savefig(png_file, dpi=dpi)
     
 
 def plot_iv_vs_strikes(t, dataframe):
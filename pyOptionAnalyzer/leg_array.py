@@ -0,0 +1,265 @@
+'''
+Compact array-backed container of option legs. Every leg is a record of a
+NumPy structured array (strike, expiry ordinal, right, amount, multiplier
+and the bid/ask prices, IV and greeks), so a whole option chain is converted
+once and the legs of candidate strategies are slices of it instead of lists
+of Option objects. Shifting the IV returns a view sharing the same records,
+and the legs are still accessible as Option-like objects (Leg) wherever an
+Option is expected.
+'''
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from option import Option
+
+# Ordinal of the NumPy datetime64 epoch
+EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+# Bid/ask pairs of every leg, named as Option attributes
+PAIR_FIELDS = ['bid_ask', 'implied_volatility', 'delta', 'gamma', 'theta',
+               'vega']
+
+# Record of a leg. Prices and greeks not available are NaN
+LEG_DTYPE = np.dtype(
+    [('strike', np.float64), ('expiry', np.int32), ('right', 'U1'),
+     ('amount', np.float64), ('multiplier', np.float64),
+     ('debit', np.float64)] +
+    [(side + '_' + field, np.float64) for field in PAIR_FIELDS
+     for side in ['bid', 'ask']])
+
+# Option chain columns of every leg field
+CHAIN_COLUMNS = [
+    ('strike', 'm_strike'), ('multiplier', 'm_multiplier'),
+    ('bid_bid_ask', 'bid'), ('ask_bid_ask', 'ask'),
+    ('bid_implied_volatility', 'bid_impliedVolatility'),
+    ('ask_implied_volatility', 'ask_impliedVolatility')] + [
+    (side + '_' + greek, side + '_' + greek)
+    for greek in ['delta', 'gamma', 'theta', 'vega']
+    for side in ['bid', 'ask']]
+
+
+class LegArray(object):
+    '''
+    Legs of a strategy (or of a whole option chain) as a structured array
+    '''
+    __slots__ = ('ticker', 'data', 'iv_change')
+
+    def __init__(self, data, ticker=None, iv_change=1.):
+        '''
+        data -> structured array of LEG_DTYPE records
+        ticker -> [Optional] underlying of the legs
+        iv_change -> factor applied to the IV of every leg
+        '''
+        self.ticker = ticker
+        self.data = data
+        self.iv_change = iv_change
+
+    @classmethod
+    def from_options(cls, options_list):
+        '''
+        Constructor from a list of Options
+        '''
+        data = np.zeros(len(options_list), dtype=LEG_DTYPE)
+        for row, opt in zip(data, options_list):
+            row['strike'] = opt.strike
+            row['expiry'] = opt.expiration.toordinal()
+            row['right'] = opt.right
+            row['amount'] = opt.amount
+            row['multiplier'] = float(opt.multiplier)
+            row['debit'] = opt.debit if opt.debit else np.nan
+            for field in PAIR_FIELDS:
+                row['bid_' + field], row['ask_' + field] = getattr(
+                    opt, field)
+        return cls(data, options_list[0].ticker if options_list else None)
+
+    @classmethod
+    def from_chain(cls, df, amounts=1, ticker=None):
+        '''
+        Constructor from an option chain DataFrame, with a leg per row
+        inputs:
+            df -> option chain (missing price or greek columns are NaN)
+            amounts -> amount of every leg (scalar or array)
+            ticker -> [Optional] underlying (default the m_symbol column)
+        '''
+        data = np.empty(len(df), dtype=LEG_DTYPE)
+        for field, column in CHAIN_COLUMNS:
+            data[field] = (pd.to_numeric(df[column], errors='coerce').values
+                           if column in df else np.nan)
+        expiries = pd.to_datetime(df['m_expiry'].astype(str),
+                                  format='%Y%m%d').values
+        data['expiry'] = (expiries.astype('datetime64[D]').astype(np.int64) +
+                          EPOCH_ORDINAL)
+        data['right'] = np.char.lower(np.asarray(df['m_right'], dtype=str))
+        data['amount'] = amounts
+        data['debit'] = np.nan
+        if ticker is None and len(df) and 'm_symbol' in df:
+            ticker = df['m_symbol'].iloc[0]
+        return cls(data, ticker)
+
+    def __getstate__(self):
+        # Needed to pickle a class with __slots__ (protocols 0 and 1)
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __iter__(self):
+        return (Leg(self, index) for index in range(len(self.data)))
+
+    def __getitem__(self, index):
+        '''
+        Returns a Leg for an integer index, or a LegArray for a slice (a
+        view) or an array of indices
+        '''
+        if isinstance(index, (int, np.integer)):
+            return Leg(self, index)
+        return LegArray(self.data[index], self.ticker, self.iv_change)
+
+    def shift_iv(self, iv_change):
+        '''
+        Returns a view of the legs with their IV multiplied by iv_change
+        (e.g. 1.03 for a 3% increment), sharing the same records
+        '''
+        return LegArray(self.data, self.ticker, self.iv_change * iv_change)
+
+    def with_amounts(self, amounts):
+        '''
+        Returns a copy of the legs with the given amounts (scalar or array)
+        '''
+        data = self.data.copy()
+        data['amount'] = amounts
+        return LegArray(data, self.ticker, self.iv_change)
+
+    @property
+    def strikes(self):
+        return self.data['strike']
+
+    @property
+    def flags(self):
+        return self.data['right']
+
+    @property
+    def size(self):
+        '''
+        Multiplier times amount of every leg
+        '''
+        return self.data['multiplier'] * self.data['amount']
+
+    @property
+    def debits(self):
+        '''
+        Debit paid per leg, or the bid-ask midpoint where it was not set
+        '''
+        return np.where(np.isnan(self.data['debit']),
+                        (self.data['bid_bid_ask'] +
+                         self.data['ask_bid_ask']) / 2.,
+                        self.data['debit'])
+
+    @property
+    def ivs(self):
+        '''
+        IV of every leg: ask IV if going long, bid IV if going short
+        '''
+        return self.iv_change * np.where(
+            self.data['amount'] > 0, self.data['ask_implied_volatility'],
+            self.data['bid_implied_volatility'])
+
+    @property
+    def expirations(self):
+        return [datetime.fromordinal(int(e)) for e in self.data['expiry']]
+
+    def arrays(self):
+        '''
+        Returns the tuple (flags, strikes, size, debits, expirations) used
+        by bs_engine to price the legs
+        '''
+        return (self.flags, self.strikes, self.size, self.debits,
+                self.expirations)
+
+
+def _pair_property(field):
+    '''
+    Returns a property with the (bid, ask) tuple of a leg field. Setting it
+    writes through to the record of the leg (e.g. streamed quotes)
+    '''
+    def getter(self):
+        row = self._legs.data[self._index]
+        pair = (float(row['bid_' + field]), float(row['ask_' + field]))
+        if field == 'implied_volatility':
+            pair = (pair[0] * self._legs.iv_change,
+                    pair[1] * self._legs.iv_change)
+        return pair
+
+    def setter(self, pair):
+        scale = (self._legs.iv_change if field == 'implied_volatility'
+                 else 1.)
+        for side, value in zip(['bid_', 'ask_'], pair):
+            self._legs.data[side + field][self._index] = value / scale
+    return property(getter, setter)
+
+
+class Leg(Option):
+    '''
+    View of a leg of a LegArray, usable wherever an Option is expected
+    '''
+    __slots__ = ('_legs', '_index')
+
+    def __init__(self, legs, index):
+        self._legs = legs
+        self._index = index
+
+    def __getstate__(self):
+        # The Option slots are properties of the LegArray records
+        return {'_legs': self._legs, '_index': self._index}
+
+    def _field(self, name):
+        return self._legs.data[name][self._index]
+
+    @property
+    def ticker(self):
+        return self._legs.ticker
+
+    @property
+    def strike(self):
+        return float(self._field('strike'))
+
+    @property
+    def expiration(self):
+        return datetime.fromordinal(int(self._field('expiry')))
+
+    @property
+    def right(self):
+        return str(self._field('right'))
+
+    @property
+    def amount(self):
+        # Amounts are stored as floats, so fractional ones are kept
+        amount = float(self._field('amount'))
+        return int(amount) if amount.is_integer() else amount
+
+    @property
+    def multiplier(self):
+        return float(self._field('multiplier'))
+
+    @property
+    def debit(self):
+        debit = float(self._field('debit'))
+        return None if np.isnan(debit) else debit
+
+    bid_ask = _pair_property('bid_ask')
+    implied_volatility = _pair_property('implied_volatility')
+    delta = _pair_property('delta')
+    gamma = _pair_property('gamma')
+    theta = _pair_property('theta')
+    vega = _pair_property('vega')
+
+    def get_copy(self, iv_change):
+        '''
+        Returns a view of this leg with an increment/decrement in IV (see
+        Option.get_copy). No record is copied
+        '''
+        return Leg(self._legs.shift_iv(iv_change), self._index)
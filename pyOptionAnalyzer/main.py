@@ -1,24 +1,29 @@
 from argparse import ArgumentParser
 from datetime import datetime
 from ib_api import IB_API
+from chain_filter import ChainFilter
+from chain_store import ChainStore, is_excel, open_chain_source
+from contract_cache import ContractCache
+from download_checkpoint import DownloadCheckpoint
+from mongo_writer import SnapshotWriter
 import pandas as pd
 import pymongo
 import smtplib
 import threading
-from time import sleep
 import traceback
 
+# Seconds to wait for the IB server to accept a client id
+CONNECT_TIMEOUT = 10.
 
-def load_from_excel(input_file, tickers):
+
+def load_chains(source, tickers):
     '''
-    This function reads option chain from given input excel file
-    input_file -> input file where the data will be imported from
-    tickers -> list of tickers to be loaded from the excel file
+    This function reads option chains from given excel file or chain store
+    source -> excel file or chain store directory
+    tickers -> list of tickers to be loaded
     '''
-    opt_chains = {}
-    for tick in tickers:
-        opt_chains[tick] = pd.ExcelFile(input_file).parse(tick)
-    return opt_chains
+    chain_source = open_chain_source(source)
+    return {tick: chain_source.load(tick) for tick in tickers}
 
 
 def save_to_excel(opt_chains, output_file):
@@ -63,11 +68,27 @@ if __name__ == "__main__":
                         'expiry date. Use format YYYYMM'))
     parser.add_argument('-s', '--strike', help='Determines option strike')
     parser.add_argument('-i', '--input', type=str,
-                        help='Uses an excel file as input')
+                        help=('Uses an excel file (.xlsx) or a chain store '
+                              'directory as input'))
     parser.add_argument('-o', '--output', type=str,
-                        help='Uses an excel file as output')
+                        help=('Uses an excel file (.xlsx) or a chain store '
+                              'directory as output'))
     parser.add_argument('-m', '--mongo', type=str,
                         help='Stores output data in given MongoDB database')
+    parser.add_argument('-n', '--max_tickers', type=int, default=5,
+                        help='Number of tickers downloaded concurrently')
+    parser.add_argument('-l', '--max_lines', type=int, default=100,
+                        help='Number of simultaneous market data requests')
+    parser.add_argument('-c', '--checkpoint', type=str,
+                        help=('Directory where the download progress is '
+                              'saved, to resume it if the run dies'))
+    parser.add_argument('-d', '--details_cache', type=str,
+                        help=('Directory where the option contracts are '
+                              'cached between runs'))
+    parser.add_argument('-f', '--filter', type=str,
+                        help=('Only downloads the contracts within the '
+                              'given bands, e.g. moneyness=0.8:1.2,'
+                              'delta=0.05:0.95,dte=60,rights=CP'))
     parser.add_argument('-e', '--toaddr', type=str,
                         help='E-mail where error alarms are sent to')
     parser.add_argument('-p', '--emailpass', type=str,
@@ -76,9 +97,9 @@ if __name__ == "__main__":
     args = parser.parse_args()
     df_option_chains = None
 
-    # If input excel file was given, load data
+    # If input excel file or chain store was given, load data
     if args.input:
-        df_option_chains = load_from_excel(args.input, args.tickers)
+        df_option_chains = load_chains(args.input, args.tickers)
     else:
         # Check if MongoDB server is accessible if mongo flag is on before
         # asking the IB server for any data
@@ -91,6 +112,7 @@ if __name__ == "__main__":
                 raise SystemExit
 
         # Connection thread
+        writer = None
         try:
             client_id = 0
             ib = None
@@ -99,81 +121,80 @@ if __name__ == "__main__":
             # one free id
             while True:
                 try:
-                    ib = IB_API(client_id=client_id, event=event)
+                    ib = IB_API(client_id=client_id, event=event,
+                                max_lines=args.max_lines,
+                                max_tickers=args.max_tickers)
                     ib.start()
-                    sleep(1)
-                    # Check if client_id is currently in use
-                    if ib.thread_exception_msg:
-                        client_id += 1
-                    else:
-                        break
                 except Exception, e:
                     print('Error while connecting to IB API: ' + str(e))
-
-            # Connected!
-            ib.get_option_contracts(args.tickers)
-            event.wait()  # Wait for the IB thread to finish
-            event.clear()
-            for ticker in args.tickers:
-                ib.get_stock_implied_volatility(ticker, True)
-                event.wait()
-                event.clear()
+                    continue
+                # Wait until the server accepts the client_id or answers
+                # that it is currently in use
+                if ib.wait_connected(CONNECT_TIMEOUT):
+                    break
+                client_id += 1
+
+            # Option chains are written to MongoDB in the background while
+            # the remaining tickers download
+            if args.mongo and not args.output:
+                con = pymongo.MongoClient('localhost:27017')
+                writer = SnapshotWriter(con[args.mongo])
+                writer.start()
+            today = datetime.now().replace(
+                hour=0, minute=0, second=0, microsecond=0)
+
+            # Connected! Download all the tickers concurrently, reporting
+            # each one as soon as it finishes
+            checkpoint = (DownloadCheckpoint(args.checkpoint)
+                          if args.checkpoint else None)
+            contract_cache = (ContractCache(args.details_cache)
+                              if args.details_cache else None)
+            chain_filter = (ChainFilter.parse(args.filter) if args.filter
+                            else None)
+            ib.download_chains(args.tickers, checkpoint, contract_cache,
+                               chain_filter)
+            for _ in args.tickers:
+                ticker, latency = ib.completed.get()
+                print(str(ticker) + ' downloaded in ' +
+                      '{0:.1f}'.format(latency) + ' s')
+                if writer:
+                    chain = ib.opt_chain[ticker].to_dataframe()
+                    print(str(ticker) + ' optchain size: ' + str(len(chain)))
+                    writer.save_ticker(ticker,
+                                       chain[chain['close'].notnull()],
+                                       ib.stk_data[ticker], today)
+
+            if checkpoint:
+                print(checkpoint.summary())
 
             if(len(ib.opt_chain) == 0):
                 print('Error, zero contracts retrieved')
             else:
-                # Store option chain in excel file
+                # Store option chain in excel file or chain store
                 if args.output:
-                    # Get option chains from the IB connection class
-                    df_option_chains = {t: pd.DataFrame(ib.opt_chain[t]).T
-                                        for t in args.tickers}
-
-                    # Get columns to be exported to excel file
-                    for key in ib.opt_chain[args.tickers[0]]:
-                        cols = ib.opt_chain[args.tickers[0]][key].keys()
-                        break
+                    # Get option chains from the IB connection class,
+                    # removing those option contracts without price
+                    df_option_chains = {}
                     for t in args.tickers:
-                        # Set column names
-                        df_option_chains[t] = df_option_chains[t][cols]
-                        # Remove those option contracts without price
-                        df_option_chains[t].dropna(subset=['close'])
+                        df = ib.opt_chain[t].to_dataframe()
+                        df_option_chains[t] = df.dropna(subset=['close'])
 
-                    # Save dataframe to Excel file
-                    save_to_excel(df_option_chains, args.output)
+                    # Save dataframe to Excel file or to the chain store
+                    if is_excel(args.output):
+                        save_to_excel(df_option_chains, args.output)
+                    else:
+                        ChainStore(args.output).save(df_option_chains)
                     print 'Successfully exported to ' + str(args.output)
-                elif args.mongo:
-                    # Store option chains in MongoDB database
-                    con = pymongo.MongoClient('localhost:27017')
-                    db = args.mongo
-                    today = datetime.now().replace(
-                        hour=0, minute=0, second=0, microsecond=0)
-
-                    for t in args.tickers:
-                        # Store underlyings close price and IV
-                        con[db]['underlyings'].insert(
-                            {'ticker': t,
-                             'last': ib.stk_data[t]['close'],
-                             'iv': ib.stk_data[t]['iv'],
-                             'timestamp': today})
-
-                        # Store option contracts
-                        print(str(t) + ' optchain size: ' +
-                              str(len(ib.opt_chain[t].keys())))
-                        if(len(ib.opt_chain[t].keys()) > 0):
-                            con[db]['options'].insert([
-                                {'ticker': t,
-                                 'contract_id': c['m_conId'],
-                                 'right': c['m_right'],
-                                 'strike': c['m_strike'],
-                                 'close': c['close'],
-                                 'expiry':
-                                 datetime.strptime(c['m_expiry'], '%Y%m%d'),
-                                 'multiplier': c['m_multiplier'],
-                                 'timestamp': today}
-                                for c in ib.opt_chain[t].values() if c['close']
-                            ])
-
+                elif writer:
+                    # Wait for the pending MongoDB writes
+                    writer.close()
+                    print('Stored ' + str(writer.n_docs) + ' documents (' +
+                          '{0:.0f}'.format(writer.docs_per_sec()) +
+                          ' docs/s, ' + str(writer.n_errors) + ' errors)')
                     print 'Successfully exported to Mongo database'
+                if checkpoint:
+                    # The run has been exported, nothing left to resume
+                    checkpoint.clear()
 
         except Exception, e:
             traceback.print_exc()
@@ -184,5 +205,8 @@ if __name__ == "__main__":
                 msg = 'Smartcondor auto data downloader error'
                 send_email_alert(from_addr, args.toaddr, args.emailpass, msg)
         finally:
+            if writer and writer.is_alive():
+                # Write the documents already queued, even on errors
+                writer.close()
             ib.stop()
             raise SystemExit
@@ -0,0 +1,258 @@
+'''
+Live streaming of market data. In streaming mode IB_API keeps its market
+data subscriptions open and writes every tick in place into the chain
+buffers, then publishes the changed fields here. Ticks are coalesced per
+contract within a time window, and every window the consumers get a single
+ChangeEvent per ticker with the contracts which changed, so they only
+recompute those. Two consumers are provided: RiskGraphUpdater keeps the legs
+of a risk graph engine up to date, and PositionMonitor keeps the P/L and
+greeks of a position.
+'''
+from threading import Event, Lock, Thread
+from time import time
+import logging
+import numpy as np
+
+# Default coalescing window, in seconds
+DEFAULT_WINDOW = 0.25
+# Chain buffer fields which change the price of an option
+PRICE_FIELDS = frozenset(['bid', 'ask'])
+
+
+class ChangeEvent(object):
+    '''
+    Changes of the chain of a ticker within a coalescing window
+    '''
+    __slots__ = ('ticker', 'contracts', 'underlying', 'n_ticks', 'time')
+
+    def __init__(self, ticker):
+        self.ticker = ticker
+        self.contracts = {}  # contract id -> set of changed fields
+        self.underlying = set()  # changed fields of the underlying
+        self.n_ticks = 0
+        self.time = None
+
+    def __str__(self):
+        return (self.ticker + ': ' + str(len(self.contracts)) +
+                ' contracts changed (' + str(self.n_ticks) + ' ticks)')
+
+
+class StreamPublisher(Thread):
+    '''
+    Collects the ticks published by IB_API and delivers them to the
+    registered consumers, coalesced per contract, once per window
+    '''
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        '''
+        window -> seconds during which the ticks of a contract are coalesced
+            into a single change
+        '''
+        super(StreamPublisher, self).__init__()
+        self.daemon = True
+        self.window = window
+        self.lock = Lock()
+        self.pending = {}  # ticker -> ChangeEvent being filled
+        self.consumers = []  # (callback, set of tickers or None)
+        self.stopped = Event()
+        self.n_ticks = 0
+        self.n_events = 0
+
+    def subscribe(self, callback, tickers=None):
+        '''
+        Registers a consumer
+        inputs:
+            callback -> callable receiving every ChangeEvent. It runs on the
+                publisher thread, so it should not block
+            tickers -> [Optional] list of tickers whose events are delivered
+                (default all)
+        '''
+        with self.lock:
+            self.consumers.append(
+                (callback, set(tickers) if tickers else None))
+
+    def unsubscribe(self, callback):
+        '''
+        Removes a registered consumer
+        '''
+        with self.lock:
+            self.consumers = [c for c in self.consumers if c[0] != callback]
+
+    def publish(self, ticker, contract_id, field):
+        '''
+        Records a tick. It is cheap, since the delivery happens at the end of
+        the window
+        inputs:
+            ticker -> underlying ticker
+            contract_id -> option contract id (local symbol), or None for a
+                tick of the underlying
+            field -> changed field of the chain buffer (or of the underlying)
+        '''
+        with self.lock:
+            event = self.pending.get(ticker)
+            if event is None:
+                event = self.pending[ticker] = ChangeEvent(ticker)
+            if contract_id is None:
+                event.underlying.add(field)
+            else:
+                fields = event.contracts.get(contract_id)
+                if fields is None:
+                    fields = event.contracts[contract_id] = set()
+                fields.add(field)
+            event.n_ticks += 1
+            self.n_ticks += 1
+
+    def flush(self):
+        '''
+        Delivers the pending events to the consumers. Returns the number of
+        events delivered
+        '''
+        with self.lock:
+            events, self.pending = self.pending, {}
+            consumers = list(self.consumers)
+        for event in events.values():
+            event.time = time()
+            for callback, tickers in consumers:
+                if tickers is not None and event.ticker not in tickers:
+                    continue
+                try:
+                    callback(event)
+                except Exception, e:
+                    logging.error('Stream consumer failed on ' +
+                                  str(event) + ': ' + str(e))
+        self.n_events += len(events)
+        return len(events)
+
+    def run(self):
+        '''
+        Thread runnable method
+        '''
+        logging.info('Streaming with a ' + str(self.window) + ' s window')
+        while not self.stopped.wait(self.window):
+            self.flush()
+        self.flush()
+
+    def stop(self):
+        '''
+        Delivers the pending events and stops the thread
+        '''
+        self.stopped.set()
+        if self.is_alive():
+            self.join()
+
+
+def refresh_option(option, chain, contract_id):
+    '''
+    Updates in place the quotes, IV and greeks of an Option with the current
+    values of its contract in a chain buffer. The values of a LegArray Leg
+    are written to its record
+    '''
+    def pair(field):
+        return (float(chain.get(contract_id, 'bid_' + field)),
+                float(chain.get(contract_id, 'ask_' + field)))
+
+    option.bid_ask = (float(chain.get(contract_id, 'bid')),
+                      float(chain.get(contract_id, 'ask')))
+    option.implied_volatility = pair('impliedVolatility')
+    option.delta = pair('delta')
+    option.gamma = pair('gamma')
+    option.theta = pair('theta')
+    option.vega = pair('vega')
+
+
+class RiskGraphUpdater(object):
+    '''
+    Stream consumer which keeps the options of a RiskGraphEngine up to date,
+    invalidating only the cached vectors of the legs whose contracts changed
+    '''
+
+    def __init__(self, engine, chain, contract_ids, callback=None):
+        '''
+        engine -> RiskGraphEngine whose options_list is updated in place
+        chain -> ChainBuffer of the underlying, updated by IB_API
+        contract_ids -> contract id (local symbol) of every leg of the engine
+        callback -> [Optional] called with the list of changed legs after
+            every update (e.g. to redraw the plot)
+        '''
+        self.engine = engine
+        self.chain = chain
+        self.legs = {}  # contract id -> legs of the engine
+        for leg, contract_id in enumerate(contract_ids):
+            self.legs.setdefault(contract_id, []).append(leg)
+        self.callback = callback
+
+    def __call__(self, event):
+        changed = []
+        for contract_id in set(event.contracts).intersection(self.legs):
+            for leg in self.legs[contract_id]:
+                refresh_option(self.engine.options_list[leg], self.chain,
+                               contract_id)
+                changed.append(leg)
+        if changed:
+            self.engine.invalidate(changed)
+            if self.callback:
+                self.callback(changed)
+
+
+class PositionMonitor(object):
+    '''
+    Stream consumer which keeps the mark to market P/L and the greeks of a
+    position, revaluing only the legs whose contracts changed
+    '''
+    GREEKS = ('delta', 'gamma', 'theta', 'vega')
+
+    def __init__(self, chain, contract_ids, options_list, callback=None):
+        '''
+        chain -> ChainBuffer of the underlying, updated by IB_API
+        contract_ids -> contract id (local symbol) of every leg
+        options_list -> Option of every leg, whose debit (if set) is the
+            price paid when the position was established
+        callback -> [Optional] called with the monitor after every update
+        '''
+        self.chain = chain
+        self.contract_ids = list(contract_ids)
+        self.options_list = options_list
+        self.callback = callback
+        self.debits = np.array([opt.get_debit() for opt in options_list],
+                               dtype=float)
+        # Value of every leg: P/L followed by the greeks
+        self.values = np.zeros((len(options_list), 1 + len(self.GREEKS)))
+        self.legs = {}
+        for leg, contract_id in enumerate(self.contract_ids):
+            self.legs.setdefault(contract_id, []).append(leg)
+            self._revalue(leg)
+
+    def _revalue(self, leg):
+        '''
+        Updates the option of a leg from the chain and recomputes its values
+        '''
+        option = self.options_list[leg]
+        refresh_option(option, self.chain, self.contract_ids[leg])
+        size = option.amount * float(option.multiplier)
+        self.values[leg, 0] = size * (option.get_price(midprice=True) -
+                                      self.debits[leg])
+        self.values[leg, 1:] = [size * option.get_delta(),
+                                size * option.get_gamma(),
+                                size * option.get_theta(),
+                                size * option.get_vega()]
+
+    def __call__(self, event):
+        changed = [leg for contract_id in event.contracts
+                   for leg in self.legs.get(contract_id, [])]
+        for leg in changed:
+            self._revalue(leg)
+        if changed and self.callback:
+            self.callback(self)
+
+    def pnl(self):
+        '''
+        Returns the mark to market (bid-ask midpoint) P/L of the position.
+        It is NaN while any leg lacks a quote
+        '''
+        return self.values[:, 0].sum()
+
+    def greeks(self):
+        '''
+        Returns a dict with the position delta, gamma, theta and vega
+        '''
+        return dict(zip(self.GREEKS, self.values[:, 1:].sum(axis=0)))
@@ -0,0 +1,168 @@
+'''
+Bulk writer of option chain snapshots into MongoDB. Documents are upserted
+keyed on (ticker, contract_id, timestamp) for options and (ticker, timestamp)
+for underlyings, the fields indexed by mongo_loader.py, so storing the same
+snapshot twice overwrites it instead of duplicating it. Writes run on a
+background thread in unordered chunks, while the next ticker downloads.
+'''
+from threading import Lock, Thread
+from Queue import Queue
+from datetime import datetime
+from time import time
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+import numpy as np
+import logging
+
+# Maximum number of operations sent in a single bulk write
+DEFAULT_CHUNK_SIZE = 1000
+
+
+def _value(value):
+    '''
+    Converts NumPy scalars to Python types which BSON can encode, and NaN
+    to None
+    '''
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and np.isnan(value):
+        return None
+    return value
+
+
+def _mean_iv(bid_iv, ask_iv):
+    '''
+    Returns the mean of the bid and ask IVs, ignoring those IB did not
+    compute (NaN or out of range), or None if there is none
+    '''
+    valid = [float(iv) for iv in [bid_iv, ask_iv] if iv > 0]
+    return sum(valid) / len(valid) if valid else None
+
+
+def option_documents(ticker, chain, timestamp):
+    '''
+    Returns the list of documents to be stored for the options of a chain
+    ticker -> underlying ticker
+    chain -> option chain DataFrame, as returned by ChainBuffer.to_dataframe
+    timestamp -> snapshot timestamp
+    '''
+    return [{'ticker': ticker,
+             'contract_id': int(c.m_conId),
+             'right': c.m_right,
+             'strike': _value(c.m_strike),
+             'close': _value(c.close),
+             'bid': _value(c.bid),
+             'ask': _value(c.ask),
+             'iv': _mean_iv(c.bid_impliedVolatility, c.ask_impliedVolatility),
+             'expiry': datetime.strptime(str(c.m_expiry), '%Y%m%d'),
+             'multiplier': _value(c.m_multiplier),
+             'timestamp': timestamp}
+            for c in chain.itertuples()]
+
+
+def underlying_document(ticker, stk_data, timestamp):
+    '''
+    Returns the document to be stored for an underlying
+    stk_data -> dictionary with the underlying 'close' price and 'iv'
+    '''
+    return {'ticker': ticker,
+            'last': _value(stk_data['close']),
+            'iv': _value(stk_data['iv']),
+            'timestamp': timestamp}
+
+
+class SnapshotWriter(Thread):
+    '''
+    Thread which upserts the snapshot documents queued with save_ticker into
+    the underlyings and options collections of given database
+    '''
+
+    def __init__(self, db, chunk_size=DEFAULT_CHUNK_SIZE):
+        '''
+        db -> pymongo Database
+        chunk_size -> maximum number of operations per bulk write
+        '''
+        super(SnapshotWriter, self).__init__()
+        self.daemon = True
+        self.db = db
+        self.chunk_size = chunk_size
+        self.queue = Queue()
+        self.lock = Lock()
+        self.n_docs = 0
+        self.n_errors = 0
+        self.write_time = 0.
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            collection, keys, docs = item
+            try:
+                self._write(collection, keys, docs)
+            except Exception, e:
+                logging.error('Error writing to ' + collection + ': ' +
+                              str(e))
+                with self.lock:
+                    self.n_errors += len(docs)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, collection, keys, docs):
+        '''
+        Upserts the given documents in chunks of chunk_size operations. An
+        unordered bulk write goes on after a failed operation, so only the
+        failed documents are counted as errors
+        '''
+        for i in range(0, len(docs), self.chunk_size):
+            chunk = docs[i:i + self.chunk_size]
+            requests = [UpdateOne({k: doc[k] for k in keys}, {'$set': doc},
+                                  upsert=True) for doc in chunk]
+            start = time()
+            n_errors = 0
+            try:
+                self.db[collection].bulk_write(requests, ordered=False)
+            except BulkWriteError as bwe:
+                n_errors = len(bwe.details.get('writeErrors', []))
+                logging.warning(str(n_errors) + ' failed writes to ' +
+                                collection + ': ' +
+                                str(bwe.details['writeErrors'][:1]))
+            with self.lock:
+                self.write_time += time() - start
+                self.n_docs += len(chunk) - n_errors
+                self.n_errors += n_errors
+
+    def save(self, collection, keys, docs):
+        '''
+        Queues documents to be upserted into given collection
+        keys -> fields which identify a document
+        '''
+        if docs:
+            self.queue.put((collection, keys, docs))
+
+    def save_ticker(self, ticker, chain, stk_data, timestamp):
+        '''
+        Queues the snapshot of a ticker: underlying data and the options of
+        its chain
+        '''
+        self.save('underlyings', ['ticker', 'timestamp'],
+                  [underlying_document(ticker, stk_data, timestamp)])
+        self.save('options', ['ticker', 'contract_id', 'timestamp'],
+                  option_documents(ticker, chain, timestamp))
+
+    def close(self):
+        '''
+        Waits until every queued document has been written and stops the
+        thread
+        '''
+        self.queue.put(None)
+        self.join()
+
+    def docs_per_sec(self):
+        '''
+        Returns the write throughput, as documents written per second spent
+        in bulk writes
+        '''
+        with self.lock:
+            return self.n_docs / self.write_time if self.write_time else 0.
@@ -0,0 +1,183 @@
+'''
+Monte Carlo simulation of the P/L of option strategies managed with exit
+rules. Underlying paths follow a geometric brownian motion in daily steps,
+optionally with a stochastic IV (lognormal shocks correlated with the
+underlying returns), and every leg is revalued along each path with the
+vectorized Black-Scholes pricer. A path is closed at the first day its P/L
+reaches the profit target or the stop loss, or when the nearest leg gets
+to the given days to expiration, so the P/L distribution reflects the way
+calendars and diagonals are actually managed instead of their expiry curve.
+
+Paths are simulated in chunks with their own seed, so memory is bounded by
+the chunk size and the results only depend on the seed and the chunk size,
+not on the number of worker processes.
+'''
+from datetime import datetime
+from multiprocessing import Pool
+import numpy as np
+import bs_engine
+
+# Paths simulated at the same time (bounds the memory used)
+CHUNK_SIZE = 50000
+# Exit reasons, as stored in the 'reason' array of the results
+EXIT_REASONS = ('time', 'target', 'stop')
+TIME_EXIT, TARGET_EXIT, STOP_EXIT = range(len(EXIT_REASONS))
+# Percentiles of the P/L reported by summary
+PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def strategy_legs(strategy, iv, date):
+    '''
+    Returns a dict of arrays with the legs of a strategy, as needed by the
+    simulation (and cheap to send to the worker processes). Legs are priced
+    with their own IV, or with the underlying one where it is not available
+    inputs:
+        strategy -> Strategy to be simulated
+        iv -> implied volatility of the underlying (as sigma)
+        date -> datetime where the simulation starts
+    '''
+    flags, strikes, size, debits, expirations = bs_engine.leg_arrays(
+        strategy.options_list)
+    leg_iv = np.array([opt.get_iv() for opt in strategy], dtype=float)
+    leg_iv = np.where(np.isfinite(leg_iv) & (leg_iv > 0), leg_iv, iv)
+    return {'flags': flags, 'strikes': strikes, 'size': size,
+            'debits': debits, 'iv': leg_iv,
+            'days': np.array([(exp - date).days for exp in expirations],
+                             dtype=float),
+            'underlying_amount': float(strategy.underlying_amount)}
+
+
+def _simulate_chunk(job):
+    '''
+    Simulates a chunk of paths (process pool worker) and returns the arrays
+    (pnl, exit_day, reason)
+    '''
+    (legs, s, r, iv, drift, iv_vol, iv_corr, horizon, target, stop,
+     n_paths, seed) = job
+    rng = np.random.RandomState(seed)
+    dt = 1. / 365
+    log_s = np.full(n_paths, np.log(s))
+    iv_ratio = np.ones(n_paths)
+    pnl = np.zeros(n_paths)
+    exit_day = np.full(n_paths, horizon, dtype=np.int32)
+    reason = np.full(n_paths, TIME_EXIT, dtype=np.int8)
+    live = np.arange(n_paths)
+
+    for day in range(1, horizon + 1):
+        # Every path keeps drawing its shocks, so a path does not depend on
+        # the exits of the others
+        z = rng.standard_normal(n_paths)
+        sigma = iv * iv_ratio
+        log_s += (drift - 0.5 * sigma * sigma) * dt + sigma * np.sqrt(dt) * z
+        if iv_vol:
+            w = (iv_corr * z + np.sqrt(1. - iv_corr * iv_corr) *
+                 rng.standard_normal(n_paths))
+            iv_ratio *= np.exp(-0.5 * iv_vol * iv_vol * dt +
+                               iv_vol * np.sqrt(dt) * w)
+
+        # Revalue the legs of the open paths only (paths x legs)
+        price = np.exp(log_s[live])
+        values = bs_engine.black_scholes(
+            legs['flags'], price[:, np.newaxis], legs['strikes'],
+            (legs['days'] - day) / 365., r,
+            legs['iv'] * iv_ratio[live][:, np.newaxis])
+        value = ((legs['size'] * (values - legs['debits'])).sum(axis=1) +
+                 legs['underlying_amount'] * (price - s))
+        pnl[live] = value
+
+        # The stop loss is checked first, as the worst case of the day
+        done = np.zeros(len(live), dtype=bool)
+        if stop is not None:
+            done |= value <= -stop
+            reason[live[done]] = STOP_EXIT
+        if target is not None:
+            hit = ~done & (value >= target)
+            reason[live[hit]] = TARGET_EXIT
+            done |= hit
+        exit_day[live[done]] = day
+        live = live[~done]
+        if not len(live):
+            break
+    return pnl, exit_day, reason
+
+
+def simulate(strategy, s, r, iv, n_paths=100000, target=None, stop=None,
+             days_to_exit=0, max_days=None, iv_vol=0., iv_corr=0.,
+             drift=None, date=None, seed=None, chunk_size=CHUNK_SIZE,
+             processes=None):
+    '''
+    Returns a dict of arrays with the outcome of every simulated path: 'pnl'
+    (P/L when it is closed), 'exit_day' (days after date) and 'reason'
+    (index in EXIT_REASONS)
+    inputs:
+        strategy -> Strategy to be simulated
+        s -> current underlying price
+        r -> interest rate on a 3-month U.S. Treasury bill or similar
+        iv -> implied volatility of the underlying (as sigma)
+        n_paths -> number of paths to be simulated
+        target -> [Optional] profit target, as a fraction of the net debit
+            (or credit) of the strategy. E.g.: 0.25 closes at a 25% profit
+        stop -> [Optional] stop loss, as a fraction of the net debit (or
+            credit). E.g.: 0.5 closes when half of the debit is lost
+        days_to_exit -> closes the paths when the nearest leg has this many
+            days to expiration (default at its expiration)
+        max_days -> [Optional] maximum number of days the strategy is held
+        iv_vol -> volatility of the IV (annualized, as sigma of its log).
+            Zero keeps the IV constant
+        iv_corr -> correlation between the IV shocks and the underlying
+            returns (typically negative for equities)
+        drift -> [Optional] underlying drift (default r, risk neutral)
+        date -> [Optional] datetime where the simulation starts (default now)
+        seed -> [Optional] seed, for reproducible simulations
+        chunk_size -> paths simulated at the same time
+        processes -> [Optional] number of worker processes
+    '''
+    date = date if date else datetime.now()
+    legs = strategy_legs(strategy, iv, date)
+    horizon = int(legs['days'].min()) - days_to_exit
+    if max_days is not None:
+        horizon = min(horizon, max_days)
+    if horizon < 1:
+        raise ValueError('The strategy must be held at least one day')
+    premium = abs((legs['size'] * legs['debits']).sum())
+    target = target * premium if target is not None else None
+    stop = stop * premium if stop is not None else None
+    drift = r if drift is None else drift
+    if seed is None:
+        seed = np.random.randint(2 ** 31)
+
+    sizes = [min(chunk_size, n_paths - start)
+             for start in range(0, n_paths, chunk_size)]
+    jobs = [(legs, s, r, iv, drift, iv_vol, iv_corr, horizon, target, stop,
+             size, [seed, chunk]) for chunk, size in enumerate(sizes)]
+    if processes and processes > 1:
+        pool = Pool(processes)
+        chunks = pool.map(_simulate_chunk, jobs)
+        pool.close()
+        pool.join()
+    else:
+        chunks = [_simulate_chunk(job) for job in jobs]
+    pnl, exit_day, reason = zip(*chunks)
+    return {'pnl': np.concatenate(pnl),
+            'exit_day': np.concatenate(exit_day),
+            'reason': np.concatenate(reason)}
+
+
+def summary(results):
+    '''
+    Returns a dict with the statistics of a simulation: probability of
+    profit, mean, standard deviation and percentiles of the P/L, mean
+    holding days and the fraction of paths closed by each exit reason
+    results -> dict returned by simulate
+    '''
+    pnl = results['pnl']
+    stats = {'pop': float((pnl > 0).mean()),
+             'mean': float(pnl.mean()),
+             'std': float(pnl.std()),
+             'mean_days': float(results['exit_day'].mean())}
+    for p, value in zip(PERCENTILES, np.percentile(pnl, PERCENTILES)):
+        stats['p' + str(p)] = float(value)
+    counts = np.bincount(results['reason'], minlength=len(EXIT_REASONS))
+    for name, count in zip(EXIT_REASONS, counts):
+        stats[name] = float(count) / len(pnl)
+    return stats
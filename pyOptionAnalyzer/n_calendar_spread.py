@@ -1,3 +1,4 @@
+import bs_engine
 from strategy import Strategy
 
 
@@ -7,14 +8,16 @@ class NCalendarSpread(Strategy):
     '''
 
     def __init__(self, calendar_list):
-        Strategy.__init__(self, calendar_list, name='N Calendar Spread')
-
         # Check that calendar list is not empty
         if not calendar_list:
             raise ValueError(
                 'No calendars given to NCalendarSpread constructor')
         else:
             self.calendar_list = calendar_list
+        # The strategy is made of the options of every calendar
+        Strategy.__init__(
+            self, [opt for cal in calendar_list for opt in cal.options_list],
+            name='N Calendar Spread')
         # Check all given calendars have the same underlying
         fist_ticker = calendar_list[0].get_ticker()
         if not all(cal.get_ticker() == fist_ticker for cal in calendar_list):
@@ -38,8 +41,10 @@ class NCalendarSpread(Strategy):
     def __len__(self):
         return len(self.calendar_list)
 
-    def plot(self):
-        pass
-
-    def get_profit_probability(self):
-        pass
+    def plot(self, x_vector, date, r, iv):
+        '''
+        Creates a risk graph for the calendars as a whole. Inputs as in
+        CalendarSpread.plot
+        '''
+        return bs_engine.risk_graph(
+            self.options_list, x_vector, [date], r, iv)[0]
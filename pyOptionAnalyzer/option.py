@@ -1,13 +1,32 @@
 import pandas as pd
 from datetime import datetime
 from math import copysign
+from numbers import Number
 import copy
 
+# Expiration datetimes already parsed, by m_expiry value
+_expirations = {}
+
+
+def parse_expirations(expiries):
+    '''
+    Returns a list with the expiration datetime of every m_expiry value
+    (YYYYMMDD, as integer or string). Each distinct value is parsed only
+    once and kept in a cache
+    '''
+    expiries = list(expiries)
+    for expiry in set(expiries).difference(_expirations):
+        _expirations[expiry] = datetime.strptime(str(int(expiry)), '%Y%m%d')
+    return [_expirations[expiry] for expiry in expiries]
+
 
 class Option(object):
     '''
     This class implements an option object
     '''
+    __slots__ = ('ticker', 'strike', 'expiration', 'implied_volatility',
+                 'bid_ask', 'delta', 'gamma', 'theta', 'vega', 'multiplier',
+                 'right', 'amount', 'debit')
 
     def __init__(self, ticker, strike, expiration, implied_volatility, bid_ask,
                  delta, gamma, theta, vega, multiplier, right, amount=1):
@@ -45,11 +64,43 @@ class Option(object):
             df.bid_impliedVolatility.iloc[0], df.ask_impliedVolatility.iloc[0])
 
         return cls(df.m_symbol.iloc[0], df.m_strike.iloc[0],
-                   datetime.strptime(str(df.m_expiry.iloc[0]), '%Y%m%d'),
+                   parse_expirations(df.m_expiry.iloc[:1])[0],
                    implied_volatility, bid_ask, delta, gamma, theta, vega,
                    multiplier=df.m_multiplier.iloc[0],
                    right=df.m_right.iloc[0], amount=amount)
 
+    @classmethod
+    def from_chain(cls, df, amount=1):
+        '''
+        Bulk constructor from an option chain DataFrame: returns a list with
+        an Option per row, reading every column once
+        amount -> amount of every option (scalar or a sequence per row)
+        '''
+        if not isinstance(df, pd.DataFrame):
+            raise ValueError('Given argument is not a Pandas DataFrame')
+        amounts = ([amount] * len(df) if isinstance(amount, Number)
+                   else list(amount))
+
+        def pairs(bid, ask):
+            return zip(df[bid].tolist(), df[ask].tolist())
+
+        return [cls(*fields) for fields in zip(
+            df.m_symbol.tolist(), df.m_strike.tolist(),
+            parse_expirations(df.m_expiry.tolist()),
+            pairs('bid_impliedVolatility', 'ask_impliedVolatility'),
+            pairs('bid', 'ask'), pairs('bid_delta', 'ask_delta'),
+            pairs('bid_gamma', 'ask_gamma'), pairs('bid_theta', 'ask_theta'),
+            pairs('bid_vega', 'ask_vega'), df.m_multiplier.tolist(),
+            df.m_right.tolist(), amounts)]
+
+    def __getstate__(self):
+        # Needed to pickle a class with __slots__ (protocols 0 and 1)
+        return dict((name, getattr(self, name)) for name in Option.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def __str__(self):
         return(str(self.amount) + ' ' + str(self.ticker) +
                (' call ' if (self.right.upper() == 'C') else ' put ') +
@@ -124,7 +175,8 @@ class Option(object):
             iv_change: percentaje to increment/decrement the IV of the option.
                 E.g.: 1.03 for a 3% increment, 0.97 for a 3% decrement.
         '''
-        option_copy = copy.deepcopy(self)
+        # Every attribute is immutable, so the copy can share them
+        option_copy = copy.copy(self)
         option_copy.implied_volatility = (
             self.implied_volatility[0] * iv_change,
             self.implied_volatility[1] * iv_change)
@@ -1,10 +1,11 @@
 from argparse import ArgumentParser
-from option import Option
+from chain_index import ChainIndex
 from calendar_spread import CalendarSpread
 from make_selection import SelectionList
+from chain_store import open_chain_source
+from risk_engine import RiskGraphEngine
 from datetime import datetime, timedelta
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Button, Slider
 import sys
@@ -24,15 +25,21 @@ class RiskGraph(object):
     t_list -> dates to be plotted (in datetime)
     risk_free_rate -> interest rate on a 3-month U.S. Treasury bill or similar
     iv -> current underlying IV (as sigma)
+    debounce_ms -> slider changes are only redrawn once they stop for this
+        number of milliseconds
     '''
 
-    def __init__(self, strategy, risk_free_rate, iv):
+    def __init__(self, strategy, risk_free_rate, iv, debounce_ms=30):
         self.r = risk_free_rate
         self.strategy = strategy
         self.ticker = self.strategy.get_ticker()
 
         min_strike, max_strike = self.strategy.get_strike_bounds()
         self.x_vector = np.linspace(min_strike * 0.7, max_strike * 1.3, 500)
+        # Leg P/L vectors are cached so that only the changed legs are
+        # recomputed
+        self.engine = RiskGraphEngine(self.strategy.options_list,
+                                      self.x_vector)
         self.t = datetime.today()
         self.expiry_t = self.strategy.get_nearest_expiration()
         self.iv = iv
@@ -43,6 +50,11 @@ class RiskGraph(object):
         self.fig, self.ax = plt.subplots()
         self.fig.canvas.set_window_title('Calendar Spread Analyzer')
         plt.subplots_adjust(bottom=0.2)
+        # Single shot timer which applies the last slider change
+        self.redraw_timer = self.fig.canvas.new_timer(interval=debounce_ms)
+        self.redraw_timer.single_shot = True
+        self.redraw_timer.add_callback(self._redraw)
+        self.pending_updates = set()
 
         # First column: Connect button and list of options
         ax1 = plt.subplot2grid((12, 8), (0, 0), colspan=2)
@@ -70,8 +82,8 @@ class RiskGraph(object):
         # And finally, the plot
         plt.subplot2grid((12, 8), (0, 2), colspan=6, rowspan=9)
 
-        self.expiry_y = self._update_plot(self.expiry_t)
-        self.variable_y = self._update_plot(self.t)
+        self.expiry_y, self.variable_y = self._update_plot(
+            [self.expiry_t, self.t])
         self.var_line, = plt.plot(
             self.x_vector, self.variable_y, '-b', label='t')
         self.exp_line, = plt.plot(
@@ -86,34 +98,49 @@ class RiskGraph(object):
         plt.tight_layout()
         plt.show()
 
-    def _update_plot(self, plot_date):
+    def _update_plot(self, plot_dates):
         '''
-        Updates the plot with current scenario parameters
+        Updates the plot with current scenario parameters. Only the legs
+        whose days to expiration, IV or interest rate changed are priced
+        again
         '''
-        y = self.strategy.plot(self.x_vector, plot_date, self.r, self.iv)
-        return y
+        return self.engine.curves(plot_dates, self.r, self.iv)
+
+    def _schedule(self, update):
+        '''
+        Queues a plot update and restarts the debounce timer
+        '''
+        self.pending_updates.add(update)
+        self.redraw_timer.stop()
+        self.redraw_timer.start()
 
     def _update_time(self, val):
         '''
-        TODO
+        Date slider callback
         '''
-        self.t = self.expiry_t - timedelta(days=self.date_slider.val)
-        self.variable_y = self._update_plot(self.t)
-        self.var_line.set_ydata(self.variable_y)
-        self._update_results()
-        plt.draw()
+        self._schedule('time')
 
     def _update_iv(self, val):
         '''
-        TODO
+        IV slider callback
         '''
-        self.iv = self.iv_slider.val
-        self.expiry_y = self._update_plot(self.expiry_t)
-        self.variable_y = self._update_plot(self.t)
-        self.exp_line.set_ydata(self.expiry_y)
-        self.var_line.set_ydata(self.variable_y)
-        self._update_results()
-        plt.draw()
+        self._schedule('iv')
+
+    def _redraw(self):
+        '''
+        Applies the pending slider changes and redraws the plot
+        '''
+        updates, self.pending_updates = self.pending_updates, set()
+        if 'iv' in updates:
+            self.iv = self.iv_slider.val
+            self.expiry_y = self._update_plot([self.expiry_t])[0]
+            self.exp_line.set_ydata(self.expiry_y)
+        if updates:
+            self.t = self.expiry_t - timedelta(days=self.date_slider.val)
+            self.variable_y = self._update_plot([self.t])[0]
+            self.var_line.set_ydata(self.variable_y)
+            self._update_results()
+            self.fig.canvas.draw_idle()
 
     def _update_results(self):
         '''
@@ -123,7 +150,8 @@ class RiskGraph(object):
         self.max_gain_label.label.set_text(
             'Max gain: ' + str(max(self.expiry_y)))
         profit_prob = self.strategy.get_profit_probability(
-            self.x_vector, self.expiry_y, self.iv, self.s)
+            self.x_vector, self.expiry_y, self.iv, self.s, self.r,
+            (self.expiry_t - datetime.today()).days / 365.)
         self.profit_prob_label.label.set_text(
             'Prob. of profit: ' + '{0:.2f}'.format(100 * profit_prob) + '%')
 
@@ -132,13 +160,14 @@ if __name__ == "__main__":
     # Configure the command line options
     parser = ArgumentParser()
     parser.add_argument('-i', '--input', type=str, required=True,
-                        help='Uses an excel file as input')
+                        help=('Uses an excel file (.xlsx) or a chain store '
+                              'directory as input'))
     args = parser.parse_args()
 
-    # Load option chains from excel input file
-    excel_file = pd.ExcelFile(args.input)
-    # Get sheets names (tickers)
-    tickers = excel_file.sheet_names
+    # Load option chains from excel input file or chain store
+    chain_source = open_chain_source(args.input)
+    # Get available tickers
+    tickers = chain_source.tickers()
     # Let the user decide which ticker to analyze
     selectionList = SelectionList(tickers)
     selectionList.mainloop()
@@ -147,7 +176,7 @@ if __name__ == "__main__":
         selected_ticker = selectionList.selection
     else:
         sys.exit()
-    df = excel_file.parse(selected_ticker)
+    df = chain_source.load(selected_ticker)
 
     # Keep only calls or puts depending on the selection made
     df = df[df.m_right == 'C']  # TODO make this selectable
@@ -189,12 +218,8 @@ if __name__ == "__main__":
         sys.exit()
 
     # Create options from selected data
-    near_term_opt = Option.from_pandas(
-        df[(df['m_expiry'] == near_term) &
-           (df['m_strike'] == strike)], amount=-1)
-    next_term_opt = Option.from_pandas(
-        df[(df['m_expiry'] == next_term) &
-           (df['m_strike'] == strike)], amount=1)
+    near_term_opt, next_term_opt = ChainIndex(df).options(
+        [(near_term, strike, 'C'), (next_term, strike, 'C')], [-1, 1])
 
     calendar = CalendarSpread(near_term_opt, next_term_opt)
     risk_graph = RiskGraph(calendar, 0.01, 0.149)
@@ -0,0 +1,147 @@
+'''
+Probability of profit and expected value of option strategies at
+expiration, for any number of profit regions. The expiry P/L of every
+strategy is taken as piecewise linear between the points of its price grid
+(and linearly extrapolated beyond them), which allows integrating it in
+closed form against the lognormal distribution of the underlying price.
+Any other density can be supplied on a grid, and it is then integrated
+numerically. Every function works on many strategies at once.
+'''
+import numpy as np
+from scipy.special import ndtr
+
+
+def lognormal_params(s, r, iv, t):
+    '''
+    Returns (mu, sd) of the log of the underlying price at t years under the
+    risk neutral lognormal distribution
+    inputs:
+        s -> current underlying price
+        r -> interest rate on a 3-month U.S. Treasury bill or similar
+        iv -> implied volatility of the underlying (as sigma)
+        t -> time in years
+    '''
+    iv = np.asarray(iv, dtype=float)
+    t = np.asarray(t, dtype=float)
+    return (np.log(s) + (r - 0.5 * iv * iv) * t), iv * np.sqrt(t)
+
+
+def _lognormal_moments(x, mu, sd):
+    '''
+    Returns (P[S < x], E[S; S < x]) of a lognormal S, for x in [0, inf]
+    '''
+    with np.errstate(divide='ignore'):
+        z = (np.log(x) - mu) / sd
+    return ndtr(z), np.exp(mu + 0.5 * sd * sd) * ndtr(z - sd)
+
+
+def _segments(x, y):
+    '''
+    Returns the (lo, hi, alpha, beta) arrays of the linear pieces of the P/L,
+    P/L = alpha + beta * price within [lo, hi], including the tails
+    [0, x[0]] and [x[-1], inf] extrapolated from the first and last pieces
+    '''
+    x, y = np.broadcast_arrays(x, y)
+    beta = np.diff(y, axis=-1) / np.diff(x, axis=-1)
+    alpha = y[..., :-1] - beta * x[..., :-1]
+    # Extend the first and the last pieces over the tails
+    lo = np.concatenate([np.zeros_like(x[..., :1]), x], axis=-1)
+    hi = np.concatenate([x, np.full_like(x[..., :1], np.inf)], axis=-1)
+    alpha = np.concatenate([alpha[..., :1], alpha, alpha[..., -1:]],
+                           axis=-1)
+    beta = np.concatenate([beta[..., :1], beta, beta[..., -1:]], axis=-1)
+    return lo, hi, alpha, beta
+
+
+def _profit_range(lo, hi, alpha, beta):
+    '''
+    Returns the sub-interval [a, b] of every piece where the P/L is positive
+    (a == b where there is none)
+    '''
+    with np.errstate(divide='ignore', invalid='ignore'):
+        root = -alpha / beta
+    a = np.where(beta > 0, np.clip(root, lo, hi), lo)
+    b = np.where(beta < 0, np.clip(root, lo, hi), hi)
+    flat = beta == 0
+    a = np.where(flat, lo, a)
+    b = np.where(flat, np.where(alpha > 0, hi, lo), b)
+    return a, np.maximum(a, b)
+
+
+def expiry_statistics(x, y, s=None, r=None, iv=None, t=None, density=None):
+    '''
+    Returns a dict with the probability of profit ('pop') and the expected
+    value ('expected_value') of the expiry P/L of one or many strategies
+    inputs:
+        x -> grid of underlying prices, either shared (prices) or one per
+            strategy (strategies x prices). Must be increasing
+        y -> expiry P/L on the grid (prices, or strategies x prices)
+        s, r, iv, t -> lognormal distribution parameters (see
+            lognormal_params). iv and t may be arrays with a value per
+            strategy
+        density -> [Optional] tuple (prices, pdf) with any other density of
+            the underlying price at expiration, used instead of the lognormal
+    '''
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if density is not None:
+        return _numerical_statistics(x, y, density)
+
+    mu, sd = lognormal_params(s, r, iv, t)
+    if y.ndim > 1:
+        mu = np.broadcast_to(mu, y.shape[:-1])[..., np.newaxis]
+        sd = np.broadcast_to(sd, y.shape[:-1])[..., np.newaxis]
+    lo, hi, alpha, beta = _segments(x, y)
+    # Closed form integrals of the linear pieces against the lognormal
+    cdf_lo, mean_lo = _lognormal_moments(lo, mu, sd)
+    cdf_hi, mean_hi = _lognormal_moments(hi, mu, sd)
+    expected_value = (alpha * (cdf_hi - cdf_lo) +
+                      beta * (mean_hi - mean_lo)).sum(axis=-1)
+    a, b = _profit_range(lo, hi, alpha, beta)
+    pop = (_lognormal_moments(b, mu, sd)[0] -
+           _lognormal_moments(a, mu, sd)[0]).sum(axis=-1)
+    return {'pop': pop, 'expected_value': expected_value}
+
+
+def _interp(x, y, prices):
+    '''
+    Linear interpolation of y (prices along the last axis) at the given
+    prices, extrapolating the first and last pieces as the closed form does
+    '''
+    i = np.clip(np.searchsorted(x, prices), 1, len(x) - 1)
+    w = (prices - x[i - 1]) / (x[i] - x[i - 1])
+    return y[..., i - 1] * (1. - w) + y[..., i] * w
+
+
+def _numerical_statistics(x, y, density):
+    '''
+    Integrates the P/L against a density given on a grid (trapezoidal rule)
+    '''
+    prices, pdf = (np.asarray(v, dtype=float) for v in density)
+    weights = np.zeros_like(prices)
+    dx = np.diff(prices)
+    weights[:-1] += 0.5 * dx
+    weights[1:] += 0.5 * dx
+    weights *= pdf
+    # Normalize, so that the probability left out of the grid is ignored
+    weights /= weights.sum()
+    if x.ndim == 1:
+        y_d = _interp(x, y, prices)
+    else:
+        x, y = np.broadcast_arrays(x, y)
+        y_d = np.array([_interp(xi, yi, prices) for xi, yi in zip(
+            x.reshape(-1, x.shape[-1]), y.reshape(-1, y.shape[-1]))]).reshape(
+                y.shape[:-1] + prices.shape)
+    return {'pop': ((y_d > 0) * weights).sum(axis=-1),
+            'expected_value': (y_d * weights).sum(axis=-1)}
+
+
+def with_breakevens(x_vector, y_vector, breakevens):
+    '''
+    Returns (x, y) with the given breakevens inserted in the grid with zero
+    P/L, so that the profit regions are bounded exactly by them
+    '''
+    x = np.concatenate([x_vector, breakevens])
+    y = np.concatenate([y_vector, np.zeros(len(breakevens))])
+    x, index = np.unique(x, return_index=True)
+    return x, y[index]
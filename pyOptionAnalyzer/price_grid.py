@@ -0,0 +1,126 @@
+'''
+Adaptive grids of underlying prices for risk graphs and exact breakevens.
+Instead of evaluating a strategy on a dense fixed linspace, the grid starts
+coarse (plus the strikes, where the expiration payoff bends) and only the
+intervals where the P/L is not linear enough are split. Breakevens are then
+root-found inside every interval where the P/L changes sign, so they are
+accurate to a tolerance instead of to the grid spacing, and there can be any
+number of them.
+'''
+import numpy as np
+import bs_engine
+
+# Maximum number of root-finding iterations
+MAX_ITER = 100
+
+
+def default_bounds(options_list):
+    '''
+    Returns the (lower, upper) bounds used by the risk graphs: 30% below the
+    minimum strike and 30% above the maximum one
+    '''
+    strikes = [opt.strike for opt in options_list]
+    return min(strikes) * 0.7, max(strikes) * 1.3
+
+
+def adaptive_grid(options_list, dates, r, iv, bounds=None, n_initial=33,
+                  tol=None, max_points=2000):
+    '''
+    Returns a tuple (x_vector, y) with an adaptive grid of underlying prices
+    and the (dates x prices) P/L of the strategy on it. An interval is split
+    while the P/L at its midpoint (for any date) differs from the linear
+    interpolation of its ends by more than tol
+    inputs:
+        options_list -> list of Options composing the strategy
+        dates -> list of datetimes to be evaluated
+        r -> interest rate on a 3-month U.S. Treasury bill or similar
+        iv -> implied volatility of the underlying (as sigma)
+        bounds -> [Optional] (lower, upper) underlying prices
+        n_initial -> number of evenly spaced points to start with
+        tol -> [Optional] P/L tolerance (default 0.1% of the P/L range)
+        max_points -> maximum number of points of the grid
+    '''
+    lower, upper = bounds if bounds else default_bounds(options_list)
+    strikes = [opt.strike for opt in options_list
+               if lower < opt.strike < upper]
+    x = np.union1d(np.linspace(lower, upper, n_initial), strikes)
+    y = bs_engine.risk_graph(options_list, x, dates, r, iv)
+    if tol is None:
+        tol = 1e-3 * max(np.ptp(y), 1e-12)
+    min_width = 1e-9 * (upper - lower)
+
+    active = np.ones(len(x) - 1, dtype=bool)
+    while active.any() and len(x) < max_points:
+        # Evaluate the midpoints of the intervals to be checked at once
+        left = np.flatnonzero(active)
+        x_mid = 0.5 * (x[left] + x[left + 1])
+        y_mid = bs_engine.risk_graph(options_list, x_mid, dates, r, iv)
+        error = np.abs(y_mid - 0.5 * (y[:, left] + y[:, left + 1])).max(
+            axis=0)
+        split = (error > tol) & (x[left + 1] - x[left] > min_width)
+        if not split.any():
+            break
+        # Keep the worst intervals if the grid would grow too much
+        room = max_points - len(x)
+        if split.sum() > room:
+            split[np.argsort(-np.where(split, error, -1.))[room:]] = False
+        x = np.concatenate([x, x_mid[split]])
+        y = np.concatenate([y, y_mid[:, split]], axis=1)
+        is_new = np.concatenate([np.zeros(len(x) - split.sum(), dtype=bool),
+                                 np.ones(split.sum(), dtype=bool)])
+        order = np.argsort(x, kind='mergesort')
+        x, y, is_new = x[order], y[:, order], is_new[order]
+        # Only the halves of the split intervals are checked again
+        active = is_new[:-1] | is_new[1:]
+    return x, y
+
+
+def find_breakevens(options_list, date, r, iv, x_vector=None, y_vector=None,
+                    xtol=1e-6):
+    '''
+    Returns the sorted array of underlying prices where the P/L of the
+    strategy at the given date is zero. Every sign change of the P/L along
+    the grid is root-found (Illinois method, all roots at once) until it is
+    bracketed within xtol
+    inputs:
+        options_list -> list of Options composing the strategy
+        date -> datetime to be evaluated
+        r -> interest rate on a 3-month U.S. Treasury bill or similar
+        iv -> implied volatility of the underlying (as sigma)
+        x_vector -> [Optional] grid of underlying prices. An adaptive grid is
+            used by default
+        y_vector -> [Optional] P/L on x_vector at the given date
+        xtol -> absolute tolerance on the breakevens
+    '''
+    def pl(x):
+        return bs_engine.risk_graph(options_list, x, [date], r, iv)[0]
+
+    if x_vector is None:
+        x_vector, y = adaptive_grid(options_list, [date], r, iv)
+        y_vector = y[0]
+    x_vector = np.asarray(x_vector, dtype=float)
+    y_vector = pl(x_vector) if y_vector is None else np.asarray(
+        y_vector, dtype=float)
+
+    exact = x_vector[y_vector == 0]
+    brackets = np.flatnonzero(y_vector[:-1] * y_vector[1:] < 0)
+    a, b = x_vector[brackets], x_vector[brackets + 1]
+    fa, fb = y_vector[brackets], y_vector[brackets + 1]
+    for _ in range(MAX_ITER):
+        live = np.abs(b - a) > xtol
+        if not live.any():
+            break
+        with np.errstate(divide='ignore', invalid='ignore'):
+            c = np.where(live, (a * fb - b * fa) / (fb - fa), b)
+        c = np.where(np.isfinite(c), c, 0.5 * (a + b))
+        fc = pl(c)
+        # Exact hits collapse the bracket
+        hit = live & (fc == 0)
+        a, b = np.where(hit, c, a), np.where(hit, c, b)
+        # Illinois step: the end which stays twice gets its value halved
+        flip = live & ~hit & (fc * fb < 0)
+        stay = live & ~hit & ~flip
+        a, fa = np.where(flip, b, a), np.where(flip, fb, np.where(
+            stay, 0.5 * fa, fa))
+        b, fb = np.where(live & ~hit, c, b), np.where(live & ~hit, fc, fb)
+    return np.sort(np.concatenate([exact, 0.5 * (a + b)]))
@@ -0,0 +1,102 @@
+'''
+Incremental risk graph engine for interactive plots. The P/L vector of every
+leg is cached, keyed by its own inputs (days to expiration, IV and interest
+rate), so moving a slider only recomputes the legs whose inputs changed,
+and streamed quotes only invalidate the legs whose contracts ticked.
+Legs which have already expired only contribute their intrinsic value, which
+does not depend on the date, IV or interest rate.
+'''
+from collections import OrderedDict
+import numpy as np
+import bs_engine
+
+# Leg vectors kept in the cache
+DEFAULT_CACHE_SIZE = 256
+
+
+class RiskGraphEngine(object):
+    '''
+    Computes the risk graph of a strategy on a fixed grid of underlying
+    prices, caching the P/L vector of each leg
+    '''
+
+    def __init__(self, options_list, x_vector, cache_size=DEFAULT_CACHE_SIZE):
+        '''
+        options_list -> list of Options composing the strategy
+        x_vector -> vector of underlying prices
+        cache_size -> maximum number of leg vectors kept in the cache
+        '''
+        self.options_list = options_list
+        self.x_vector = np.asarray(x_vector, dtype=float)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        '''
+        Empties the cache (e.g. after changing the debit of any leg)
+        '''
+        self.cache.clear()
+
+    def invalidate(self, legs):
+        '''
+        Drops the cached vectors of the given legs (e.g. after their quotes
+        or debits changed), keeping the ones of the other legs
+        legs -> list of leg positions in options_list
+        '''
+        legs = set(legs)
+        for key in [k for k in self.cache if k[0] in legs]:
+            del self.cache[key]
+
+    def _key(self, leg, date, r, iv):
+        '''
+        Returns the cache key of a leg: the expired legs do not depend on the
+        scenario, the live ones on their whole days to expiration, IV and r
+        '''
+        days = (self.options_list[leg].expiration - date).days
+        return (leg, 'expired') if days <= 0 else (leg, days, iv, r)
+
+    def leg_curves(self, date, r, iv):
+        '''
+        Returns a (legs x prices) array with the P/L of each leg at the
+        given date, computing only the legs missing in the cache
+        inputs:
+            date -> datetime to be evaluated
+            r -> interest rate on a 3-month U.S. Treasury bill or similar
+            iv -> implied volatility of the underlying (as sigma)
+        '''
+        keys = [self._key(leg, date, r, iv)
+                for leg in range(len(self.options_list))]
+        missing = [leg for leg, key in enumerate(keys)
+                   if key not in self.cache]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            # Price every missing leg in a single batched call
+            curves = bs_engine.risk_graph_by_leg(
+                [self.options_list[leg] for leg in missing], self.x_vector,
+                [date], r, iv)[0]
+            for leg, curve in zip(missing, curves):
+                self.cache[keys[leg]] = curve
+        y = np.empty((len(keys), len(self.x_vector)))
+        for leg, key in enumerate(keys):
+            # Mark as most recently used
+            y[leg] = self.cache[key] = self.cache.pop(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return y
+
+    def curve(self, date, r, iv):
+        '''
+        Returns the P/L of the whole strategy at the given date. Inputs as in
+        leg_curves
+        '''
+        return self.leg_curves(date, r, iv).sum(axis=0)
+
+    def curves(self, dates, r, iv):
+        '''
+        Returns a (dates x prices) array with the P/L of the whole strategy,
+        as bs_engine.risk_graph does
+        '''
+        return np.array([self.curve(date, r, iv) for date in dates])
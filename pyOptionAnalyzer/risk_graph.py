@@ -1,4 +1,5 @@
-import vollib.black_scholes as bs
+import bs_engine
+import price_grid
 from datetime import datetime
 import numpy as np
 import matplotlib.pyplot as plt
@@ -8,7 +9,7 @@ sns.set(color_codes=True)
 
 
 def plot_risk_graph(options_list, t_list, risk_free_rate, iv, show_plot=False,
-                    save_png=False):
+                    save_png=False, adaptive=False):
     '''
     Creates a risk graph for the combination of options provided
     in the input list of options for the different times to
@@ -22,6 +23,9 @@ def plot_risk_graph(options_list, t_list, risk_free_rate, iv, show_plot=False,
     iv -> implied volatility of underlying
     show_plot -> determines if the plot is shown in a window (default False)
     save_png -> determines if the plot is saved as a PNG file (default False)
+    adaptive -> evaluates the risk graph on an adaptive grid of prices,
+        refined where the P/L bends, instead of on 500 evenly spaced prices
+        (default False)
     returns:
         list of tuples (x, (datetime, y))
     '''
@@ -35,26 +39,23 @@ def plot_risk_graph(options_list, t_list, risk_free_rate, iv, show_plot=False,
         if (max_strike is None) or (opt.strike > max_strike):
             max_strike = opt.strike
 
-    # Prices
-    x_vector = np.linspace(min_strike * 0.7, max_strike * 1.3, 500)
+    # Prices. Evaluate every date and leg at once
+    if adaptive:
+        x_vector, y = price_grid.adaptive_grid(
+            options_list, t_list, risk_free_rate, iv / 100.,
+            bounds=(min_strike * 0.7, max_strike * 1.3))
+    else:
+        x_vector = np.linspace(min_strike * 0.7, max_strike * 1.3, 500)
+        y = bs_engine.risk_graph(options_list, x_vector, t_list,
+                                 risk_free_rate, iv / 100.)
 
     # Now plot the risk graph for the different time values provided
     return_values = []
-    y = []
-    for t in t_list:
-        y.append(np.zeros(len(x_vector)))
-        # Create the discrete values of P/L to plot against xrange
-        for opt in options_list:
-            t_exp = (opt.expiration - t).days / 365.
-            y[-1] += np.array([opt.multiplier * opt.amount * (
-                bs.black_scholes(opt.right, x, opt.strike, t_exp,
-                                 risk_free_rate, iv / 100.) -
-                opt.get_debit()) for x in x_vector])
-
+    for t, y_t in zip(t_list, y):
         # Get the number of days to expiration from today for plot's legend
         days_to_expire = (options_list[0].expiration - t).days
-        plt.plot(x_vector, y[-1], label='t: ' + str(days_to_expire))
-        return_values.append((t, y[-1]))
+        plt.plot(x_vector, y_t, label='t: ' + str(days_to_expire))
+        return_values.append((t, y_t))
 
     plt.legend()
     plt.xlabel('Price')
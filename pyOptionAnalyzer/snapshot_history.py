@@ -0,0 +1,209 @@
+'''
+Time-series access to the daily snapshots stored in MongoDB by main.py -m.
+History queries are range scans on the compound indexes created by
+mongo_loader.py, (timestamp, ticker) for underlyings and (timestamp, ticker,
+contract_id) for options: the time window bounds the scan, and documents are
+read in index order with only the requested fields. Series are returned as
+NumPy arrays aligned on a common timestamp axis (NaN where a contract was not
+quoted), and recent windows can be kept in a local cache.
+'''
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from time import time
+import hashlib
+import logging
+import os
+import numpy as np
+from pymongo import ASCENDING, DESCENDING
+
+# Index orders of the collections, as created by mongo_loader.py
+UNDERLYINGS_SORT = [('timestamp', DESCENDING), ('ticker', ASCENDING)]
+OPTIONS_SORT = [('timestamp', DESCENDING), ('ticker', ASCENDING),
+                ('contract_id', ASCENDING)]
+# Default history window, in days
+DEFAULT_DAYS = 90
+# Windows kept in memory and their time to live, in seconds
+DEFAULT_CACHE_SIZE = 128
+DEFAULT_CACHE_TTL = 3600
+
+
+def _as_float(values):
+    '''
+    Returns a float array where missing values (None) are NaN
+    '''
+    return np.array([np.nan if v is None else v for v in values], dtype=float)
+
+
+class SnapshotHistory(object):
+    '''
+    History of the underlyings and options collections of a snapshot
+    database
+    '''
+
+    def __init__(self, db, cache_size=DEFAULT_CACHE_SIZE,
+                 cache_ttl=DEFAULT_CACHE_TTL, cache_dir=None):
+        '''
+        db -> pymongo Database written by mongo_writer
+        cache_size -> windows kept in memory (0 disables the cache)
+        cache_ttl -> seconds a window is kept in memory, so that windows
+            including the latest snapshot get refreshed
+        cache_dir -> [Optional] directory where closed windows (ending before
+            today, so they cannot change) are also stored as .npz files
+        '''
+        self.db = db
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache_dir = cache_dir
+        self.cache = OrderedDict()
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    @staticmethod
+    def _window(start, end, days):
+        '''
+        Returns the (start, end) datetimes of a query. By default the window
+        is open ended (end None, up to the latest snapshot) and starts days
+        back from today's midnight, so it keeps the same cache key all day
+        long and the cache TTL decides when it is read again
+        '''
+        if not start:
+            start = (end if end else datetime.now().replace(
+                hour=0, minute=0, second=0, microsecond=0)) - timedelta(
+                    days=days)
+        return start, end
+
+    @staticmethod
+    def _condition(start, end):
+        '''
+        Returns the MongoDB condition on the timestamp of a window
+        '''
+        condition = {'$gte': start}
+        if end:
+            condition['$lte'] = end
+        return condition
+
+    def _cache_path(self, key):
+        digest = hashlib.md5(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest + '.npz')
+
+    def _cached(self, key, end, query):
+        '''
+        Returns the dict of arrays of a window from the cache, or runs the
+        query and caches its result
+        '''
+        if key in self.cache:
+            stored, arrays = self.cache.pop(key)
+            if time() - stored < self.cache_ttl:
+                self.cache[key] = (stored, arrays)
+                return arrays
+        closed = end is not None and end < datetime.now().replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        path = self._cache_path(key) if self.cache_dir and closed else None
+        if path and os.path.isfile(path):
+            with np.load(path) as f:
+                arrays = dict(f.items())
+        else:
+            arrays = query()
+            if path:
+                np.savez(path, **arrays)
+        if self.cache_size:
+            self.cache[key] = (time(), arrays)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return arrays
+
+    def underlying(self, ticker, start=None, end=None, days=DEFAULT_DAYS,
+                   fields=('last', 'iv')):
+        '''
+        Returns a dict with the 'timestamp' array (ascending, datetime64) and
+        an array per requested field of the underlying snapshots of a ticker
+        inputs:
+            ticker -> underlying ticker
+            start, end -> [Optional] datetimes bounding the window (default
+                the last days up to the latest snapshot)
+            days -> window length when start is not given
+            fields -> fields of the underlyings documents to be read
+        '''
+        start, end = self._window(start, end, days)
+        key = ('underlyings', ticker, start, end, tuple(fields))
+
+        def query():
+            docs = list(self.db.underlyings.find(
+                {'timestamp': self._condition(start, end), 'ticker': ticker},
+                dict((f, 1) for f in ('timestamp',) + tuple(fields)),
+                sort=UNDERLYINGS_SORT))[::-1]
+            arrays = {'timestamp': np.array(
+                [d['timestamp'] for d in docs], dtype='datetime64[ms]')}
+            for field in fields:
+                arrays[field] = _as_float([d.get(field) for d in docs])
+            return arrays
+
+        return self._cached(key, end, query)
+
+    def contract_ids(self, ticker, right, strike, expiry, start=None,
+                     end=None, days=DEFAULT_DAYS):
+        '''
+        Returns the sorted list of contract ids quoted within the window for
+        the given right, strike and expiry (datetime) of a ticker
+        '''
+        start, end = self._window(start, end, days)
+        return sorted(self.db.options.find(
+            {'timestamp': self._condition(start, end), 'ticker': ticker,
+             'right': right.upper(), 'strike': float(strike),
+             'expiry': expiry}).distinct('contract_id'))
+
+    def contracts(self, ticker, contract_ids, start=None, end=None,
+                  days=DEFAULT_DAYS, fields=('iv', 'bid', 'ask', 'close')):
+        '''
+        Returns a dict with the 'timestamp' array (ascending, datetime64),
+        the 'contract_id' array and a (timestamps x contracts) array per
+        requested field, aligned with NaN where a contract was not quoted.
+        Other inputs as in underlying
+        '''
+        start, end = self._window(start, end, days)
+        contract_ids = sorted(int(c) for c in contract_ids)
+        key = ('options', ticker, tuple(contract_ids), start, end,
+               tuple(fields))
+
+        def query():
+            docs = list(self.db.options.find(
+                {'timestamp': self._condition(start, end), 'ticker': ticker,
+                 'contract_id': {'$in': contract_ids}},
+                dict((f, 1) for f in ('timestamp', 'contract_id') +
+                     tuple(fields)),
+                sort=OPTIONS_SORT))
+            timestamps = np.unique(np.array(
+                [d['timestamp'] for d in docs], dtype='datetime64[ms]'))
+            rows = np.searchsorted(timestamps, np.array(
+                [d['timestamp'] for d in docs], dtype='datetime64[ms]'))
+            columns = np.searchsorted(contract_ids, np.array(
+                [d['contract_id'] for d in docs], dtype=np.int64))
+            arrays = {'timestamp': timestamps,
+                      'contract_id': np.array(contract_ids, dtype=np.int64)}
+            for field in fields:
+                values = np.full((len(timestamps), len(contract_ids)), np.nan)
+                values[rows, columns] = _as_float([d.get(field)
+                                                   for d in docs])
+                arrays[field] = values
+            return arrays
+
+        logging.info('Reading ' + ticker + ' history of ' +
+                     str(len(contract_ids)) + ' contracts')
+        return self._cached(key, end, query)
+
+    def contract(self, ticker, right, strike, expiry, start=None, end=None,
+                 days=DEFAULT_DAYS, fields=('iv', 'bid', 'ask', 'close')):
+        '''
+        Returns the history of a contract given by its right, strike and
+        expiry (datetime), as a dict with the 'timestamp' array and an array
+        per requested field. Other inputs as in underlying
+        '''
+        start, end = self._window(start, end, days)
+        ids = self.contract_ids(ticker, right, strike, expiry, start, end)
+        if len(ids) > 1:
+            logging.warning(ticker + ' ' + str(strike) + right + ' has ' +
+                            str(len(ids)) + ' contract ids, using ' +
+                            str(ids[0]))
+        arrays = self.contracts(ticker, ids[:1], start, end, fields=fields)
+        return dict((f, v if f == 'timestamp' else v.ravel())
+                    for f, v in arrays.items() if f != 'contract_id')
@@ -1,3 +1,9 @@
+from leg_array import LegArray
+import monte_carlo
+import pop_engine
+import price_grid
+
+
 class Strategy(object):
     '''
     Strategy super class
@@ -5,16 +11,17 @@ class Strategy(object):
 
     def __init__(self, options_list, underlying_amount=0, name='Unknown'):
         '''
-        options_list -> list of Options composing the strategy. It is important
-            to provide this list ordered by near-term expiries first
+        options_list -> list of Options (or a LegArray) composing the
+            strategy. It is important to provide this list ordered by
+            near-term expiries first
         underlying_amount -> [Optional] amount of stocks of the underlying
             (long or short). Will consider zero if not provided.
         name -> [Optional] strategy name. To be filled at each particular
             strategy derivated from this Strategy class
         '''
-        if not isinstance(options_list, list):
+        if not isinstance(options_list, (list, LegArray)):
             raise Exception('options_list parameter must be a list')
-        elif not options_list:
+        elif not len(options_list):
             raise Exception('Cannot create an option strategy with an empty '
                             'list of options')
 
@@ -64,8 +71,46 @@ class Strategy(object):
     def plot(self):
         raise NotImplementedError('Method has not been implemented')
 
-    def get_profit_probability(self):
-        raise NotImplementedError('Method has not been implemented')
+    def get_profit_probability(self, x_vector, y_vector, iv, s, r, t):
+        '''
+        Returns the probability of obtaining a profit with the strategy at
+        the nearest expiration, for any number of profit regions
+        inputs:
+            x_vector -> vector of underlying prices
+            y_vector -> P/L of the strategy at the nearest expiration
+            iv -> underlying implied volatility (as sigma), or a VolSurface
+            s -> current underlying price
+            r -> interest rate on a 3-month U.S. Treasury bill or similar
+            t -> time to the nearest expiration in years
+        '''
+        return self.get_expiry_statistics(
+            x_vector, y_vector, iv, s, r, t)['pop']
+
+    def get_expiry_statistics(self, x_vector, y_vector, iv, s, r, t):
+        '''
+        Returns a dict with the probability of profit ('pop'), the expected
+        value ('expected_value') and the breakevens ('breakevens') of the
+        strategy at the nearest expiration. Inputs as in
+        get_profit_probability
+        '''
+        # Bound the profit regions by the root-found breakevens
+        breakevens = price_grid.find_breakevens(
+            self.options_list, self.nearest_expiration, r, iv, x_vector,
+            y_vector)
+        x, y = pop_engine.with_breakevens(x_vector, y_vector, breakevens)
+        # The underlying distribution of a surface is given by its ATM IV
+        sigma = iv.atm_iv(t) if callable(iv) else iv
+        statistics = pop_engine.expiry_statistics(x, y, s, r, sigma, t)
+        return {'pop': float(statistics['pop']),
+                'expected_value': float(statistics['expected_value']),
+                'breakevens': breakevens}
+
+    def simulate(self, s, r, iv, n_paths=100000, **kwargs):
+        '''
+        Returns the Monte Carlo P/L distribution of the strategy, managed
+        with the given exit rules (see monte_carlo.simulate for the inputs)
+        '''
+        return monte_carlo.simulate(self, s, r, iv, n_paths, **kwargs)
 
     def get_nearest_expiration(self):
         '''
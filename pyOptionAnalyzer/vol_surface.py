@@ -0,0 +1,261 @@
+'''
+Implied volatility surface fitting. The smile of every expiry is fitted in
+total implied variance (w = iv^2 * t) against the log-moneyness
+k = log(strike / forward), either with the raw SVI parameterization or with
+a smoothing spline, and the surface is interpolated linearly in total
+variance across expiries at constant log-moneyness. Surfaces are callable
+with arrays of strikes and times, so they can replace the single IV of the
+risk graphs and price every leg with its own IV.
+
+Fitted surfaces are cached per (ticker, snapshot), so they are only fitted
+once per option chain snapshot.
+'''
+from collections import OrderedDict
+from datetime import datetime
+import logging
+import numpy as np
+import pandas as pd
+from scipy.interpolate import UnivariateSpline
+from scipy.optimize import least_squares
+import iv_solver
+from calendar_scanner import underlying_price
+from chain_store import open_chain_source
+
+# Smile fitting methods
+METHODS = ('svi', 'spline')
+# Minimum quotes to fit an SVI smile (it has 5 parameters) or a cubic spline
+MIN_SVI_POINTS = 5
+MIN_SPLINE_POINTS = 4
+# Smoothing of the splines, as the tolerated error relative to the mean
+# total variance of the smile
+SPLINE_TOLERANCE = 0.01
+# Fitted surfaces kept in memory
+MAX_CACHED_SURFACES = 32
+
+_surfaces = OrderedDict()
+
+
+class SVISmile(object):
+    '''
+    Raw SVI smile: w(k) = a + b * (rho * (k - m) + sqrt((k - m)^2 + sigma^2))
+    '''
+
+    def __init__(self, a, b, rho, m, sigma):
+        self.params = (a, b, rho, m, sigma)
+
+    @staticmethod
+    def _w(params, k):
+        a, b, rho, m, sigma = params
+        return a + b * (rho * (k - m) + np.sqrt((k - m) ** 2 + sigma ** 2))
+
+    def __call__(self, k):
+        return np.maximum(self._w(self.params, k), 0.)
+
+    @classmethod
+    def fit(cls, k, w):
+        '''
+        Least squares fit of the total variance w at log-moneyness k
+        '''
+        scale = w.mean()
+        lower = [-w.max(), 0., -0.999, k.min() - 1., 1e-4]
+        upper = [w.max(), 10., 0.999, k.max() + 1., 10.]
+        x0 = [0.5 * w.min(), 0.1, -0.3, k[np.argmin(w)], 0.1]
+        res = least_squares(lambda p: (cls._w(p, k) - w) / scale, x0,
+                            jac=lambda p: cls._jacobian(p, k) / scale,
+                            bounds=(lower, upper))
+        return cls(*res.x)
+
+    @staticmethod
+    def _jacobian(params, k):
+        '''
+        Returns the (points x parameters) derivatives of w(k)
+        '''
+        a, b, rho, m, sigma = params
+        root = np.sqrt((k - m) ** 2 + sigma ** 2)
+        return np.column_stack([np.ones_like(k), rho * (k - m) + root,
+                                b * (k - m), -b * (rho + (k - m) / root),
+                                b * sigma / root])
+
+
+class SplineSmile(object):
+    '''
+    Smoothing spline of the total variance (linear interpolation when there
+    are too few quotes), flat beyond the quoted strikes
+    '''
+
+    def __init__(self, k, w):
+        self.bounds = (k.min(), k.max())
+        self.k = k
+        self.w = w
+        self.spline = None
+        if len(k) >= MIN_SPLINE_POINTS:
+            self.spline = UnivariateSpline(
+                k, w, k=3, s=len(k) * (SPLINE_TOLERANCE * w.mean()) ** 2)
+
+    def __call__(self, k):
+        k = np.clip(k, *self.bounds)
+        w = self.spline(k) if self.spline else np.interp(k, self.k, self.w)
+        return np.maximum(w, 0.)
+
+    @classmethod
+    def fit(cls, k, w):
+        return cls(k, w)
+
+
+def smile_quotes(df, s, r, date):
+    '''
+    Returns a DataFrame with the quotes used to fit the smiles: time to
+    expiration (t), log-moneyness (k) and total variance (w) of the mean of
+    the bid and ask IVs. The out of the money right of every strike is used
+    (the other one where it is the only quote)
+    inputs:
+        df -> option chain DataFrame
+        s -> underlying price
+        r -> interest rate on a 3-month U.S. Treasury bill or similar
+        date -> date when the quotes were taken
+    '''
+    df = iv_solver.fill_missing_iv(df, s, r, date)
+    iv = df[['bid_impliedVolatility', 'ask_impliedVolatility']].mean(axis=1)
+    expiries = pd.to_datetime(df['m_expiry'].astype(str), format='%Y%m%d')
+    t = (expiries - date).dt.days.values / 365.
+    strikes = pd.to_numeric(df['m_strike'], errors='coerce').values
+    k = np.log(strikes / (s * np.exp(r * t)))
+    call = np.char.upper(np.asarray(df['m_right'], dtype=str)) == 'C'
+    quotes = pd.DataFrame({'m_expiry': df['m_expiry'].values,
+                           'm_strike': strikes, 't': t, 'k': k,
+                           'w': iv.values ** 2 * t,
+                           'otm': call == (k >= 0)})
+    valid = ((quotes['t'] > 0) & (iv.values > 0) &
+             (iv.values < iv_solver.MAX_IV) & np.isfinite(k))
+    quotes = quotes[valid].sort_values('otm', ascending=False)
+    quotes = quotes.drop_duplicates(['m_expiry', 'm_strike'])
+    return quotes.sort_values(['t', 'k']).reset_index(drop=True)
+
+
+class VolSurface(object):
+    '''
+    Implied volatility surface of an option chain. Calling it with arrays of
+    strikes and times to expiration (in years) returns their IV
+    '''
+
+    def __init__(self, s, r, t, smiles):
+        '''
+        s -> underlying price
+        r -> interest rate on a 3-month U.S. Treasury bill or similar
+        t -> sorted array with the time to expiration of every smile
+        smiles -> list of smiles (callables returning the total variance at
+            the given log-moneyness)
+        '''
+        self.s = s
+        self.r = r
+        self.t = np.asarray(t, dtype=float)
+        self.smiles = smiles
+
+    @classmethod
+    def fit(cls, df, s, r, date, method='svi'):
+        '''
+        Fits the smile of every expiry of an option chain
+        inputs:
+            df -> option chain DataFrame
+            s -> underlying price
+            r -> interest rate on a 3-month U.S. Treasury bill or similar
+            date -> date when the quotes were taken (the snapshot date, not
+                today, for historical chains)
+            method -> 'svi' or 'spline'. SVI smiles with too few quotes are
+                fitted with a spline
+        '''
+        if method not in METHODS:
+            raise ValueError('Unknown smile fitting method: ' + str(method))
+        if date is None:
+            raise ValueError('The date of the option chain quotes is needed')
+        t, smiles = [], []
+        for t_exp, group in smile_quotes(df, s, r, date).groupby('t'):
+            k, w = group['k'].values, group['w'].values
+            if method == 'svi' and len(k) >= MIN_SVI_POINTS:
+                smiles.append(SVISmile.fit(k, w))
+            else:
+                smiles.append(SplineSmile.fit(k, w))
+            t.append(t_exp)
+        if not smiles:
+            raise ValueError('The option chain has no valid IV quotes as of ' +
+                             date.strftime('%Y-%m-%d'))
+        return cls(s, r, t, smiles)
+
+    def total_variance(self, k, t):
+        '''
+        Returns the total implied variance at the given log-moneyness and
+        times to expiration (broadcasted arrays). It is linear in time
+        between expiries, and keeps the IV of the first and last smiles
+        before and after them
+        '''
+        k, t = np.broadcast_arrays(np.asarray(k, dtype=float),
+                                   np.asarray(t, dtype=float))
+        shape = k.shape
+        k, t = k.ravel(), t.ravel()
+        w = np.array([smile(k) for smile in self.smiles])
+        first = w[0] * t / self.t[0]
+        last = w[-1] * t / self.t[-1]
+        if len(self.t) == 1:
+            return first.reshape(shape)
+        j = np.clip(np.searchsorted(self.t, t, side='right'), 1,
+                    len(self.t) - 1)
+        points = np.arange(len(t))
+        t0, t1 = self.t[j - 1], self.t[j]
+        w0, w1 = w[j - 1, points], w[j, points]
+        between = w0 + (w1 - w0) * (t - t0) / (t1 - t0)
+        return np.where(t < self.t[0], first, np.where(
+            t > self.t[-1], last, between)).reshape(shape)
+
+    def __call__(self, strikes, t):
+        '''
+        Returns the IV at the given strikes and times to expiration in years
+        (broadcasted arrays). Expired entries get the IV of the first smile
+        '''
+        strikes, t = np.broadcast_arrays(np.asarray(strikes, dtype=float),
+                                         np.asarray(t, dtype=float))
+        t = np.where(t > 0, t, self.t[0])
+        k = np.log(strikes / (self.s * np.exp(self.r * t)))
+        return np.sqrt(self.total_variance(k, t) / t)
+
+    def atm_iv(self, t):
+        '''
+        Returns the at the money (forward) IV at the given times
+        '''
+        t = np.asarray(t, dtype=float)
+        return np.sqrt(self.total_variance(np.zeros_like(t), t) / t)
+
+
+def get_surface(source, ticker, snapshot=None, s=None, r=0.01,
+                method='svi'):
+    '''
+    Returns the IV surface of a ticker option chain snapshot, fitting it
+    only the first time it is requested
+    inputs:
+        source -> excel file or chain store directory
+        ticker -> ticker whose surface is requested
+        snapshot -> [Optional] snapshot date as YYYYMMDD (default latest,
+            or the one in the file name of an excel file)
+        s -> [Optional] underlying price (default the one quoted along with
+            the chain)
+        r -> interest rate on a 3-month U.S. Treasury bill or similar
+        method -> 'svi' or 'spline'
+    '''
+    chain_source = open_chain_source(source)
+    if snapshot is None:
+        snapshots = chain_source.snapshots(ticker)
+        if not snapshots:
+            raise ValueError('No snapshots stored for ' + str(ticker))
+        snapshot = snapshots[-1]
+    key = (source, ticker, snapshot, s, r, method)
+    if key in _surfaces:
+        surface = _surfaces[key] = _surfaces.pop(key)
+        return surface
+
+    df = chain_source.load(ticker, snapshot)
+    date = datetime.strptime(snapshot, '%Y%m%d')
+    s = s if s else underlying_price(df)
+    logging.info('Fitting ' + ticker + ' IV surface (' + method + ')')
+    surface = _surfaces[key] = VolSurface.fit(df, s, r, date, method)
+    while len(_surfaces) > MAX_CACHED_SURFACES:
+        _surfaces.popitem(last=False)
+    return surface